@@ -0,0 +1,330 @@
+
+##########################
+# ADAPTIVE EVALUATION
+##########################
+
+# 'and'/'or' are commutative, so the operands of a chain can run in any
+# order. AdaptiveExpression evaluates chains with short-circuiting,
+# counts per operand how often it ran, how often it came out true or
+# false and what it cost (visited nodes, like specialize.py), and every
+# `interval` evaluations sorts each chain so cheap, decisive operands
+# come first.
+#
+# The Interpreter always evaluates both operands and reports the first
+# error in source order, so skipping an operand is only safe if nothing
+# can fail. Every error of this language (undefined identifier, wrong
+# operand type) follows from the types of the facts alone, so the
+# expression is type checked once per combination of fact types. If it
+# could fail, that evaluation goes through the plain Interpreter and
+# gives exactly the same result and error.
+
+import json
+
+from interpreter import *
+from render import chain, is_logical
+from specialize import count_nodes
+
+
+DEFAULT_INTERVAL = 1000
+
+ORDERING_OPS = (TT_LT, TT_LTE, TT_GT, TT_GTE)
+
+# the outcome that decides a chain right away
+DECISIVE = {'and': 'FALSE', 'or': 'TRUE'}
+
+
+def kind_of(value):
+    if value == None:
+        return None
+    return 'bool' if isinstance(value, Booleen) else 'num'
+
+
+def check_types(node, kinds):
+    # 'bool' or 'num' for the node, None if evaluating it can fail
+    if isinstance(node, BooleanNode):
+        return 'bool'
+    if isinstance(node, NumberNode):
+        return 'num'
+    if isinstance(node, VarAccessNode):
+        return kinds.get(node.var_name_tok.value)
+
+    if isinstance(node, UnaryOpNode):
+        kind = check_types(node.node, kinds)
+        if node.op_tok.type == TT_NEG and kind != 'bool':
+            return None
+        return kind
+
+    # long chains nest on the left, the left spine is walked in a loop
+    spine = left_spine(node)
+    kind = check_types(spine[-1].left_node, kinds)
+    for node in reversed(spine):
+        if kind == None:
+            return None
+        kind = binop_kind(node, kind, check_types(node.right_node, kinds))
+    return kind
+
+
+def binop_kind(node, left, right):
+    if left == None or right == None:
+        return None
+    if node.op_tok.type == TT_KEYWORD:
+        return 'bool' if left == right == 'bool' else None
+    if node.op_tok.type in ORDERING_OPS:
+        return 'bool' if left == right == 'num' else None
+    # '==' and '!=' compare any two values
+    return 'bool'
+
+
+class OperandStats:
+    def __init__(self, node):
+        self.node = node
+        self.nodes = count_nodes(node)
+        self.evaluated = 0
+        self.true = 0
+        self.false = 0
+        self.cost = 0
+
+    def source(self):
+        return self.node.pos_start.ftxt[self.node.pos_start.idx:self.node.pos_end.idx]
+
+    def average_cost(self):
+        # the size of the operand stands in until it has run
+        return (self.cost + self.nodes) / (self.evaluated + 1)
+
+    def score(self, kind):
+        # expected cost per decided chain, lower runs first
+        decided = self.false if kind == 'and' else self.true
+        return self.average_cost() / ((decided + 1) / (self.evaluated + 2))
+
+    def as_dict(self):
+        return {
+            'source': self.source(),
+            'evaluated': self.evaluated,
+            'true': self.true,
+            'false': self.false,
+            'cost': self.cost,
+        }
+
+
+class Chain:
+    def __init__(self, node):
+        self.node = node
+        self.kind = node.op_tok.value.lower()
+        # in evaluation order
+        self.operands = [OperandStats(operand) for operand in chain(node)]
+
+    def source(self):
+        return self.node.pos_start.ftxt[self.node.pos_start.idx:self.node.pos_end.idx]
+
+    def reorder(self):
+        order = sorted(self.operands, key=lambda stats: stats.score(self.kind))
+        changed = order != self.operands
+        self.operands = order
+        return changed
+
+    def as_dict(self):
+        return {
+            'start': self.node.pos_start.idx,
+            'source': self.source(),
+            'kind': self.kind,
+            'order': [stats.as_dict() for stats in self.operands],
+        }
+
+
+##########################
+# ADAPTIVE EXPRESSION
+##########################
+
+class AdaptiveExpression:
+    def __init__(self, expr, interval=DEFAULT_INTERVAL):
+        self.expr = expr
+        self.interval = interval
+        self.interpreter = Interpreter()
+        # id of the top node of every chain -> Chain
+        self.chains = {}
+        self.add_chains(expr.node)
+        # fact types -> whether evaluation can fail
+        self.safe = {}
+        self.evaluations = 0
+        self.fallbacks = 0
+        self.reorders = 0
+        self.visited = 0
+
+    def add_chains(self, node):
+        if is_logical(node):
+            chain = self.chains[id(node)] = Chain(node)
+            for stats in chain.operands:
+                self.add_chains(stats.node)
+        elif isinstance(node, BinOpNode):
+            self.add_chains(node.left_node)
+            self.add_chains(node.right_node)
+        elif isinstance(node, UnaryOpNode):
+            self.add_chains(node.node)
+
+    def is_safe(self, symbols):
+        signature = tuple(kind_of(symbols.get(name))
+                          for name in self.expr.identifiers)
+        safe = self.safe.get(signature)
+        if safe == None:
+            kinds = dict(zip(self.expr.identifiers, signature))
+            safe = self.safe[signature] = check_types(self.expr.node, kinds) != None
+        return safe
+
+    def evaluate(self, bindings=None):
+        # returns (value, error) like Expression.evaluate
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        if bindings:
+            context.symbol_table.update(bindings)
+
+        self.evaluations += 1
+        if self.evaluations % self.interval == 0:
+            self.reorder()
+
+        if not self.is_safe(context.symbol_table):
+            self.fallbacks += 1
+            result = self.interpreter.visit(self.expr.node, context)
+            return result.value, result.error
+
+        node = self.expr.node
+        value = self.value(node, context.symbol_table)
+        value = Booleen(value) if isinstance(value, str) else Number(value)
+        return value.set_context(context).set_pos(node.pos_start, node.pos_end), None
+
+    def value(self, node, symbols):
+        # py value of a node that cannot fail, bools stay 'TRUE'/'FALSE'
+        # so '==' between a bool and a number behaves like Booleen/Number
+        self.visited += 1
+        if isinstance(node, (BooleanNode, NumberNode)):
+            return node.tok.value
+        if isinstance(node, VarAccessNode):
+            return symbols.get(node.var_name_tok.value).value
+
+        if isinstance(node, UnaryOpNode):
+            value = self.value(node.node, symbols)
+            if node.op_tok.type == TT_NEG:
+                return 'FALSE' if value == 'TRUE' else 'TRUE'
+            return value
+
+        chain = self.chains.get(id(node))
+        if chain != None:
+            return self.chain_value(chain, symbols)
+
+        left = self.value(node.left_node, symbols)
+        right = self.value(node.right_node, symbols)
+        op = node.op_tok.type
+        if op == TT_EE:
+            result = left == right
+        elif op == TT_NE:
+            result = left != right
+        elif op == TT_LT:
+            result = left < right
+        elif op == TT_LTE:
+            result = left <= right
+        elif op == TT_GT:
+            result = left > right
+        else:
+            result = left >= right
+        return 'TRUE' if result else 'FALSE'
+
+    def chain_value(self, chain, symbols):
+        decisive = DECISIVE[chain.kind]
+        for stats in chain.operands:
+            before = self.visited
+            value = self.value(stats.node, symbols)
+            stats.evaluated += 1
+            stats.cost += self.visited - before
+            if value == 'TRUE':
+                stats.true += 1
+            else:
+                stats.false += 1
+            if value == decisive:
+                return value
+        return 'TRUE' if decisive == 'FALSE' else 'FALSE'
+
+    def reorder(self):
+        # returns the number of chains whose order changed
+        changed = 0
+        for chain in self.chains.values():
+            if chain.reorder():
+                changed += 1
+        self.reorders += 1
+        return changed
+
+    def decisions(self):
+        return [chain.as_dict() for chain in self.chains.values()]
+
+    def to_json(self):
+        return json.dumps({
+            'text': self.expr.text,
+            'evaluations': self.evaluations,
+            'chains': self.decisions(),
+        }, indent=2)
+
+    def load_json(self, text):
+        # restores orders and stats saved by to_json, chains and operands
+        # are matched by position and source, unknown ones are skipped
+        data = json.loads(text)
+        chains = {(chain.node.pos_start.idx, chain.source()): chain
+                  for chain in self.chains.values()}
+        for saved in data['chains']:
+            chain = chains.get((saved['start'], saved['source']))
+            if chain == None:
+                continue
+            remaining = list(chain.operands)
+            order = []
+            for entry in saved['order']:
+                for stats in remaining:
+                    if stats.source() == entry['source']:
+                        stats.evaluated = entry['evaluated']
+                        stats.true = entry['true']
+                        stats.false = entry['false']
+                        stats.cost = entry['cost']
+                        remaining.remove(stats)
+                        order.append(stats)
+                        break
+            chain.operands = order + remaining
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            file.write(self.to_json())
+
+    def load(self, path):
+        with open(path) as file:
+            self.load_json(file.read())
+
+
+if __name__ == '__main__':
+    import random
+    import time
+    import expression
+
+    # the cheap, usually false check comes last
+    expr, error = expression.compile(
+        '(a > 1 or b > 1 or c > 1 or d > 1) and (e == 1 or f == 1 or g == 1) '
+        'and !(h > 5 and i > 5) and vip')
+    adaptive = AdaptiveExpression(expr)
+
+    random.seed(0)
+    rows = [{name: random.randint(0, 9) for name in 'abcdefghi'}
+            for _ in range(2000)]
+    for row in rows:
+        row['vip'] = random.random() < 0.05
+
+    runs = 20
+    start = time.perf_counter()
+    for _ in range(runs):
+        for row in rows:
+            expr.evaluate(row)
+    plain = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        for row in rows:
+            adaptive.evaluate(row)
+    adapted = time.perf_counter() - start
+
+    for chain in adaptive.decisions():
+        print(chain['kind'], [operand['source'] for operand in chain['order']])
+    print(f'plain    {runs * len(rows) / plain:.0f} evals/s')
+    print(f'adaptive {runs * len(rows) / adapted:.0f} evals/s')
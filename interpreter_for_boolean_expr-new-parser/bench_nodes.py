@@ -0,0 +1,91 @@
+
+##########################
+# PER NODE BENCHMARK
+##########################
+
+# Time per AST node for parsing and for evaluation, plus whole run()
+# calls on a short rule. Big expressions are nested as balanced trees
+# so they stay within the default depth limit.
+
+import random
+import time
+
+from interpreter import *
+
+
+RUNS = 5
+
+
+def balanced(leaves):
+    if len(leaves) == 1:
+        return leaves[0]
+    middle = len(leaves) // 2
+    op = random.choice(['and', 'or'])
+    return f'({balanced(leaves[:middle])} {op} {balanced(leaves[middle:])})'
+
+
+def leaf(i):
+    return random.choice([f'x{i % 50} > {i % 7}', f'!b{i % 50}',
+                          f'x{i % 50} == {i % 3}.5', 'true'])
+
+
+def best_of(function):
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def count_nodes(node):
+    nodes = [node]
+    count = 0
+    while nodes:
+        node = nodes.pop()
+        count += 1
+        if isinstance(node, BinOpNode):
+            nodes.append(node.left_node)
+            nodes.append(node.right_node)
+        elif isinstance(node, UnaryOpNode):
+            nodes.append(node.node)
+    return count
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    text = balanced([leaf(i) for i in range(20000)])
+    bindings = {}
+    for i in range(50):
+        bindings[f'x{i}'] = i
+        bindings[f'b{i}'] = i % 2 == 0
+
+    tokens, error = Lexer('<bench>', text).make_tokens()
+    node = Parser(tokens).parse().node
+    nodes = count_nodes(node)
+
+    def parse():
+        Parser(tokens).parse()
+
+    def evaluate():
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        context.governor = Governor()
+        context.symbol_table.update(bindings)
+        result = Interpreter().visit(node, context)
+        assert result.error == None
+
+    rule = 'active and age >= 18 or !active and score > 7.5 or age == 42'
+    rule_bindings = {'active': True, 'age': 30, 'score': 8.0}
+    calls = 20000
+
+    def run_rule():
+        for _ in range(calls):
+            run('<bench>', rule, rule_bindings)
+
+    print(f'{nodes} nodes')
+    print(f'parse:    {best_of(parse) / nodes * 1e9:7.0f} ns/node')
+    print(f'evaluate: {best_of(evaluate) / nodes * 1e9:7.0f} ns/node')
+    print(f'run():    {best_of(run_rule) / calls * 1e6:7.1f} us/call')
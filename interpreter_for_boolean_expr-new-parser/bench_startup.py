@@ -0,0 +1,49 @@
+
+##########################
+# STARTUP BENCHMARK
+##########################
+
+# Measures how long a fresh process needs to import the interpreter
+# compared to an empty interpreter start, like when spawned per job.
+
+import subprocess
+import sys
+import time
+
+
+def spawn(code, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def import_times(module):
+    # self time per module from python -X importtime, slowest first
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True).stderr
+    times = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self' in line:
+            continue
+        self_us, cumulative_us, name = line.split('|')
+        times.append((int(self_us.split(':')[1]), name.strip()))
+    return sorted(times, reverse=True)
+
+
+if __name__ == '__main__':
+    runs = 20
+    baseline = spawn('pass', runs)
+    startup = spawn('import interpreter', runs)
+    print(f'python -c pass:        {baseline * 1000:6.1f} ms')
+    print(f'import interpreter:    {startup * 1000:6.1f} ms')
+    print(f'import overhead:       {(startup - baseline) * 1000:6.1f} ms')
+
+    print('\nslowest imports (self time):')
+    for self_us, name in import_times('interpreter')[:5]:
+        print(f'{self_us:8d} us  {name}')
@@ -0,0 +1,56 @@
+
+##########################
+# THREAD BENCHMARK
+##########################
+
+# Evaluates one shared compiled Expression from 1..N threads.
+# On a free-threaded build (3.13t) throughput should grow with the
+# thread count, on the GIL build it should stay flat.
+
+import sys
+import threading
+import time
+
+import expression
+
+
+TEXT = 'active and age >= 18 or !active and score > 7.5 or age == 42'
+EVALUATIONS = 20000
+
+
+def worker(expr, offset, count, barrier):
+    barrier.wait()
+    for i in range(count):
+        bindings = {
+            'active': (i + offset) % 2 == 0,
+            'age': (i + offset) % 100,
+            'score': (i % 10) + 0.5,
+        }
+        expr.evaluate(bindings)
+
+
+def measure(expr, threads):
+    barrier = threading.Barrier(threads + 1)
+    count = EVALUATIONS // threads
+    pool = [threading.Thread(target=worker, args=(expr, n, count, barrier))
+            for n in range(threads)]
+    for thread in pool:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print(f'python {sys.version.split()[0]}, GIL enabled: {gil_enabled}')
+
+    expr, error = expression.compile(TEXT)
+    single = measure(expr, 1)
+    for threads in (1, 2, 4, 8):
+        elapsed = measure(expr, threads)
+        print(f'{threads} threads: {EVALUATIONS / elapsed:10,.0f} evals/s '
+              f'(speedup {single / elapsed:4.2f}x)')
@@ -0,0 +1,727 @@
+
+##########################
+# BITMAP INDEX
+##########################
+
+# Answers "which rows satisfy this expression" from precomputed bitmaps
+# instead of evaluating every row. Bool columns get one bitmap of their
+# true rows. Numeric columns are cut into buckets by quantiles, every
+# bucket gets a bitmap of its rows and remembers its smallest and
+# largest value. A comparison takes the buckets it holds for as a whole
+# and only rechecks the rows of the buckets its literal falls into
+# against the raw values. 'and', 'or' and '!' become intersection,
+# union and complement.
+#
+# Bitmaps are roaring style: rows are split into chunks of 2**16 and a
+# chunk is stored as a sorted uint16 array while it has at most
+# ARRAY_LIMIT rows, else as a 1024 word bitset. An index is saved as one
+# file and loaded with mmap, containers are used in place without
+# copying.
+#
+# Results and errors match evaluate_columns in vectorized.py. A column
+# has one type, so a type error holds from the first row on and is
+# reported as a ColumnError in row 0.
+
+import json
+import mmap
+
+import numpy as np
+
+from interpreter import *
+from vectorized import ColumnError, compare, equal, prepare_columns
+
+
+CHUNK_BITS = 16
+CHUNK_ROWS = 1 << CHUNK_BITS
+WORDS = CHUNK_ROWS // 64
+ARRAY_LIMIT = 4096
+DEFAULT_BUCKETS = 64
+
+MAGIC = b'BMINDEX1'
+
+
+##########################
+# CONTAINERS
+##########################
+
+# a container is a uint16 array of set rows or a uint64 array of WORDS
+
+def is_bitset(container):
+    return container.dtype == np.uint64
+
+
+def to_words(container):
+    if is_bitset(container):
+        return container
+    mask = np.zeros(CHUNK_ROWS, dtype=bool)
+    mask[container] = True
+    return np.packbits(mask, bitorder='little').view(np.uint64)
+
+
+def to_rows(container):
+    if is_bitset(container):
+        bits = np.unpackbits(container.view(np.uint8), bitorder='little')
+        return np.flatnonzero(bits).astype(np.uint16)
+    return container
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        return int(np.bitwise_count(words).sum())
+else:
+    # numpy before 2.0, the bits of every byte are looked up in a table
+    BYTE_BITS = np.array([bin(byte).count('1') for byte in range(256)],
+                         dtype=np.uint8)
+
+    def popcount(words):
+        return int(BYTE_BITS[words.view(np.uint8)].sum())
+
+
+def cardinality(container):
+    if is_bitset(container):
+        return popcount(container)
+    return len(container)
+
+
+def compact(words):
+    # the smaller representation of a bitset, None if it is empty
+    count = popcount(words)
+    if count == 0:
+        return None
+    if count <= ARRAY_LIMIT:
+        return to_rows(words)
+    return words
+
+
+def from_chunk_mask(mask):
+    count = int(np.count_nonzero(mask))
+    if count == 0:
+        return None
+    if count <= ARRAY_LIMIT:
+        return np.flatnonzero(mask).astype(np.uint16)
+    if len(mask) < CHUNK_ROWS:
+        mask = np.concatenate([mask, np.zeros(CHUNK_ROWS - len(mask), dtype=bool)])
+    return np.packbits(mask, bitorder='little').view(np.uint64)
+
+
+def container_and(a, b):
+    if not is_bitset(a) and not is_bitset(b):
+        result = np.intersect1d(a, b, assume_unique=True)
+        return result if len(result) else None
+    if is_bitset(a) and is_bitset(b):
+        return compact(a & b)
+    rows, words = (a, b) if is_bitset(b) else (b, a)
+    hits = (words[rows >> 6] >> (rows & 63).astype(np.uint64)) & np.uint64(1)
+    result = rows[hits.astype(bool)]
+    return result if len(result) else None
+
+
+def container_or(a, b):
+    if not is_bitset(a) and not is_bitset(b):
+        result = np.union1d(a, b)
+        if len(result) > ARRAY_LIMIT:
+            return to_words(result)
+        return result
+    # at least one side has more than ARRAY_LIMIT rows already
+    return to_words(a) | to_words(b)
+
+
+def container_xor(a, b):
+    if not is_bitset(a) and not is_bitset(b):
+        result = np.setxor1d(a, b, assume_unique=True)
+        if len(result) > ARRAY_LIMIT:
+            return to_words(result)
+        return result if len(result) else None
+    return compact(to_words(a) ^ to_words(b))
+
+
+def full_words(rows):
+    mask = np.zeros(CHUNK_ROWS, dtype=bool)
+    mask[:rows] = True
+    return np.packbits(mask, bitorder='little').view(np.uint64)
+
+
+##########################
+# BITMAP
+##########################
+
+class Bitmap:
+    def __init__(self, size, containers=None):
+        # rows 0 .. size - 1 can be set
+        self.size = size
+        # chunk number -> container, empty chunks are left out
+        self.containers = containers if containers != None else {}
+
+    @staticmethod
+    def from_mask(mask):
+        bitmap = Bitmap(len(mask))
+        for key, start in enumerate(range(0, len(mask), CHUNK_ROWS)):
+            container = from_chunk_mask(mask[start:start + CHUNK_ROWS])
+            if container is not None:
+                bitmap.containers[key] = container
+        return bitmap
+
+    @staticmethod
+    def from_rows(rows, size):
+        # rows must be sorted and unique
+        bitmap = Bitmap(size)
+        if not len(rows):
+            return bitmap
+        keys = rows >> CHUNK_BITS
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        for group in np.split(rows, bounds):
+            low = (group & (CHUNK_ROWS - 1)).astype(np.uint16)
+            if len(low) > ARRAY_LIMIT:
+                low = to_words(low)
+            bitmap.containers[int(group[0]) >> CHUNK_BITS] = low
+        return bitmap
+
+    @staticmethod
+    def full(size):
+        return ~Bitmap(size)
+
+    def chunk_words(self, key):
+        # the bitset of all rows in a chunk
+        rows = min(self.size - (key << CHUNK_BITS), CHUNK_ROWS)
+        if rows == CHUNK_ROWS:
+            return np.full(WORDS, np.uint64(0xFFFFFFFFFFFFFFFF))
+        return full_words(rows)
+
+    def __and__(self, other):
+        result = Bitmap(self.size)
+        small, large = sorted((self.containers, other.containers), key=len)
+        for key, container in small.items():
+            if key in large:
+                container = container_and(container, large[key])
+                if container is not None:
+                    result.containers[key] = container
+        return result
+
+    def __or__(self, other):
+        result = Bitmap(self.size, dict(self.containers))
+        for key, container in other.containers.items():
+            if key in result.containers:
+                container = container_or(result.containers[key], container)
+            result.containers[key] = container
+        return result
+
+    def __xor__(self, other):
+        result = Bitmap(self.size, dict(self.containers))
+        for key, container in other.containers.items():
+            if key in result.containers:
+                container = container_xor(result.containers[key], container)
+                if container is None:
+                    del result.containers[key]
+                    continue
+            result.containers[key] = container
+        return result
+
+    def __invert__(self):
+        result = Bitmap(self.size)
+        for key in range((self.size + CHUNK_ROWS - 1) >> CHUNK_BITS):
+            words = self.chunk_words(key)
+            container = self.containers.get(key)
+            if container is not None:
+                words = compact(words & ~to_words(container))
+            if words is not None:
+                result.containers[key] = words
+        return result
+
+    def count(self):
+        return sum(cardinality(container)
+                   for container in self.containers.values())
+
+    def to_array(self):
+        parts = [to_rows(self.containers[key]).astype(np.int64) + (key << CHUNK_BITS)
+                 for key in sorted(self.containers)]
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(parts)
+
+    def __iter__(self):
+        for key in sorted(self.containers):
+            rows = to_rows(self.containers[key]).astype(np.int64) + (key << CHUNK_BITS)
+            yield from rows.tolist()
+
+    def to_mask(self):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.to_array()] = True
+        return mask
+
+    def __repr__(self):
+        return f'Bitmap({self.count()} of {self.size} rows)'
+
+
+def union(bitmaps, size):
+    # merges every chunk once instead of pairwise
+    groups = {}
+    for bitmap in bitmaps:
+        for key, container in bitmap.containers.items():
+            groups.setdefault(key, []).append(container)
+
+    result = Bitmap(size)
+    for key, containers in groups.items():
+        if len(containers) == 1:
+            result.containers[key] = containers[0]
+            continue
+        mask = np.zeros(CHUNK_ROWS, dtype=bool)
+        words = np.packbits(mask, bitorder='little').view(np.uint64)
+        for container in containers:
+            if is_bitset(container):
+                words = words | container
+            else:
+                mask[container] = True
+        words = words | np.packbits(mask, bitorder='little').view(np.uint64)
+        result.containers[key] = compact(words)
+    return result
+
+
+##########################
+# COLUMNS
+##########################
+
+class BoolColumn:
+    def __init__(self, bitmap):
+        self.bitmap = bitmap
+
+
+class Bucket:
+    def __init__(self, min, max, bitmap):
+        self.min = min
+        self.max = max
+        self.bitmap = bitmap
+
+
+class NumberColumn:
+    def __init__(self, values, nan, buckets):
+        # the raw values for rechecks, the rows holding NaN
+        self.values = values
+        self.nan = nan
+        self.buckets = buckets
+
+
+def build_number_column(values, buckets):
+    size = len(values)
+    if values.dtype.kind == 'f':
+        is_nan = np.isnan(values)
+    else:
+        is_nan = np.zeros(size, dtype=bool)
+    rows = np.flatnonzero(~is_nan)
+    if not len(rows):
+        return NumberColumn(values, Bitmap.from_mask(is_nan), [])
+
+    present = values[rows]
+    edges = np.unique(np.quantile(present, np.linspace(0, 1, buckets + 1)))
+    bucket_of = np.searchsorted(edges[1:-1], present, side='right')
+    order = np.argsort(bucket_of, kind='stable')
+    counts = np.bincount(bucket_of, minlength=len(edges))
+
+    result = []
+    start = 0
+    for count in counts:
+        if count == 0:
+            continue
+        segment = order[start:start + count]
+        start += count
+        segment_values = present[segment]
+        result.append(Bucket(segment_values.min().item(),
+                             segment_values.max().item(),
+                             Bitmap.from_rows(rows[segment], size)))
+    return NumberColumn(values, Bitmap.from_mask(is_nan), result)
+
+
+def bucket_decision(op, bucket, value):
+    # 'all', 'none' or 'check' for the rows of a bucket
+    low, high = bucket.min, bucket.max
+    if op == TT_LT:
+        return 'all' if high < value else 'none' if low >= value else 'check'
+    if op == TT_LTE:
+        return 'all' if high <= value else 'none' if low > value else 'check'
+    if op == TT_GT:
+        return 'all' if low > value else 'none' if high <= value else 'check'
+    if op == TT_GTE:
+        return 'all' if low >= value else 'none' if high < value else 'check'
+    # '=='
+    if value < low or value > high:
+        return 'none'
+    return 'all' if low == high else 'check'
+
+
+##########################
+# QUERY
+##########################
+
+class Numbers:
+    # a number operand, a whole column or a literal
+    def __init__(self, column=None, value=None):
+        self.column = column
+        self.value = value
+
+
+class QueryResult:
+    def __init__(self, bitmap, rechecked):
+        self.bitmap = bitmap
+        # rows compared against raw values in boundary buckets
+        self.rechecked = rechecked
+
+    def count(self):
+        return self.bitmap.count()
+
+    def __iter__(self):
+        return iter(self.bitmap)
+
+    def to_array(self):
+        return self.bitmap.to_array()
+
+    def __repr__(self):
+        return f'QueryResult({self.count()} rows, {self.rechecked} rechecked)'
+
+
+FLIPPED = {TT_LT: TT_GT, TT_LTE: TT_GTE, TT_GT: TT_LT, TT_GTE: TT_LTE,
+           TT_EE: TT_EE}
+
+
+class IndexInterpreter:
+    # visits return (Bitmap or Numbers, error)
+    def __init__(self, index, context):
+        self.index = index
+        self.context = context
+        self.rechecked = 0
+
+    def visit(self, node):
+        method_name = f'visit_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_visit_method)
+        return method(node)
+
+    def no_visit_method(self, node):
+        raise Exception(f'No visit_{type(node).__name__} method defined')
+
+    def constant(self, value):
+        bitmap = Bitmap(self.index.rows)
+        return ~bitmap if value else bitmap
+
+    def visit_BooleanNode(self, node):
+        return self.constant(node.tok.value == 'TRUE'), None
+
+    def visit_NumberNode(self, node):
+        return Numbers(value=node.tok.value), None
+
+    def visit_VarAccessNode(self, node):
+        var_name = node.var_name_tok.value
+        column = self.index.columns.get(var_name)
+        if column == None:
+            return None, ColumnError(node.pos_start, node.pos_end,
+                                     f"'{var_name}' is not defined", self.context)
+        if isinstance(column, BoolColumn):
+            return column.bitmap, None
+        return Numbers(column=column), None
+
+    def visit_UnaryOpNode(self, node):
+        value, error = self.visit(node.node)
+        if error:
+            return None, error
+        if node.op_tok.type != TT_NEG:
+            return value, None
+        if isinstance(value, Numbers):
+            return None, ColumnError(node.node.pos_start, node.node.pos_end,
+                                     "Negation of 'int/float'", self.context)
+        return ~value, None
+
+    def visit_BinOpNode(self, node):
+        # long chains nest on the left, the left spine is walked in a loop
+        spine = left_spine(node)
+        left, error = self.visit(spine[-1].left_node)
+        for node in reversed(spine):
+            if error:
+                return None, error
+            left, error = self.combine(node, left)
+        return left, error
+
+    def combine(self, node, left):
+        # node with its left operand visited already
+        right, error = self.visit(node.right_node)
+        if error:
+            return None, error
+
+        op_tok = node.op_tok
+        if op_tok.type == TT_KEYWORD:
+            # Number.and_to reports on itself, Booleen.and_to on the other side
+            if isinstance(left, Numbers):
+                return None, ColumnError(
+                    node.left_node.pos_start, node.left_node.pos_end,
+                    f"Logical operation on 'int/float' and '{kind_of(right)}'",
+                    self.context)
+            if isinstance(right, Numbers):
+                return None, ColumnError(
+                    node.right_node.pos_start, node.right_node.pos_end,
+                    "Logical operation on 'bool' and 'int/float'", self.context)
+            if op_tok.matches(TT_KEYWORD, 'AND'):
+                return left & right, None
+            return left | right, None
+
+        if op_tok.type in (TT_EE, TT_NE):
+            equal = self.equal(left, right)
+            return (equal if op_tok.type == TT_EE else ~equal), None
+
+        # Booleen reports on itself, Number.less_than on the other side
+        if isinstance(left, Bitmap):
+            return None, ColumnError(
+                node.left_node.pos_start, node.left_node.pos_end,
+                f"Comparsion of 'bool' and '{kind_of(right)}'", self.context)
+        if isinstance(right, Bitmap):
+            return None, ColumnError(
+                node.right_node.pos_start, node.right_node.pos_end,
+                "Comparsion of 'bool' and 'int/float'", self.context)
+        return self.compare(op_tok.type, left, right), None
+
+    def equal(self, left, right):
+        if isinstance(left, Bitmap) and isinstance(right, Bitmap):
+            return ~(left ^ right)
+        if isinstance(left, Bitmap) or isinstance(right, Bitmap):
+            # values of different types are never equal
+            return self.constant(False)
+        return self.compare(TT_EE, left, right)
+
+    def compare(self, op, left, right):
+        # op is '==' or an ordering, '!=' is the complement of '=='
+        if left.column == None and right.column == None:
+            return self.constant(bool(compare_values(op, left.value, right.value)))
+        if left.column != None and right.column != None:
+            return Bitmap.from_mask(
+                compare_values(op, left.column.values, right.column.values))
+        if left.column == None:
+            op, left, right = FLIPPED[op], right, left
+        return self.compare_buckets(op, left.column, right.value)
+
+    def compare_buckets(self, op, column, value):
+        # NaN rows are in no bucket and never match
+        parts = []
+        for bucket in column.buckets:
+            decision = bucket_decision(op, bucket, value)
+            if decision == 'all':
+                parts.append(bucket.bitmap)
+            elif decision == 'check':
+                rows = bucket.bitmap.to_array()
+                self.rechecked += len(rows)
+                mask = compare_values(op, column.values[rows], value)
+                parts.append(Bitmap.from_rows(rows[mask], self.index.rows))
+        return union(parts, self.index.rows)
+
+
+def compare_values(op, left, right):
+    if op == TT_EE:
+        return equal(left, right)
+    return compare(op, left, right)
+
+
+def kind_of(value):
+    return 'int/float' if isinstance(value, Numbers) else 'bool'
+
+
+##########################
+# INDEX
+##########################
+
+class BitmapIndex:
+    def __init__(self, rows, columns):
+        self.rows = rows
+        # upper case name -> BoolColumn or NumberColumn
+        self.columns = columns
+        self.mmap = None
+
+    @staticmethod
+    def build(columns, buckets=DEFAULT_BUCKETS):
+        columns, rows = prepare_columns(columns)
+        result = {}
+        for name, values in columns.items():
+            if values.dtype.kind == 'b':
+                result[name] = BoolColumn(Bitmap.from_mask(values))
+            elif values.dtype.kind in 'iuf':
+                result[name] = build_number_column(values, buckets)
+            else:
+                raise TypeError(f"Column '{name}' must hold only bools "
+                                "or only numbers to be indexed")
+        return BitmapIndex(rows, result)
+
+    def query_node(self, node):
+        interpreter = IndexInterpreter(self, Context('<index>'))
+        bitmap, error = interpreter.visit(node)
+        if error:
+            return None, error
+        if isinstance(bitmap, Numbers):
+            return None, ColumnError(node.pos_start, node.pos_end,
+                                     "Expected 'bool' result, got 'int/float'",
+                                     interpreter.context)
+        if self.mmap != None:
+            # containers taken as is are views into the mapping, copies
+            # let the result outlive close()
+            bitmap = Bitmap(bitmap.size, {
+                key: container if container.base is None else container.copy()
+                for key, container in bitmap.containers.items()})
+        return QueryResult(bitmap, interpreter.rechecked), None
+
+    def query(self, text, fn='<query>'):
+        # Generate tokens
+        lexer = Lexer(fn, text)
+        tokens, error = lexer.make_tokens()
+        if error:
+            return None, error
+
+        # Generate AST
+        parser = Parser(tokens)
+        ast = parser.parse()
+        if ast.error:
+            return None, ast.error
+
+        return self.query_node(ast.node)
+
+    def count(self, text, fn='<query>'):
+        result, error = self.query(text, fn)
+        if error:
+            return None, error
+        return result.count(), None
+
+    def row_ids(self, text, fn='<query>'):
+        result, error = self.query(text, fn)
+        if error:
+            return None, error
+        return iter(result), None
+
+    ##########################
+    # PERSISTENCE
+    ##########################
+
+    # MAGIC, the length of the JSON header as uint64, the header padded
+    # to 8 bytes, then every array 8 byte aligned. Offsets in the header
+    # are relative to the end of the header.
+
+    def save(self, path):
+        blobs = []
+        offset = 0
+
+        def add(array):
+            nonlocal offset
+            start = offset
+            data = np.ascontiguousarray(array).tobytes()
+            blobs.append(data + b'\0' * (-len(data) % 8))
+            offset += len(blobs[-1])
+            return [start, len(array)]
+
+        def add_bitmap(bitmap):
+            return [[key, 'b' if is_bitset(container) else 'a', *add(container)]
+                    for key, container in sorted(bitmap.containers.items())]
+
+        header = {'rows': self.rows, 'columns': {}}
+        for name, column in self.columns.items():
+            if isinstance(column, BoolColumn):
+                header['columns'][name] = {'kind': 'bool',
+                                           'bitmap': add_bitmap(column.bitmap)}
+                continue
+            header['columns'][name] = {
+                'kind': 'number',
+                'dtype': column.values.dtype.str,
+                'values': add(column.values),
+                'nan': add_bitmap(column.nan),
+                'buckets': [[bucket.min, bucket.max, add_bitmap(bucket.bitmap)]
+                            for bucket in column.buckets],
+            }
+
+        data = json.dumps(header).encode()
+        data += b' ' * (-len(data) % 8)
+        with open(path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(np.uint64(len(data)).tobytes())
+            file.write(data)
+            for blob in blobs:
+                file.write(blob)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            buffer.close()
+            raise ValueError(f"'{path}' is not a bitmap index")
+        length = int(np.frombuffer(buffer, np.uint64, 1, len(MAGIC))[0])
+        base = len(MAGIC) + 8
+        header = json.loads(bytes(buffer[base:base + length]))
+        base += length
+
+        def array(dtype, entry):
+            start, count = entry
+            return np.frombuffer(buffer, dtype, count, base + start)
+
+        def bitmap(entries):
+            return Bitmap(header['rows'], {
+                key: array(np.uint64 if kind == 'b' else np.uint16, [start, count])
+                for key, kind, start, count in entries})
+
+        columns = {}
+        for name, column in header['columns'].items():
+            if column['kind'] == 'bool':
+                columns[name] = BoolColumn(bitmap(column['bitmap']))
+                continue
+            columns[name] = NumberColumn(
+                array(np.dtype(column['dtype']), column['values']),
+                bitmap(column['nan']),
+                [Bucket(low, high, bitmap(entries))
+                 for low, high, entries in column['buckets']])
+
+        index = BitmapIndex(header['rows'], columns)
+        index.mmap = buffer
+        return index
+
+    def close(self):
+        # arrays of a loaded index are views into the mapping, query
+        # results hold copies and stay usable
+        self.columns = {}
+        if self.mmap != None:
+            self.mmap.close()
+            self.mmap = None
+
+
+##########################
+# BENCHMARK
+##########################
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import time
+    from vectorized import evaluate_columns
+
+    rows = 5_000_000
+    rng = np.random.default_rng(0)
+    columns = {
+        'active': rng.random(rows) < 0.5,
+        'vip': rng.random(rows) < 0.01,
+        'age': rng.integers(0, 100, rows),
+        'score': rng.random(rows) * 10,
+    }
+
+    start = time.perf_counter()
+    index = BitmapIndex.build(columns)
+    print(f'build: {time.perf_counter() - start:.2f}s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'index.bmi')
+        index.save(path)
+        print(f'file: {os.path.getsize(path) / 1e6:.1f} MB')
+        start = time.perf_counter()
+        index = BitmapIndex.load(path)
+        print(f'load: {(time.perf_counter() - start) * 1000:.2f}ms')
+
+        for text in ['vip and active',
+                     'active and age >= 18 or !active and score > 7.5',
+                     'vip and age == 42 and score < 1.25']:
+            node = Parser(Lexer('<bench>', text).make_tokens()[0]).parse().node
+            start = time.perf_counter()
+            result, error = index.query_node(node)
+            indexed = time.perf_counter() - start
+            start = time.perf_counter()
+            mask, error = evaluate_columns(node, columns)
+            scanned = time.perf_counter() - start
+            assert result.count() == int(mask.sum())
+            print(f'{text}: {result.count()} rows, {result.rechecked} rechecked, '
+                  f'index {indexed * 1000:.1f}ms, scan {scanned * 1000:.1f}ms')
+        index.close()
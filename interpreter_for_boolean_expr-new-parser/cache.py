@@ -0,0 +1,197 @@
+
+##########################
+# RESULT CACHE
+##########################
+
+# Memoizes evaluation results. A result is keyed on the compiled
+# Expression plus the values of only the identifiers it reads, so an
+# expression over 'age' keeps hitting while unrelated facts change.
+#
+# Facts live in a long lived Context (see fact_context) and are changed
+# with Context.set_fact/remove_fact, which bump a version per fact.
+# The key built for an expression and context is remembered by the
+# cache together with the versions it was built from, so as long as
+# none of the facts it reads changed the key is reused without looking
+# at the values. Writing to context.symbol_table directly bypasses the
+# versions and is not safe with a cache.
+#
+# Every evaluation runs in a context of its own with its own Governor
+# and a snapshot of the facts, the caller's context is only read. Results and errors are stored
+# without a context, so the cache does not keep old contexts and their
+# symbol tables alive, and are handed out with the caller's context.
+#
+# Errors caused by the values are cached like results, limit errors
+# depend on the budget and are not.
+
+import threading
+import weakref
+from collections import OrderedDict
+
+from interpreter import *
+
+
+DEFAULT_MAXSIZE = 4096
+
+
+def fact_context(facts=None, display_name='<program>'):
+    context = Context(display_name)
+    context.symbol_table = SymbolTable(global_symbol_table)
+    if facts:
+        context.set_facts(facts)
+    return context
+
+
+def value_key(value):
+    if value == None:
+        return None
+    if isinstance(value, Booleen):
+        return value.value
+    # 1 and 1.0 compare equal but do not render the same
+    return (type(value.value), value.value)
+
+
+def detach(result):
+    # a value or error without the context it was evaluated in, an
+    # RTError is kept as its (pos_start, pos_end, details)
+    if isinstance(result, RTError):
+        return (result.pos_start, result.pos_end, result.details)
+    if result != None:
+        return result.copy().set_context(None)
+    return None
+
+
+class ResultCache:
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, limits=None):
+        self.maxsize = maxsize
+        self.limits = limits
+        self.entries = OrderedDict()
+        # (weakref to context, expr) -> (fact versions, key)
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.interpreter = Interpreter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # keys rebuilt because a fact the expression reads changed
+        self.invalidations = 0
+
+    def key(self, expr, context):
+        versions = context.versions
+        version = tuple(versions.get(name, 0) for name in expr.identifiers)
+        memo_key = (weakref.ref(context), expr)
+        with self.lock:
+            memo = self.keys.get(memo_key)
+            if memo != None and memo[0] == version:
+                self.keys.move_to_end(memo_key)
+                return memo[1]
+            if memo != None:
+                self.invalidations += 1
+
+        get = context.symbol_table.get
+        key = (expr, tuple(value_key(get(name)) for name in expr.identifiers))
+        with self.lock:
+            self.keys[memo_key] = (version, key)
+            self.keys.move_to_end(memo_key)
+            if len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+        return key
+
+    def evaluate(self, expr, context):
+        # returns (value, error) like Expression.evaluate
+        key = self.key(expr, context)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry == None:
+            # facts may change while this runs, so it evaluates a
+            # snapshot of them and is stored under the key of the
+            # snapshot, which is not always the key looked up
+            get = context.symbol_table.get
+            snapshot = SymbolTable()
+            for name in expr.identifiers:
+                value = get(name)
+                if value != None:
+                    snapshot.set(name, value)
+            key = (expr, tuple(value_key(snapshot.get(name))
+                               for name in expr.identifiers))
+
+            # a context of its own, the caller's governor is left alone
+            own = Context(context.display_name)
+            own.symbol_table = snapshot
+            own.governor = Governor(self.limits)
+            result = self.interpreter.visit(expr.node, own)
+            if isinstance(result.error, LimitExceededError):
+                return None, result.error
+
+            entry = (detach(result.value), detach(result.error))
+            with self.lock:
+                self.entries[key] = entry
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        value, error = entry
+        if value != None:
+            value = value.copy().set_context(context)
+        if isinstance(error, tuple):
+            error = RTError(*error, context)
+        return value, error
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hit_rate(),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+
+
+if __name__ == '__main__':
+    import random
+    import time
+    import expression
+
+    expr, error = expression.compile(
+        '(age >= 18 and country == 49) and (premium or age > 65) and !banned')
+    context = fact_context({'age': 30, 'country': 49, 'premium': False,
+                            'banned': False, 'clicks': 0})
+    cache = ResultCache()
+
+    runs = 100000
+    start = time.perf_counter()
+    for i in range(runs):
+        # an unrelated fact changes on every call, age only now and then
+        context.set_fact('clicks', i)
+        if random.random() < 0.01:
+            context.set_fact('age', random.randint(0, 99))
+        cache.evaluate(expr, context)
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(runs):
+        context.set_fact('clicks', i)
+        expr.evaluate({'age': 30, 'country': 49, 'premium': False,
+                       'banned': False, 'clicks': i})
+    uncached = time.perf_counter() - start
+
+    print(f'cached   {runs / cached:.0f} evals/s')
+    print(f'uncached {runs / uncached:.0f} evals/s')
+    print(cache.stats())
@@ -0,0 +1,300 @@
+
+##########################
+# CANONICAL FORM
+##########################
+
+# Brings logically identical rules written differently into one form:
+#   - 'and'/'or' chains are flattened, sorted and deduplicated
+#   - 'true'/'false' operands of 'and'/'or' are folded
+#   - '!!x' becomes 'x'
+#   - 'a > b' becomes 'b < a', 'a >= b' becomes 'b <= a'
+#   - operands of '==' and '!=' are sorted
+#   - integral floats become ints ('1.0' and '1' compare the same)
+# Folding assumes operands of 'and'/'or' are bools, like minimize.py.
+#
+# The canonical form is a nested tuple, its stable hash is a blake2b
+# digest of that tuple's source text.
+
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+
+from interpreter import *
+from render import (chain, is_logical, number_source, PREC_COMPARSION,
+                    PREC_EQUALITY, PREC_LOGICAL, PREC_PRIMARY, PREC_UNARY)
+
+
+DEFAULT_PARTITIONS = 64
+HASH_CACHE_SIZE = 65536
+
+# comparisons are turned around so only '<' and '<=' remain
+FLIPPED = {
+    TT_GT: TT_LT,
+    TT_GTE: TT_LTE,
+}
+
+OP_SOURCE = {
+    TT_EE: '==',
+    TT_NE: '!=',
+    TT_LT: '<',
+    TT_LTE: '<=',
+}
+
+
+##########################
+# FOLD
+##########################
+
+def fold(root, children, combine):
+    # combine(item, its children, their results) bottom up. An explicit
+    # stack instead of recursion, 'and'/'or' chains only flatten runs of
+    # one operator and nest once per change like in 'a or b and c or d'.
+    stack = [(root, None)]
+    results = []
+    while stack:
+        item, items = stack.pop()
+        if items == None:
+            items = children(item)
+            if not items:
+                results.append(combine(item, items, items))
+                continue
+            stack.append((item, items))
+            stack.extend((child, None) for child in reversed(items))
+        else:
+            start = len(results) - len(items)
+            values = results[start:]
+            del results[start:]
+            results.append(combine(item, items, values))
+    return results[0]
+
+
+##########################
+# CANONICALIZE
+##########################
+
+def canonicalize(node):
+    return fold(node, operands_of, canonical_form)
+
+
+def operands_of(node):
+    if is_logical(node):
+        return chain(node)
+    if isinstance(node, BinOpNode):
+        return [node.left_node, node.right_node]
+    if isinstance(node, UnaryOpNode):
+        return [node.node]
+    return []
+
+
+def canonical_form(node, operands, forms):
+    if isinstance(node, BooleanNode):
+        return ('bool', node.tok.value == 'TRUE')
+
+    if isinstance(node, NumberNode):
+        value = node.tok.value
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return ('num', value)
+
+    if isinstance(node, VarAccessNode):
+        return ('var', node.var_name_tok.value)
+
+    if isinstance(node, UnaryOpNode):
+        operand = forms[0]
+        if operand[0] == 'not':
+            return operand[1]
+        if operand[0] == 'bool':
+            return ('bool', not operand[1])
+        return ('not', operand)
+
+    if is_logical(node):
+        return canonical_chain(node, forms)
+
+    op = node.op_tok.type
+    left, right = forms
+    if op in FLIPPED:
+        op = FLIPPED[op]
+        left, right = right, left
+    elif op in (TT_EE, TT_NE) and sort_key(right) < sort_key(left):
+        left, right = right, left
+    return ('cmp', OP_SOURCE[op], left, right)
+
+
+def canonical_chain(node, forms):
+    # forms are the canonical forms of the chain's operands
+    kind = node.op_tok.value.lower()
+    # 'true' is the identity of 'and' and decides an 'or', 'false' the other way
+    identity = kind == 'and'
+
+    operands = {}
+    for operand in forms:
+        if operand[0] == kind:
+            nested = operand[1]
+        else:
+            nested = (operand,)
+        for operand in nested:
+            if operand == ('bool', identity):
+                continue
+            if operand == ('bool', not identity):
+                return operand
+            operands[sort_key(operand)] = operand
+
+    if not operands:
+        return ('bool', identity)
+    if len(operands) == 1:
+        return next(iter(operands.values()))
+    return (kind, tuple(operands[key] for key in sorted(operands)))
+
+
+def sort_key(form):
+    return to_text(form)
+
+
+##########################
+# TEXT AND HASH
+##########################
+
+def precedence(form):
+    if form[0] in ('and', 'or'):
+        return PREC_LOGICAL
+    if form[0] == 'cmp':
+        return PREC_EQUALITY if form[1] in ('==', '!=') else PREC_COMPARSION
+    if form[0] == 'not':
+        return PREC_UNARY
+    return PREC_PRIMARY
+
+
+def wrap(form, text, min_prec):
+    if precedence(form) < min_prec:
+        return f'({text})'
+    return text
+
+
+def to_text(form):
+    if form[0] in ('bool', 'num', 'var'):
+        return form_text(form, (), ())
+    return fold(form, subforms, form_text)
+
+
+def subforms(form):
+    kind = form[0]
+    if kind == 'not':
+        return [form[1]]
+    if kind == 'cmp':
+        return [form[2], form[3]]
+    if kind in ('and', 'or'):
+        return list(form[1])
+    return []
+
+
+def form_text(form, operands, texts):
+    kind = form[0]
+    if kind == 'bool':
+        return 'true' if form[1] else 'false'
+    if kind == 'num':
+        return number_source(form[1])
+    if kind == 'var':
+        return form[1].lower()
+    if kind == 'not':
+        return '!' + wrap(operands[0], texts[0], PREC_UNARY)
+    if kind == 'cmp':
+        prec = precedence(form)
+        return (f'{wrap(operands[0], texts[0], prec)} {form[1]} '
+                f'{wrap(operands[1], texts[1], prec + 1)}')
+    # 'and' and 'or' share one level in the Parser
+    return f' {kind} '.join(wrap(operand, text, PREC_LOGICAL + 1)
+                            for operand, text in zip(operands, texts))
+
+
+def structural_hash(form):
+    # stable across processes, unlike hash()
+    return hashlib.blake2b(to_text(form).encode(), digest_size=16).hexdigest()
+
+
+def parse(text, fn='<expr>'):
+    tokens, error = Lexer(fn, text).make_tokens()
+    if error:
+        return None, error
+    ast = Parser(tokens).parse()
+    return ast.node, ast.error
+
+
+def canonical_node(node):
+    # the canonical form as a new AST
+    return parse(to_text(canonicalize(node)), '<canonical>')[0]
+
+
+@lru_cache(maxsize=HASH_CACHE_SIZE)
+def canonical_hash(text):
+    # returns (hash, error), repeated texts are served from the cache
+    node, error = parse(text)
+    if error:
+        return None, error
+    return structural_hash(canonicalize(node)), None
+
+
+##########################
+# BULK DEDUP
+##########################
+
+def group_by_canonical_hash(items, partitions=DEFAULT_PARTITIONS,
+                            directory=None, on_error=None):
+    # items is an iterable of (id, text) with JSON serializable ids.
+    # Yields (hash, [ids]) for every group of equivalent expressions.
+    # Items that fail are passed to on_error(id, error), error is an
+    # Error or the exception hashing the item raised.
+    # (hash, id) pairs are spilled into partition files by hash, then
+    # one partition at a time is grouped in memory, so memory is bounded
+    # by the largest partition instead of the whole input.
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        paths = [os.path.join(tmp, f'{i}.jsonl') for i in range(partitions)]
+        files = [open(path, 'w') for path in paths]
+        try:
+            for item_id, text in items:
+                try:
+                    digest, error = canonical_hash(text)
+                except Exception as exception:
+                    # one bad item must not abort the whole run
+                    digest, error = None, exception
+                if error:
+                    if on_error:
+                        on_error(item_id, error)
+                    continue
+                partition = int(digest[:8], 16) % partitions
+                files[partition].write(json.dumps([digest, item_id]) + '\n')
+        finally:
+            for file in files:
+                file.close()
+
+        for path in paths:
+            groups = {}
+            with open(path) as file:
+                for line in file:
+                    digest, item_id = json.loads(line)
+                    groups.setdefault(digest, []).append(item_id)
+            for digest, ids in groups.items():
+                yield digest, ids
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    random.seed(0)
+    shapes = ['{a} and {b}', '{b} and {a}', '({a}) and true and {b}',
+              '!!{a} and {b}', '{b} and ({a} and {b})']
+    names = [f'v{i}' for i in range(200)]
+
+    def items(count):
+        for i in range(count):
+            a, b = random.sample(names, 2)
+            text = random.choice(shapes).format(a=f'x > {a}', b=b)
+            yield i, text
+
+    count = 200000
+    start = time.perf_counter()
+    groups = sum(1 for _ in group_by_canonical_hash(items(count)))
+    elapsed = time.perf_counter() - start
+    print(f'{count} expressions -> {groups} groups in {elapsed:.2f}s')
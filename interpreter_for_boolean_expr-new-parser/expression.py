@@ -0,0 +1,62 @@
+
+##########################
+# COMPILED EXPRESSION
+##########################
+
+# compile() parses an expression once into an immutable Expression.
+# evaluate() keeps all state in its own Context and SymbolTable, so one
+# Expression can be shared by many threads without locks.
+
+from interpreter import *
+
+
+# the Interpreter only caches its visit method per node type, filling
+# that cache twice from two threads is harmless, so it can be shared
+_interpreter = Interpreter()
+
+
+class Expression:
+    __slots__ = ('fn', 'text', 'node', 'identifiers')
+
+    def __init__(self, fn, text, node):
+        object.__setattr__(self, 'fn', fn)
+        object.__setattr__(self, 'text', text)
+        object.__setattr__(self, 'node', node)
+        object.__setattr__(self, 'identifiers', collect_identifiers(node))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Expression is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Expression is immutable')
+
+    def evaluate(self, bindings=None, limits=None):
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        context.governor = Governor(limits)
+        if bindings:
+            context.symbol_table.update(bindings)
+
+        result = _interpreter.visit(self.node, context)
+        return result.value, result.error
+
+    def __repr__(self):
+        return f'Expression({self.text!r})'
+
+
+def compile(text, fn='<expr>', limits=None):
+    governor = Governor(limits)
+
+    # Generate tokens
+    lexer = Lexer(fn, text, governor)
+    tokens, error = lexer.make_tokens()
+    if error:
+        return None, error
+
+    # Generate AST
+    parser = Parser(tokens, governor)
+    ast = parser.parse()
+    if ast.error:
+        return None, ast.error
+
+    return Expression(fn, text, ast.node), None
@@ -3,11 +3,10 @@
 # POSSIBLE TOKENS
 ##########################
 
-from urllib.request import HTTPBasicAuthHandler
 from hashmap import HashMap
 from string_with_arrows import *
-from keyword import *
-import string
+import operator
+import time
 
 
 # Token Types
@@ -25,6 +24,7 @@ TT_LT = '<'
 TT_GT = '>'
 TT_LTE = '<='
 TT_GTE = '>='
+TT_NEWLINE = 'NEWLINE'
 TT_EOF = 'EOF'
 
 
@@ -34,9 +34,10 @@ keyword.put('TRUE', TT_KEYWORD)
 keyword.put('FALSE', TT_KEYWORD)
 keyword.put('AND', TT_KEYWORD)
 keyword.put('OR', TT_KEYWORD)
+keyword.put('VAR', TT_KEYWORD)
 
 
-LETTERS = string.ascii_letters
+LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 DIGITS = '0123456789'
 LETTERS_AND_DIGITS = LETTERS + DIGITS
 
@@ -102,6 +103,123 @@ class RTError(Error):
         return 'Traceback (most recent call last):\n' + result
 
 
+class Failure(Exception):
+    # carries an Error up to where a ParseResult or RTResult is returned
+    def __init__(self, error):
+        super().__init__(error.details)
+        self.error = error
+
+
+class LimitExceededError(Error):
+    def __init__(self, pos_start, pos_end, details):
+        super().__init__(pos_start, pos_end, 'Limit Exceeded', details)
+
+
+##########################
+# LIMITS
+##########################
+
+# Budgets for untrusted input, checked while lexing, parsing and
+# evaluating. None switches a single budget off.
+#   max_bytes    size of the source text
+#   max_tokens   tokens produced by the Lexer
+#   max_nodes    AST nodes built by the Parser
+#   max_nesting  parentheses and '!' inside each other, every level
+#                costs the recursive Parser about ten stack frames
+#   max_depth    depth of the AST, the Interpreter recurses once per level.
+#                A chain of one 'and'/'or' like 'a and b and c' is
+#                walked in a loop and counts as one level
+#   max_steps    nodes visited by the Interpreter
+#   timeout      wall-clock seconds for all phases together
+
+class Limits:
+    def __init__(self, max_bytes=1 << 20, max_tokens=200000, max_nodes=200000,
+                 max_nesting=50, max_depth=300, max_steps=1000000, timeout=5.0):
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.max_nodes = max_nodes
+        self.max_nesting = max_nesting
+        self.max_depth = max_depth
+        self.max_steps = max_steps
+        self.timeout = timeout
+
+
+default_limits = Limits()
+
+
+class Governor:
+    # the time is only read every CLOCK_INTERVAL ticks
+    CLOCK_INTERVAL = 256
+
+    def __init__(self, limits=None):
+        self.limits = limits or default_limits
+        self.deadline = None
+        if self.limits.timeout != None:
+            self.deadline = time.perf_counter() + self.limits.timeout
+        self.ticks = 0
+        self.nodes = 0
+        self.steps = 0
+        # check_node/check_step only look closer once the count reaches
+        # its mark, so the common case is one comparison in the caller
+        self.node_mark = 0
+        self.step_mark = 0
+        self.depth_limit = self.limits.max_depth
+        if self.depth_limit == None:
+            self.depth_limit = float('inf')
+
+    def out_of_time(self):
+        self.ticks += 1
+        if self.deadline == None or self.ticks % self.CLOCK_INTERVAL:
+            return False
+        return time.perf_counter() > self.deadline
+
+    def check_text(self, fn, text):
+        max_bytes = self.limits.max_bytes
+        if max_bytes == None or len(text) <= max_bytes and (
+                text.isascii() or len(text.encode('utf-8')) <= max_bytes):
+            return None
+
+        # point at the character where the budget runs out
+        idx = min(max_bytes, len(text) - 1)
+        ln = text.count('\n', 0, idx)
+        col = idx - (text.rfind('\n', 0, idx) + 1)
+        pos_start = Position(idx, ln, col, fn, text)
+        pos_end = pos_start.copy().advance()
+        return LimitExceededError(pos_start, pos_end,
+                                  f'Input is larger than {max_bytes} bytes')
+
+    def next_mark(self, count, limit):
+        mark = count + self.CLOCK_INTERVAL
+        return mark if limit == None else min(mark, limit + 1)
+
+    def check_node(self, node):
+        # called with self.nodes already counted, see Parser.check
+        limits = self.limits
+        self.node_mark = self.next_mark(self.nodes, limits.max_nodes)
+        if limits.max_nodes != None and self.nodes > limits.max_nodes:
+            return LimitExceededError(node.pos_start, node.pos_end,
+                                      f'More than {limits.max_nodes} nodes')
+        if limits.max_depth != None and node.depth > limits.max_depth:
+            return LimitExceededError(node.pos_start, node.pos_end,
+                                      f'Expression deeper than {limits.max_depth}')
+        if self.deadline != None and time.perf_counter() > self.deadline:
+            return LimitExceededError(node.pos_start, node.pos_end,
+                                      'Parsing took too long')
+        return None
+
+    def check_step(self, node):
+        # called with self.steps already counted, see Interpreter.evaluate
+        max_steps = self.limits.max_steps
+        self.step_mark = self.next_mark(self.steps, max_steps)
+        if max_steps != None and self.steps > max_steps:
+            return LimitExceededError(node.pos_start, node.pos_end,
+                                      f'More than {max_steps} evaluation steps')
+        if self.deadline != None and time.perf_counter() > self.deadline:
+            return LimitExceededError(node.pos_start, node.pos_end,
+                                      'Evaluation took too long')
+        return None
+
+
 ##########################
 # POSITION
 ##########################
@@ -144,7 +262,7 @@ class Token:
             self.pos_end.advance()
 
         if pos_end:
-            self.pos_end = pos_end
+            self.pos_end = pos_end.copy()
 
     def matches(self, type_, value):
         return self.type == type_ and self.value == value
@@ -160,9 +278,10 @@ class Token:
 ##########################
 
 class Lexer:
-    def __init__(self, fn, text):
+    def __init__(self, fn, text, governor=None):
         self.fn = fn
         self.text = text
+        self.governor = governor or Governor()
         self.pos = Position(-1, 0, -1, fn, text)
         self.current_char = None
         self.advance()
@@ -174,9 +293,27 @@ class Lexer:
 
     def make_tokens(self):
         tokens = []
+        error = self.governor.check_text(self.fn, self.text)
+        if error:
+            return [], error
+        max_tokens = self.governor.limits.max_tokens
 
         while self.current_char != None:
-            if self.current_char in ' \t':
+            if max_tokens != None and len(tokens) >= max_tokens:
+                return [], LimitExceededError(
+                    self.pos.copy(), self.pos.copy().advance(),
+                    f'More than {max_tokens} tokens')
+            if self.governor.out_of_time():
+                return [], LimitExceededError(
+                    self.pos.copy(), self.pos.copy().advance(),
+                    'Tokenizing took too long')
+
+            if self.current_char in ' \t\r':
+                self.advance()
+            elif self.current_char == '#':
+                self.skip_comment()
+            elif self.current_char in ';\n':
+                tokens.append(Token(TT_NEWLINE, pos_start=self.pos))
                 self.advance()
             elif self.current_char == '(':
                 tokens.append(Token(TT_LK, pos_start=self.pos))
@@ -213,11 +350,15 @@ class Lexer:
         tokens.append(Token(TT_EOF, pos_start=self.pos))
         return tokens, None
 
+    def skip_comment(self):
+        while self.current_char != None and self.current_char != '\n':
+            self.advance()
+
     def make_word(self):
         word = ''
         pos_start = self.pos.copy()
 
-        while self.current_char != None and self.current_char in LETTERS:
+        while self.current_char != None and self.current_char in LETTERS_AND_DIGITS + '_':
             word += self.current_char
             self.advance()
 
@@ -321,6 +462,7 @@ class Lexer:
 class NumberNode:
     def __init__(self, tok):
         self.tok = tok
+        self.depth = 1
 
         self.pos_start = self.tok.pos_start
         self.pos_end = self.tok.pos_end
@@ -332,6 +474,7 @@ class NumberNode:
 class BooleanNode:
     def __init__(self, tok):
         self.tok = tok
+        self.depth = 1
 
         self.pos_start = self.tok.pos_start
         self.pos_end = self.tok.pos_end
@@ -340,11 +483,33 @@ class BooleanNode:
         return f'{self.tok}'
 
 
+class VarAccessNode:
+    def __init__(self, var_name_tok):
+        self.var_name_tok = var_name_tok
+        self.depth = 1
+
+        self.pos_start = self.var_name_tok.pos_start
+        self.pos_end = self.var_name_tok.pos_end
+
+    def __repr__(self):
+        return f'{self.var_name_tok}'
+
+
 class BinOpNode:
     def __init__(self, left_node, op_tok, right_node):
         self.left_node = left_node
         self.op_tok = op_tok
         self.right_node = right_node
+        # key into OPERATORS
+        self.op = op_tok.value if op_tok.type == TT_KEYWORD else op_tok.type
+        # 'a and b and c' nests on the left but is one chain, walked in a
+        # loop (see Interpreter.visit_BinOpNode). A left operand with
+        # another operator, like in 'a and b or c', adds a level.
+        if op_tok.type == TT_KEYWORD and isinstance(left_node, BinOpNode) \
+                and left_node.op == self.op:
+            self.depth = max(left_node.depth, right_node.depth + 1)
+        else:
+            self.depth = max(left_node.depth, right_node.depth) + 1
 
         self.pos_start = self.left_node.pos_start
         self.pos_end = self.right_node.pos_end
@@ -357,6 +522,7 @@ class UnaryOpNode:
     def __init__(self, op_tok, node: BooleanNode):
         self.op_tok = op_tok
         self.node = node
+        self.depth = node.depth + 1
 
         self.pos_start = self.op_tok.pos_start
         self.pos_end = self.node.pos_end
@@ -365,6 +531,61 @@ class UnaryOpNode:
         return f'({self.op_tok}, {self.node})'
 
 
+class VarAssignNode:
+    def __init__(self, var_name_tok, value_node):
+        self.var_name_tok = var_name_tok
+        self.value_node = value_node
+        self.depth = value_node.depth + 1
+
+        self.pos_start = self.var_name_tok.pos_start
+        self.pos_end = self.value_node.pos_end
+
+    def __repr__(self):
+        return f'(VAR {self.var_name_tok} = {self.value_node})'
+
+
+class StatementsNode:
+    def __init__(self, statements, pos_start, pos_end):
+        self.statements = statements
+        self.depth = max([node.depth for node in statements], default=0) + 1
+
+        self.pos_start = pos_start
+        self.pos_end = pos_end
+
+    def __repr__(self):
+        return f'[{", ".join(repr(node) for node in self.statements)}]'
+
+
+def collect_identifiers(node):
+    identifiers = set()
+    nodes = [node]
+
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, VarAccessNode):
+            identifiers.add(node.var_name_tok.value)
+        elif isinstance(node, BinOpNode):
+            nodes.append(node.left_node)
+            nodes.append(node.right_node)
+        elif isinstance(node, UnaryOpNode):
+            nodes.append(node.node)
+        elif isinstance(node, VarAssignNode):
+            nodes.append(node.value_node)
+        elif isinstance(node, StatementsNode):
+            nodes.extend(node.statements)
+
+    return frozenset(identifiers)
+
+
+def left_spine(node):
+    # node and its left operands as long as they are BinOpNodes, outermost first
+    spine = [node]
+    while isinstance(node.left_node, BinOpNode):
+        node = node.left_node
+        spine.append(node)
+    return spine
+
+
 ##########################
 # PARSE RESULT
 ##########################
@@ -374,13 +595,6 @@ class ParseResult:
         self.error = None
         self.node = None
 
-    def register(self, res):
-        if isinstance(res, ParseResult):
-            if res.error:
-                self.error = res.error
-            return res.node
-        return res
-
     def success(self, node):
         self.node = node
         return self
@@ -394,9 +608,14 @@ class ParseResult:
 # PARSER
 ##########################
 
+# Every rule returns its node. Errors are raised as Failure and turned
+# into a ParseResult once, in parse()/parse_statements().
+
 class Parser:
-    def __init__(self, tokens):
+    def __init__(self, tokens, governor=None):
         self.tokens = tokens
+        self.governor = governor or Governor()
+        self.nesting = 0
         self.tok_idx = -1
         self.advance()
 
@@ -407,24 +626,92 @@ class Parser:
         return self.current_tok
 
     def parse(self):
-        res = self.expr()
-        if not res.error and self.current_tok.type != TT_EOF:
-            return res.failure(InvalidSyntaxError(
-                self.current_tok.pos_start, self.current_tok.pos_end,
-                "Expected 'and' or 'or'"
-            ))
-        return res
+        return self.parse_rule(self.expr)
+
+    def parse_statements(self):
+        return self.parse_rule(self.statements)
+
+    def parse_rule(self, rule):
+        res = ParseResult()
+        try:
+            node = rule()
+            if self.current_tok.type != TT_EOF:
+                self.fail(self.current_tok, "Expected 'and' or 'or'")
+        except Failure as failure:
+            return res.failure(failure.error)
+        return res.success(node)
+
+    def fail(self, tok, details):
+        raise Failure(InvalidSyntaxError(tok.pos_start, tok.pos_end, details))
 
     def peek_prev(self):
 
         return self.tokens[self.tok_idx - 1]
 
+    def check(self, node):
+        governor = self.governor
+        governor.nodes += 1
+        if governor.nodes >= governor.node_mark or node.depth > governor.depth_limit:
+            error = governor.check_node(node)
+            if error:
+                raise Failure(error)
+        return node
+
+    def enter_nesting(self, tok):
+        self.nesting += 1
+        max_nesting = self.governor.limits.max_nesting
+        if max_nesting != None and self.nesting > max_nesting:
+            raise Failure(LimitExceededError(tok.pos_start, tok.pos_end,
+                                             f'Nesting deeper than {max_nesting}'))
+
 
 # [( true or false ) and false)]
 # (true or false) and false
 # !!!!!true and false
 # 11231232123 > 2
 
+    def statements(self):
+        statements = []
+        pos_start = self.current_tok.pos_start.copy()
+
+        while self.current_tok.type == TT_NEWLINE:
+            self.advance()
+
+        while True:
+            statements.append(self.statement())
+
+            if self.current_tok.type != TT_NEWLINE:
+                break
+            while self.current_tok.type == TT_NEWLINE:
+                self.advance()
+            if self.current_tok.type == TT_EOF:
+                break
+
+        return StatementsNode(statements, pos_start, self.current_tok.pos_end.copy())
+
+    def statement(self):
+        if not self.current_tok.matches(TT_KEYWORD, 'VAR'):
+            return self.expr()
+
+        self.advance()
+        if self.current_tok.type != TT_IDENTIFIER:
+            self.fail(self.current_tok, "Expected identifier")
+        var_name_tok = self.current_tok
+        self.advance()
+
+        if self.current_tok.type != TT_EQ:
+            self.fail(self.current_tok, "Expected '='")
+        self.advance()
+
+        return self.check(VarAssignNode(var_name_tok, self.expr()))
+
+    # 'and' and 'or' share one level and group left to right
+    def expr(self):
+        return self.bin_op(self.term, (TT_KEYWORD,), ('AND', 'OR'))
+
+    def term(self):
+        return self.bin_op(self.equality, (TT_KEYWORD,), ('AND', 'OR'))
+
     def equality(self):
         return self.bin_op(self.comparsion, (TT_EE, TT_NE))
 
@@ -432,86 +719,65 @@ class Parser:
         return self.bin_op(self.unary, (TT_LT, TT_LTE, TT_GT, TT_GTE))
 
     def unary(self):
-        res = ParseResult()
         tok = self.current_tok
 
         if tok.type == TT_NEG:
-            res.register(self.advance())
-            unary = res.register(self.unary())
-            if res.error:
-                return res
-            return res.success(UnaryOpNode(tok, unary))
-
-        # elif tok.type in (TT_INT, TT_FLOAT, keyword.get('TRUE'), keyword.get('FALSE')):
-
-        primary = res.register(self.primary())
-        if res.error:
-            return res
+            self.enter_nesting(tok)
+            self.advance()
+            node = UnaryOpNode(tok, self.unary())
+            self.nesting -= 1
+            # up to the last token read, a ')' around the operand included
+            node.pos_end = self.peek_prev().pos_end
+            return self.check(node)
 
-        return res.success(primary)
+        return self.primary()
 
     def primary(self):
-        res = ParseResult()
         tok = self.current_tok
 
-        if tok.type == TT_KEYWORD and (tok.value == 'TRUE' or tok.value == 'FALSE'):
-            res.register(self.advance())
-            return res.success(BooleanNode(tok))
+        if tok.type == TT_IDENTIFIER:
+            self.advance()
+            return self.check(VarAccessNode(tok))
 
         elif tok.type in (TT_INT, TT_FLOAT):
             if self.peek_prev().type == '!':
-                return res.failure(InvalidSyntaxError(
-                    self.current_tok.pos_start, self.current_tok.pos_end,
-                    "Expected 'true' or 'false' after '!'"
-                ))
-            res.register(self.advance())
-            return res.success(NumberNode(tok))
-
-        elif tok.type == TT_LK:
-            if self.peek_prev().type == '!':
-                return res.failure(InvalidSyntaxError(
-                    self.current_tok.pos_start, self.current_tok.pos_end,
-                    "Expected 'true' or 'false' after '!'"
-                ))
-            res.register(self.advance())
-            expr = res.register(self.expr())
-            if res.error:
-                return res
-            if self.current_tok.type == TT_RK:
-                res.register(self.advance())
-                return res.success(expr)
-            else:
-                return res.failure(InvalidSyntaxError(
-                    self.current_tok.pos_start, self.current_tok.pos_end,
-                    "Expected ')'"
-                ))
+                self.fail(tok, "Expected 'true' or 'false' after '!'")
+            self.advance()
+            return self.check(NumberNode(tok))
 
-        return res.failure(InvalidSyntaxError(
-            tok.pos_start, tok.pos_end,
-            "Expected 'true', 'false', 'INT' or 'FLOAT'"
-        ))
+        elif tok.type == TT_KEYWORD and (tok.value == 'TRUE' or tok.value == 'FALSE'):
+            self.advance()
+            return self.check(BooleanNode(tok))
 
-    def term(self):
-        return self.bin_op(self.equality, keyword.get('AND'))
+        elif tok.type == TT_LK:
+            self.enter_nesting(tok)
+            self.advance()
+            expr = self.expr()
+            self.nesting -= 1
+            if self.current_tok.type != TT_RK:
+                self.fail(self.current_tok, "Expected ')'")
+            self.advance()
+            return expr
 
-    def expr(self):
-        return self.bin_op(self.term, keyword.get('OR'))
+        self.fail(tok, "Expected 'true', 'false', 'INT', 'FLOAT' or identifier")
 
-    def bin_op(self, func, ops):
-        res = ParseResult()
-        left = res.register(func())
-        if res.error:
-            return res
+    def bin_op(self, func, ops, values=None):
+        # ops are token types, values narrows keywords down to some words
+        pos_start = self.current_tok.pos_start
+        left = func()
 
-        while self.current_tok.type in ops:
-            op_tok = self.current_tok
-            res.register(self.advance())
-            right = res.register(func())
-            if res.error:
-                return res
-            left = BinOpNode(left, op_tok, right)
+        tok = self.current_tok
+        while tok.type in ops and (values == None or tok.value in values):
+            self.advance()
+            left = BinOpNode(left, tok, func())
+            # from the first to the last token read, so parentheses
+            # around the operands are part of the span
+            left.pos_start = pos_start
+            left.pos_end = self.peek_prev().pos_end
+            left = self.check(left)
+            tok = self.current_tok
 
-        return res.success(left)
+        return left
 
 
 ##########################
@@ -524,28 +790,21 @@ class RTResult:
         self.error = None
         self.value = None
 
-    def register(self, res):
-        if res.error:
-            self.error = res.error
-        return res.value
-
     def success(self, value):
         self.value = value
         return self
 
-    def failure(self, error):
-        self.error = error
-        return self
-
 ##########################
 # VALUES
 ##########################
 
 
 class Booleen:
-    def __init__(self, value):
+    def __init__(self, value, pos_start=None, pos_end=None, context=None):
         self.value = value
-        self.set_pos()
+        self.pos_start = pos_start
+        self.pos_end = pos_end
+        self.context = context
 
     def set_pos(self, pos_start=None, pos_end=None):
         self.pos_start = pos_start
@@ -556,26 +815,36 @@ class Booleen:
         self.context = context
         return self
 
+    def copy(self):
+        return Booleen(self.value, self.pos_start, self.pos_end, self.context)
+
     def and_to(self, other):
-        if isinstance(other, Booleen):
-            if self.value == other.value:
-                return Booleen(self.value).set_context(self.context), None
-            return Booleen('FALSE').set_context(self.context), None
+        if not isinstance(other, Booleen):
+            return None, RTError(
+                other.pos_start, other.pos_end,
+                "Logical operation on 'bool' and 'int/float'",
+                self.context
+            )
+        if self.value == other.value:
+            return Booleen(self.value).set_context(self.context), None
+        return Booleen('FALSE').set_context(self.context), None
 
     def or_to(self, other):
-        if isinstance(other, Booleen):
-            if self.value == 'FALSE' and other.value == 'FALSE':
-                return Booleen(self.value).set_context(self.context), None
-            else:
-                return Booleen('TRUE').set_context(self.context), None
+        if not isinstance(other, Booleen):
+            return None, RTError(
+                other.pos_start, other.pos_end,
+                "Logical operation on 'bool' and 'int/float'",
+                self.context
+            )
+        if self.value == 'FALSE' and other.value == 'FALSE':
+            return Booleen(self.value).set_context(self.context), None
+        else:
+            return Booleen('TRUE').set_context(self.context), None
 
     def reverse(self):
         if self.value == 'TRUE':
-            self.value = 'FALSE'
-        elif self.value == 'FALSE':
-            self.value = 'TRUE'
-
-        return Booleen(self.value).set_context(self.context), None
+            return Booleen('FALSE').set_context(self.context), None
+        return Booleen('TRUE').set_context(self.context), None
 
     def not_equal(self, other):
         if self.value != other.value:
@@ -589,15 +858,28 @@ class Booleen:
         else:
             return Booleen('FALSE').set_context(self.context), None
 
+    def illegal_comparsion(self, other):
+        return None, RTError(
+            self.pos_start, self.pos_end,
+            f"Comparsion of 'bool' and '{type_name(other)}'",
+            self.context
+        )
+
+    less_than = illegal_comparsion
+    less_equal_than = illegal_comparsion
+    greater_than = illegal_comparsion
+    greater_equal_than = illegal_comparsion
+
     def __repr__(self):
         return str(self.value)
 
 
 class Number:
-    def __init__(self, value):
+    def __init__(self, value, pos_start=None, pos_end=None, context=None):
         self.value = value
-        self.set_pos()
-        self.set_context()
+        self.pos_start = pos_start
+        self.pos_end = pos_end
+        self.context = context
 
     def set_pos(self, pos_start=None, pos_end=None):
         self.pos_start = pos_start
@@ -608,6 +890,9 @@ class Number:
         self.context = context
         return self
 
+    def copy(self):
+        return Number(self.value, self.pos_start, self.pos_end, self.context)
+
     def not_equal(self, other):
         if self.value != other.value:
             return Booleen('TRUE').set_context(self.context), None
@@ -634,13 +919,110 @@ class Number:
                 return Booleen('FALSE').set_context(self.context), None
 
     def less_equal_than(self, other):
-        pass
+        if not (isinstance(other, Number)):
+            return None, RTError(
+                other.pos_start, other.pos_end,
+                "Comparsion of 'bool' and 'int/float'",
+                self.context
+            )
+        else:
+            if self.value <= other.value:
+                return Booleen('TRUE').set_context(self.context), None
+            else:
+                return Booleen('FALSE').set_context(self.context), None
 
     def greater_than(self, other):
-        pass
+        if not (isinstance(other, Number)):
+            return None, RTError(
+                other.pos_start, other.pos_end,
+                "Comparsion of 'bool' and 'int/float'",
+                self.context
+            )
+        else:
+            if self.value > other.value:
+                return Booleen('TRUE').set_context(self.context), None
+            else:
+                return Booleen('FALSE').set_context(self.context), None
 
     def greater_equal_than(self, other):
-        pass
+        if not (isinstance(other, Number)):
+            return None, RTError(
+                other.pos_start, other.pos_end,
+                "Comparsion of 'bool' and 'int/float'",
+                self.context
+            )
+        else:
+            if self.value >= other.value:
+                return Booleen('TRUE').set_context(self.context), None
+            else:
+                return Booleen('FALSE').set_context(self.context), None
+
+    def illegal_logical_operation(self, other):
+        return None, RTError(
+            self.pos_start, self.pos_end,
+            f"Logical operation on 'int/float' and '{type_name(other)}'",
+            self.context
+        )
+
+    and_to = illegal_logical_operation
+    or_to = illegal_logical_operation
+
+    def reverse(self):
+        return None, RTError(
+            self.pos_start, self.pos_end,
+            "Negation of 'int/float'",
+            self.context
+        )
+
+    def __repr__(self):
+        return str(self.value)
+
+
+def type_name(value):
+    if isinstance(value, Booleen):
+        return 'bool'
+    return 'int/float'
+
+
+def make_value(value):
+    # convert a py bool/int/float into an intern value
+    if isinstance(value, (Booleen, Number)):
+        return value
+    if isinstance(value, bool):
+        return Booleen('TRUE' if value else 'FALSE')
+    if isinstance(value, (int, float)):
+        return Number(value)
+    raise TypeError(f'Cannot bind value of type {type(value).__name__}')
+
+
+##########################
+# SYMBOL TABLE
+##########################
+
+class SymbolTable:
+    def __init__(self, parent=None):
+        self.symbols = {}
+        self.parent = parent
+
+    def get(self, name):
+        value = self.symbols.get(name, None)
+        if value == None and self.parent:
+            return self.parent.get(name)
+        return value
+
+    def set(self, name, value):
+        self.symbols[name] = value
+
+    def remove(self, name):
+        del self.symbols[name]
+
+    def update(self, bindings):
+        # bind py values, identifiers are upper case like in the lexer
+        for name, value in bindings.items():
+            self.set(name.upper(), make_value(value))
+
+
+global_symbol_table = SymbolTable()
 
 
 ##########################
@@ -652,6 +1034,24 @@ class Context:
         self.display_name = display_name
         self.parent = parent
         self.parent_entry_pos = parent_entry_pos
+        self.symbol_table = None
+        self.governor = None
+        # fact name -> number of changes, bumped by set_fact/remove_fact
+        self.versions = {}
+
+    def set_fact(self, name, value):
+        name = name.upper()
+        self.symbol_table.set(name, make_value(value))
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def remove_fact(self, name):
+        name = name.upper()
+        self.symbol_table.remove(name)
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def set_facts(self, facts):
+        for name, value in facts.items():
+            self.set_fact(name, value)
 
 
 ##########################
@@ -660,76 +1060,329 @@ class Context:
 
 
 class Interpreter:
-    def visit(self, node, context):
-        method_name = f'visit_{type(node).__name__}'
-        method = getattr(self, method_name, self.no_visit_method)
+    # visit() is the boundary for callers and returns an RTResult.
+    # Inside, evaluate() returns plain values and errors are raised as
+    # Failure, so the success path allocates no wrappers per node.
+
+    def __init__(self):
+        # node type -> visit method, filled on first use
+        self.dispatch = {}
+
+    def visit(self, node, context=None):
+        if context == None:
+            context = Context('<program>')
+            context.symbol_table = SymbolTable(global_symbol_table)
+        res = RTResult()
+        try:
+            return res.success(self.evaluate(node, context))
+        except Failure as failure:
+            res.error = failure.error
+            return res
+
+    def evaluate(self, node, context):
+        # step() inlined, this runs for every node
+        governor = context.governor
+        if governor:
+            governor.steps += 1
+            if governor.steps >= governor.step_mark:
+                error = governor.check_step(node)
+                if error:
+                    raise Failure(error)
+        try:
+            method = self.dispatch[type(node)]
+        except KeyError:
+            method = self.dispatch[type(node)] = getattr(
+                self, f'visit_{type(node).__name__}', self.no_visit_method)
         return method(node, context)
 
     def no_visit_method(self, node, context):
         raise Exception(f'No visit_{type(node).__name__} method defined')
 
     def visit_BooleanNode(self, node, context):
-        return RTResult().success(
-            Booleen(node.tok.value).set_context(context).set_pos(node.pos_start, node.pos_end))
+        return Booleen(node.tok.value, node.pos_start, node.pos_end, context)
 
     def visit_NumberNode(self, node, context):
-        return RTResult().success(
-            Number(node.tok.value).set_context(context).set_pos(node.pos_start, node.pos_end))
+        return Number(node.tok.value, node.pos_start, node.pos_end, context)
 
-    def visit_BinOpNode(self, node, context):
-        res = RTResult()
-        left = res.register(self.visit(node.left_node, context))
-        if res.error:
-            return res
-        right = res.register(self.visit(node.right_node, context))
-        if res.error:
-            return res
+    def visit_VarAccessNode(self, node, context):
+        var_name = node.var_name_tok.value
+        value = context.symbol_table.get(var_name) if context.symbol_table else None
+
+        if value == None:
+            raise Failure(RTError(
+                node.pos_start, node.pos_end,
+                f"'{var_name}' is not defined",
+                context
+            ))
 
-        if node.op_tok.matches(TT_KEYWORD, 'AND'):
-            result, error = left.and_to(right)
-        elif node.op_tok.matches(TT_KEYWORD, 'OR'):
-            result, error = left.or_to(right)
-        elif node.op_tok.type == TT_LT:
-            result, error = left.less_than(right)
+        return type(value)(value.value, node.pos_start, node.pos_end, context)
 
-        if error:
-            return res.failure(error)
+    def visit_BinOpNode(self, node, context):
+        # 'a and b and c' is '(a and b) and c'. The left spine is walked
+        # in a loop so long chains do not recurse, the steps are counted
+        # in the same order as if it did.
+        if isinstance(node.left_node, BinOpNode):
+            spine = left_spine(node)
+            for inner in spine[1:]:
+                self.step(inner, context)
+            left = self.evaluate(spine[-1].left_node, context)
+            for inner in reversed(spine[1:]):
+                right = self.evaluate(inner.right_node, context)
+                left = Booleen('TRUE' if OPERATORS[inner.op](left, right) else 'FALSE',
+                               inner.pos_start, inner.pos_end, context)
         else:
-            return res.success(result.set_pos(node.pos_start, node.pos_end))
+            left = self.evaluate(node.left_node, context)
+        right = self.evaluate(node.right_node, context)
+        return Booleen('TRUE' if OPERATORS[node.op](left, right) else 'FALSE',
+                       node.pos_start, node.pos_end, context)
+
+    def step(self, node, context):
+        # what evaluate() does before visiting a node
+        governor = context.governor
+        if governor:
+            governor.steps += 1
+            if governor.steps >= governor.step_mark:
+                error = governor.check_step(node)
+                if error:
+                    raise Failure(error)
 
     def visit_UnaryOpNode(self, node, context):
-        boolean = self.visit(node.node, context)
-        if node.op_tok.type == TT_NEG:
-            boolean, error = boolean.reverse()
-        return boolean.set_pos(node.pos_start, node.pos_end)
+        # '!' is the only unary operator
+        value = self.evaluate(node.node, context)
+        if not isinstance(value, Booleen):
+            unwrap(value.reverse())
+        return Booleen('FALSE' if value.value == 'TRUE' else 'TRUE',
+                       node.pos_start, node.pos_end, context)
+
+    def visit_VarAssignNode(self, node, context):
+        var_name = node.var_name_tok.value
+
+        # a context of its own, so errors trace back to the definition
+        child = Context(var_name, context, node.pos_start)
+        child.symbol_table = context.symbol_table
+        child.governor = context.governor
+        value = self.evaluate(node.value_node, child)
+
+        context.symbol_table.set(var_name, value)
+        return value
+
+
+##########################
+# OPERATORS
+##########################
+
+# BinOpNode.op -> function(left, right) returning a py bool. The common
+# cases are computed right here, everything else goes through the value
+# methods so the error messages stay the same.
+
+def unwrap(result):
+    value, error = result
+    if error:
+        raise Failure(error)
+    return value
+
+
+def logical(test, method):
+    def apply(left, right):
+        if isinstance(left, Booleen) and isinstance(right, Booleen):
+            return test(left.value == 'TRUE', right.value == 'TRUE')
+        return unwrap(getattr(left, method)(right)).value == 'TRUE'
+    return apply
+
+
+def ordering(test, method):
+    def apply(left, right):
+        if isinstance(left, Number) and isinstance(right, Number):
+            return test(left.value, right.value)
+        return unwrap(getattr(left, method)(right)).value == 'TRUE'
+    return apply
+
+
+def equality(test):
+    # Booleen and Number compare their values the same way
+    def apply(left, right):
+        return test(left.value, right.value)
+    return apply
+
+
+OPERATORS = {
+    'AND': logical(operator.and_, 'and_to'),
+    'OR': logical(operator.or_, 'or_to'),
+    TT_EE: equality(operator.eq),
+    TT_NE: equality(operator.ne),
+    TT_LT: ordering(operator.lt, 'less_than'),
+    TT_LTE: ordering(operator.le, 'less_equal_than'),
+    TT_GT: ordering(operator.gt, 'greater_than'),
+    TT_GTE: ordering(operator.ge, 'greater_equal_than'),
+}
+
+
+##########################
+# SCRIPT
+##########################
+
+class CircularDefinitionError(Error):
+    def __init__(self, pos_start, pos_end, details):
+        super().__init__(pos_start, pos_end, 'Circular Definition', details)
+
+
+class Script:
+    # a compiled statement sequence, definitions can come in any order
+    def __init__(self, fn, text, node, order):
+        self.fn = fn
+        self.text = text
+        self.node = node
+        # the VarAssignNodes, each after the ones it reads
+        self.order = order
+
+    def evaluate(self, bindings=None, limits=None):
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        context.governor = Governor(limits)
+        if bindings:
+            context.symbol_table.update(bindings)
+        return self.execute(context)
+
+    def execute(self, context):
+        # returns ([value of every statement], error), each definition
+        # is evaluated once and then read from the symbol table
+        interpreter = Interpreter()
+        for node in self.order:
+            result = interpreter.visit(node, context)
+            if result.error:
+                return None, result.error
+
+        values = []
+        for node in self.node.statements:
+            if isinstance(node, VarAssignNode):
+                values.append(context.symbol_table.get(node.var_name_tok.value))
+                continue
+            result = interpreter.visit(node, context)
+            if result.error:
+                return None, result.error
+            values.append(result.value)
+        return values, None
+
+
+def order_definitions(statements):
+    # (definitions in dependency order, error)
+    definitions = {}
+    for node in statements:
+        if not isinstance(node, VarAssignNode):
+            continue
+        var_name = node.var_name_tok.value
+        if var_name in definitions:
+            return None, InvalidSyntaxError(
+                node.var_name_tok.pos_start, node.var_name_tok.pos_end,
+                f"'{var_name}' is already defined"
+            )
+        definitions[var_name] = node
+
+    order = []
+    # 1 while a definition is being ordered, 2 once it is done
+    state = {}
+    # the definitions being ordered, each reads the next
+    path = []
+    for var_name in definitions:
+        # depth first without recursion, long chains of definitions
+        # must not run into the recursion limit
+        pending = [(var_name, None)]
+        while pending:
+            var_name, reads = pending.pop()
+            node = definitions[var_name]
+            if reads == None:
+                if state.get(var_name) == 2:
+                    continue
+                state[var_name] = 1
+                path.append(var_name)
+                reads = sorted(collect_identifiers(node) & definitions.keys())
+            while reads and state.get(reads[-1]) == 2:
+                reads.pop()
+            if not reads:
+                state[var_name] = 2
+                path.pop()
+                order.append(node)
+                continue
+            read = reads.pop()
+            if state.get(read) == 1:
+                cycle = path[path.index(read):] + [read]
+                return None, CircularDefinitionError(
+                    node.pos_start, node.pos_end,
+                    f"'{read}' depends on itself ({' -> '.join(cycle)})"
+                )
+            pending.append((var_name, reads))
+            pending.append((read, None))
+
+    return order, None
+
+
+def compile_script(fn, text, limits=None):
+    governor = Governor(limits)
+
+    # Generate tokens
+    lexer = Lexer(fn, text, governor)
+    tokens, error = lexer.make_tokens()
+    if error:
+        return None, error
+
+    # Generate AST
+    parser = Parser(tokens, governor)
+    ast = parser.parse_statements()
+    if ast.error:
+        return None, ast.error
+
+    order, error = order_definitions(ast.node.statements)
+    if error:
+        return None, error
+    return Script(fn, text, ast.node, order), None
 
 ##########################
 # RUN
 ##########################
 
 
-def run(fn, text):
+def run_file(path, bindings=None, limits=None):
+    # returns ([value of every statement], error)
+    with open(path) as file:
+        text = file.read()
+
+    script, error = compile_script(path, text, limits)
+    if error:
+        return None, error
+    return script.evaluate(bindings, limits)
+
+
+def run(fn, text, bindings=None, limits=None):
+    # one budget for all phases
+    governor = Governor(limits)
+
     # Generate tokens
-    lexer = Lexer(fn, text)
+    lexer = Lexer(fn, text, governor)
     tokens, error = lexer.make_tokens()
-    print("tokenliste: " + str(tokens))
     if error:
         return None, error
 
     # Generate AST
-    parser = Parser(tokens)
-    ast = parser.parse()
+    parser = Parser(tokens, governor)
+    ast = parser.parse_statements()
     if ast.error:
         return None, ast.error
+    order, error = order_definitions(ast.node.statements)
+    if error:
+        return None, error
 
-    # Run program
-    interpreter = Interpreter()
+    # Run program, the value of the last statement is the result
     context = Context('<program>')
-    result = interpreter.visit(ast.node, context)
-
-    return result.value, result.error
+    context.symbol_table = SymbolTable(global_symbol_table)
+    context.governor = governor
+    if bindings:
+        context.symbol_table.update(bindings)
+    values, error = Script(fn, text, ast.node, order).execute(context)
+    if error:
+        return None, error
+    return values[-1], None
 
-# def run(fn, text):
+# def run(fn, text, bindings=None):
 #     # Generate tokens
 #     lexer = Lexer(fn, text)
 #     tokens, error = lexer.make_tokens()
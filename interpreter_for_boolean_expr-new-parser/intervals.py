@@ -0,0 +1,346 @@
+
+##########################
+# INTERVALS
+##########################
+
+# Abstract interpretation of comparisons between an identifier and a
+# number literal. Every such comparison allows a set of values for its
+# identifier, a Domain. Walking an 'and' chain, each operand is looked
+# at under the domains the other operands demand, for 'or' under the
+# complements of the others (an operand only matters when all the others
+# are false). A comparison that always holds or never holds there is
+# replaced by a constant, and the constants are folded:
+#   'x < 5 and x > 10'  -> 'false'
+#   'x < 5 and x < 7'   -> 'x < 5'
+#   'x < 5 or x < 7'    -> 'x < 7'
+#
+# Facts can be ints or floats, so domains are sets of reals with open
+# and closed bounds ('x > 1 and x < 2' stays, 1.5 fits), compared the
+# way Number compares (1 == 1.0). NaN fails every comparison but '!=',
+# so whether NaN is allowed is tracked too and 'x < 5 or x >= 5' is not
+# a tautology. Like minimize.py, identifiers compared against numbers
+# are assumed to be numbers and operands of 'and'/'or' bools.
+
+from interpreter import *
+from minimize import parse_source
+from render import chain, is_logical, to_source
+from specialize import constant_node
+
+
+INF = float('inf')
+
+# 'x < 5' is '5 > x'
+FLIPPED = {
+    TT_LT: TT_GT,
+    TT_LTE: TT_GTE,
+    TT_GT: TT_LT,
+    TT_GTE: TT_LTE,
+    TT_EE: TT_EE,
+    TT_NE: TT_NE,
+}
+
+
+##########################
+# DOMAIN
+##########################
+
+# An interval is (lo, lo_closed, hi, hi_closed), a Domain is a sorted
+# tuple of disjoint intervals plus whether NaN is in it.
+
+def empty_interval(interval):
+    lo, lo_closed, hi, hi_closed = interval
+    return lo > hi or lo == hi and not (lo_closed and hi_closed)
+
+
+def intersect_intervals(a, b):
+    if a[0] > b[0] or a[0] == b[0] and not a[1]:
+        lo, lo_closed = a[0], a[1]
+    else:
+        lo, lo_closed = b[0], b[1]
+    if a[2] < b[2] or a[2] == b[2] and not a[3]:
+        hi, hi_closed = a[2], a[3]
+    else:
+        hi, hi_closed = b[2], b[3]
+    return (lo, lo_closed, hi, hi_closed)
+
+
+class Domain:
+    def __init__(self, intervals, nan=False):
+        self.intervals = tuple(interval for interval in intervals
+                               if not empty_interval(interval))
+        self.nan = nan
+
+    @staticmethod
+    def of_comparison(op, value):
+        if op == TT_LT:
+            return Domain([(-INF, True, value, False)])
+        if op == TT_LTE:
+            return Domain([(-INF, True, value, True)])
+        if op == TT_GT:
+            return Domain([(value, False, INF, True)])
+        if op == TT_GTE:
+            return Domain([(value, True, INF, True)])
+        if op == TT_EE:
+            return Domain([(value, True, value, True)])
+        return Domain([(-INF, True, value, False), (value, False, INF, True)],
+                      nan=True)
+
+    def is_empty(self):
+        return not self.intervals and not self.nan
+
+    def intersect(self, other):
+        intervals = [intersect_intervals(a, b)
+                     for a in self.intervals for b in other.intervals]
+        intervals.sort(key=lambda interval: (interval[0], not interval[1]))
+        return Domain(intervals, self.nan and other.nan)
+
+    def complement(self):
+        intervals = []
+        lo, lo_closed = -INF, True
+        for start, start_closed, end, end_closed in self.intervals:
+            intervals.append((lo, lo_closed, start, not start_closed))
+            lo, lo_closed = end, not end_closed
+        intervals.append((lo, lo_closed, INF, True))
+        return Domain(intervals, not self.nan)
+
+    def issubset(self, other):
+        return self.intersect(other.complement()).is_empty()
+
+    def __repr__(self):
+        parts = [f"{'[' if lo_closed else '('}{lo}, {hi}{']' if hi_closed else ')'}"
+                 for lo, lo_closed, hi, hi_closed in self.intervals]
+        if self.nan:
+            parts.append('nan')
+        return ' | '.join(parts) or 'empty'
+
+
+FULL = Domain([(-INF, True, INF, True)], nan=True)
+
+
+def comparison_domain(node):
+    # (identifier, Domain) for 'x < 5', '5 > x' and '!(x < 5)', else None
+    if isinstance(node, UnaryOpNode):
+        found = comparison_domain(node.node)
+        if found == None or node.op_tok.type != TT_NEG:
+            return found
+        return found[0], found[1].complement()
+
+    if not isinstance(node, BinOpNode) or node.op_tok.type not in FLIPPED:
+        return None
+    op = node.op_tok.type
+    left, right = node.left_node, node.right_node
+    if isinstance(left, NumberNode) and isinstance(right, VarAccessNode):
+        op, left, right = FLIPPED[op], right, left
+    if isinstance(left, VarAccessNode) and isinstance(right, NumberNode):
+        return left.var_name_tok.value, Domain.of_comparison(op, right.tok.value)
+    return None
+
+
+##########################
+# PRUNE
+##########################
+
+class Removal:
+    def __init__(self, node, value, reason):
+        self.node = node
+        # the constant it was decided to, None if it went with its chain
+        self.value = value
+        # 'implied', 'contradiction', 'subsumed', 'tautology',
+        # 'constant' or 'folded'
+        self.reason = reason
+
+    def source(self):
+        return self.node.pos_start.ftxt[self.node.pos_start.idx:self.node.pos_end.idx]
+
+    def __repr__(self):
+        return f'{self.source()} ({self.reason})'
+
+
+class PruneResult:
+    def __init__(self, node, removed):
+        self.node = node
+        self.removed = removed
+
+    def is_constant(self):
+        return isinstance(self.node, BooleanNode)
+
+    def to_source(self):
+        return to_source(self.node)
+
+    def __repr__(self):
+        return f'{self.to_source()} (removed {len(self.removed)} comparisons)'
+
+
+def is_comparison(node):
+    return isinstance(node, BinOpNode) and node.op_tok.type in FLIPPED
+
+
+def constant(node, value):
+    return constant_node(Booleen('TRUE' if value else 'FALSE'),
+                         node.pos_start, node.pos_end)
+
+
+def constant_value(node):
+    if isinstance(node, BooleanNode):
+        return node.tok.value == 'TRUE'
+    return None
+
+
+class Pruner:
+    def __init__(self):
+        # id of a comparison -> Removal, for the ones decided directly
+        self.decided = {}
+
+    def visit(self, node, env):
+        # node simplified under env (identifier -> Domain)
+        if is_logical(node):
+            return self.visit_chain(node, env)
+
+        if isinstance(node, UnaryOpNode):
+            operand = self.visit(node.node, env)
+            value = constant_value(operand)
+            if value != None and node.op_tok.type == TT_NEG:
+                return constant(node, not value)
+            if operand is node.node:
+                return node
+            return UnaryOpNode(node.op_tok, operand)
+
+        if is_comparison(node):
+            return self.visit_comparison(node, env)
+        return node
+
+    def visit_comparison(self, node, env):
+        left, right = node.left_node, node.right_node
+        if isinstance(left, NumberNode) and isinstance(right, NumberNode):
+            value = self.compare_literals(node)
+            self.decided[id(node)] = Removal(node, value, 'constant')
+            return constant(node, value)
+
+        found = comparison_domain(node)
+        if found == None:
+            return node
+        name, domain = found
+        known = env.get(name, FULL)
+        if known.intersect(domain).is_empty():
+            return constant(node, False)
+        if known.issubset(domain):
+            return constant(node, True)
+        return node
+
+    def compare_literals(self, node):
+        left, right = node.left_node.tok.value, node.right_node.tok.value
+        op = node.op_tok.type
+        if op == TT_EE:
+            return left == right
+        if op == TT_NE:
+            return left != right
+        if op == TT_LT:
+            return left < right
+        if op == TT_LTE:
+            return left <= right
+        if op == TT_GT:
+            return left > right
+        return left >= right
+
+    def visit_chain(self, node, env):
+        is_and = node.op_tok.matches(TT_KEYWORD, 'AND')
+        original = chain(node)
+        # earlier operands are replaced by their simplified form (None
+        # once dropped) before the later ones look at them
+        operands = list(original)
+
+        for i, operand in enumerate(operands):
+            # what the other operands say while this one matters
+            inner = dict(env)
+            for j, other in enumerate(operands):
+                found = comparison_domain(other) if j != i else None
+                if found == None:
+                    continue
+                name, domain = found
+                if not is_and:
+                    domain = domain.complement()
+                inner[name] = inner.get(name, FULL).intersect(domain)
+
+            result = self.visit(operand, inner)
+            value = constant_value(result)
+            if value != None and comparison_domain(operand) != None:
+                if is_and:
+                    reason = 'implied' if value else 'contradiction'
+                else:
+                    reason = 'tautology' if value else 'subsumed'
+                self.decided[id(strip_negation(operand))] = Removal(
+                    strip_negation(operand), value, reason)
+
+            if value == is_and:
+                # the identity, drop it
+                operands[i] = None
+                continue
+            if value != None:
+                # decides the whole chain
+                return constant(node, value)
+            operands[i] = result
+
+        if all(a is b for a, b in zip(operands, original)):
+            return node
+        kept = [operand for operand in operands if operand != None]
+        if not kept:
+            return constant(node, is_and)
+        result = kept[0]
+        for operand in kept[1:]:
+            result = BinOpNode(result, node.op_tok, operand)
+        return result
+
+
+def strip_negation(node):
+    while isinstance(node, UnaryOpNode):
+        node = node.node
+    return node
+
+
+def comparisons(node):
+    found = []
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if is_comparison(node):
+            found.append(node)
+        elif isinstance(node, BinOpNode):
+            nodes.append(node.left_node)
+            nodes.append(node.right_node)
+        elif isinstance(node, UnaryOpNode):
+            nodes.append(node.node)
+    return found
+
+
+def prune(node):
+    pruner = Pruner()
+    result = pruner.visit(node, {})
+
+    kept = set(id(comparison) for comparison in comparisons(result))
+    removed = []
+    for comparison in comparisons(node):
+        if id(comparison) in kept:
+            continue
+        removed.append(pruner.decided.get(
+            id(comparison), Removal(comparison, None, 'folded')))
+    removed.sort(key=lambda removal: removal.node.pos_start.idx)
+    return PruneResult(result, removed)
+
+
+def prune_text(text, fn='<expr>'):
+    node, error = parse_source(text, fn)
+    if error:
+        return None, error
+    return prune(node), None
+
+
+if __name__ == '__main__':
+    for text in ['x < 5 and x > 10',
+                 'x < 5 and x < 7 and y',
+                 'x < 5 or x < 7',
+                 'x < 5 or x >= 5',
+                 'x > 1 and x < 2',
+                 'x >= 3 and (x < 2 or y > 1) and !(x < 1)',
+                 'x == 1 and x != 1.0']:
+        result, error = prune_text(text)
+        print(f'{text}\n  -> {result.to_source()}  {result.removed}')
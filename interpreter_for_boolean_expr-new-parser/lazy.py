@@ -0,0 +1,392 @@
+
+##########################
+# LAZY FACTS
+##########################
+
+# Evaluates an Expression while fetching its facts on demand from async
+# providers, instead of fetching every fact the rule could read before
+# calling run(). A provider is registered per identifier and called
+# with the subject of the evaluation (a user id, an order id, ...).
+#
+#   - 'and'/'or' short-circuit: once the left operand decides, the
+#     facts only the right operand reads are never fetched. Unlike
+#     run(), errors inside a skipped operand are not reported.
+#   - both sides of a comparison are evaluated concurrently, so the
+#     facts an operand is certain to read are fetched together.
+#     This costs no extra fetches, but a fact behind an 'and'/'or' is
+#     only fetched once its left operand is known, so a rule like
+#     'a > 1 and b > 1 and c > 1' waits for its lookups one after
+#     another.
+#   - with speculate=True the right operand of 'and'/'or' starts
+#     together with the left one too and is cancelled if it turns out
+#     not to matter. That is about as fast as fetching every fact
+#     upfront, and costs about as many fetches.
+#   - with speculate='adaptive' it only starts early if its left operand
+#     rarely decided in the evaluations so far. Rules whose operands
+#     are usually needed get most of the speed of speculate=True, and
+#     operands that are usually skipped are still mostly not fetched.
+#     How well this works depends on how stable the outcomes are, the
+#     first ADAPTIVE_WARMUP evaluations are plain lazy.
+#   - every fact is fetched at most once per evaluation, however often
+#     and from however many concurrent operands it is read.
+#   - every fetch has a timeout, a slow or failing provider becomes an
+#     RTError at the identifier like an undefined one.
+#   - a FactCache can be shared by evaluators and evaluations, keyed on
+#     (identifier, subject) and expiring after `ttl` seconds.
+#
+# Bindings passed to evaluate() are used before any provider.
+
+import asyncio
+import time
+import weakref
+from collections import OrderedDict
+
+from interpreter import *
+
+
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_TTL = 60.0
+DEFAULT_MAXSIZE = 65536
+
+# the outcome of the left operand that decides 'and'/'or' right away
+DECISIVE = {'AND': 'FALSE', 'OR': 'TRUE'}
+
+# speculate='adaptive' starts the right operand of 'and'/'or' early once
+# its left operand was seen ADAPTIVE_WARMUP times and decided in at
+# most ADAPTIVE_SHARE of them
+ADAPTIVE_WARMUP = 10
+ADAPTIVE_SHARE = 0.25
+
+
+##########################
+# FACT CACHE
+##########################
+
+class FactCache:
+    def __init__(self, ttl=DEFAULT_TTL, maxsize=DEFAULT_MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # (identifier, subject) -> (expires, value)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry != None and (self.ttl == None or entry[0] > time.monotonic()):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry != None:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        expires = None if self.ttl == None else time.monotonic() + self.ttl
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+##########################
+# EVALUATION
+##########################
+
+class Evaluation:
+    # the state of one evaluate() call
+    def __init__(self, evaluator, context, subject):
+        self.evaluator = evaluator
+        self.context = context
+        self.subject = subject
+        # identifier -> task fetching it, shared by all readers
+        self.fetches = {}
+
+    def step(self, node):
+        governor = self.context.governor
+        governor.steps += 1
+        if governor.steps >= governor.step_mark:
+            error = governor.check_step(node)
+            if error:
+                raise Failure(error)
+
+    async def evaluate(self, node):
+        self.step(node)
+        return await self.dispatch.get(type(node), Evaluation.no_visit_method)(self, node)
+
+    async def no_visit_method(self, node):
+        raise Exception(f'No visit_{type(node).__name__} method defined')
+
+    async def visit_BooleanNode(self, node):
+        return Booleen(node.tok.value, node.pos_start, node.pos_end, self.context)
+
+    async def visit_NumberNode(self, node):
+        return Number(node.tok.value, node.pos_start, node.pos_end, self.context)
+
+    async def visit_VarAccessNode(self, node):
+        value = self.context.symbol_table.get(node.var_name_tok.value)
+        if value == None:
+            value = await self.fact(node)
+        return type(value)(value.value, node.pos_start, node.pos_end, self.context)
+
+    async def visit_UnaryOpNode(self, node):
+        # '!' is the only unary operator
+        value = await self.evaluate(node.node)
+        if not isinstance(value, Booleen):
+            unwrap(value.reverse())
+        return Booleen('FALSE' if value.value == 'TRUE' else 'TRUE',
+                       node.pos_start, node.pos_end, self.context)
+
+    async def visit_BinOpNode(self, node):
+        # long chains nest on the left, the left spine is walked in a
+        # loop. The right operands of comparisons on it are always
+        # needed and start right away, those of 'and'/'or' when the
+        # evaluator speculates on them.
+        spine = left_spine(node)
+        for inner in spine[1:]:
+            self.step(inner)
+        started = [asyncio.ensure_future(self.evaluate(node.right_node))
+                   if DECISIVE.get(node.op) == None or self.evaluator.speculates(node)
+                   else None for node in spine]
+        try:
+            value = await self.evaluate(spine[-1].left_node)
+            for i in reversed(range(len(spine))):
+                node = spine[i]
+                decisive = DECISIVE.get(node.op)
+                if decisive != None:
+                    decided = isinstance(value, Booleen) and value.value == decisive
+                    self.evaluator.record(node, decided)
+                    if decided:
+                        self.evaluator.skipped += 1
+                        value = Booleen(decisive, node.pos_start, node.pos_end, self.context)
+                        continue
+                if started[i] != None:
+                    right = await started[i]
+                else:
+                    right = await self.evaluate(node.right_node)
+                value = Booleen('TRUE' if OPERATORS[node.op](value, right) else 'FALSE',
+                                node.pos_start, node.pos_end, self.context)
+            return value
+        finally:
+            for task in started:
+                discard(task)
+
+    ##########################
+    # FACTS
+    ##########################
+
+    async def fact(self, node):
+        name = node.var_name_tok.value
+        evaluator = self.evaluator
+        if name not in evaluator.providers:
+            raise Failure(RTError(node.pos_start, node.pos_end,
+                                  f"'{name}' is not defined", self.context))
+
+        task = self.fetches.get(name)
+        if task == None:
+            task = self.fetches[name] = asyncio.ensure_future(self.fetch(name))
+        else:
+            evaluator.deduplicated += 1
+
+        try:
+            # shielded, a cancelled reader must not cancel the others
+            value = await asyncio.shield(task)
+        except asyncio.TimeoutError:
+            raise Failure(RTError(node.pos_start, node.pos_end,
+                                  f"Fetching '{name}' timed out", self.context))
+        except Exception as error:
+            raise Failure(RTError(node.pos_start, node.pos_end,
+                                  f"Fetching '{name}' failed: {error}", self.context))
+
+        self.context.symbol_table.set(name, value)
+        return value
+
+    async def fetch(self, name):
+        evaluator = self.evaluator
+        key = (name, self.subject)
+        if evaluator.cache != None:
+            value = evaluator.cache.get(key)
+            if value != None:
+                return value
+
+        evaluator.fetches += 1
+        try:
+            fetching = evaluator.providers[name](self.subject)
+            if evaluator.timeout != None:
+                fetching = asyncio.wait_for(fetching, evaluator.timeout)
+            value = make_value(await fetching)
+        except asyncio.TimeoutError:
+            evaluator.timeouts += 1
+            raise
+        except Exception:
+            evaluator.failures += 1
+            raise
+
+        if evaluator.cache != None:
+            evaluator.cache.put(key, value)
+        return value
+
+    def cancel_pending(self):
+        # fetches only skipped or cancelled operands were waiting for
+        for task in self.fetches.values():
+            if not task.done():
+                task.cancel()
+                self.evaluator.cancelled += 1
+            discard(task)
+
+
+# node type -> visit method
+Evaluation.dispatch = {
+    BooleanNode: Evaluation.visit_BooleanNode,
+    NumberNode: Evaluation.visit_NumberNode,
+    VarAccessNode: Evaluation.visit_VarAccessNode,
+    UnaryOpNode: Evaluation.visit_UnaryOpNode,
+    BinOpNode: Evaluation.visit_BinOpNode,
+}
+
+
+def discard(task):
+    # cancels a task nobody awaits anymore and marks its exception as
+    # retrieved, so asyncio does not log it
+    if not isinstance(task, asyncio.Future):
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
+##########################
+# LAZY EVALUATOR
+##########################
+
+class LazyEvaluator:
+    def __init__(self, providers=None, cache=None, timeout=DEFAULT_TIMEOUT,
+                 speculate=False, limits=None):
+        # identifier -> async callable(subject) returning a py bool/number
+        self.providers = {}
+        for name, provider in (providers or {}).items():
+            self.register(name, provider)
+        self.cache = cache
+        self.timeout = timeout
+        # False, True or 'adaptive'
+        self.speculate = speculate
+        self.limits = limits
+        # 'and'/'or' node -> (times its left operand was evaluated, times
+        # it decided), for speculate='adaptive'
+        self.outcomes = weakref.WeakKeyDictionary()
+        self.evaluations = 0
+        self.fetches = 0
+        # reads served by a fetch already started in the same evaluation
+        self.deduplicated = 0
+        # 'and'/'or' decided by their left operand
+        self.skipped = 0
+        self.cancelled = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def register(self, name, provider):
+        # identifiers are upper case like in the lexer
+        self.providers[name.upper()] = provider
+
+    def speculates(self, node):
+        if self.speculate != 'adaptive':
+            return self.speculate
+        seen, decided = self.outcomes.get(node, (0, 0))
+        return seen >= ADAPTIVE_WARMUP and decided <= ADAPTIVE_SHARE * seen
+
+    def record(self, node, decided):
+        if self.speculate == 'adaptive':
+            seen, count = self.outcomes.get(node, (0, 0))
+            self.outcomes[node] = (seen + 1, count + decided)
+
+    async def evaluate(self, expr, subject=None, bindings=None):
+        # returns (value, error) like Expression.evaluate
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        context.governor = Governor(self.limits)
+        if bindings:
+            context.symbol_table.update(bindings)
+
+        self.evaluations += 1
+        evaluation = Evaluation(self, context, subject)
+        try:
+            return await evaluation.evaluate(expr.node), None
+        except Failure as failure:
+            return None, failure.error
+        finally:
+            evaluation.cancel_pending()
+
+    def stats(self):
+        return {
+            'evaluations': self.evaluations,
+            'fetches': self.fetches,
+            'deduplicated': self.deduplicated,
+            'skipped': self.skipped,
+            'cancelled': self.cancelled,
+            'timeouts': self.timeouts,
+            'failures': self.failures,
+            'cache_hits': self.cache.hits if self.cache != None else 0,
+        }
+
+
+if __name__ == '__main__':
+    import random
+    import expression
+
+    # made up facts of a user, every lookup takes 2 to 8 ms
+    def provider(name, make):
+        async def fetch(subject):
+            await asyncio.sleep(random.uniform(0.002, 0.008))
+            return make(random.Random(f'{name}{subject}'))
+        return fetch
+
+    providers = {
+        'blocked': provider('blocked', lambda rng: rng.random() < 0.1),
+        'vip': provider('vip', lambda rng: rng.random() < 0.05),
+        'age': provider('age', lambda rng: rng.randint(10, 80)),
+        'country': provider('country', lambda rng: rng.choice([1, 33, 44, 49])),
+        'premium': provider('premium', lambda rng: rng.random() < 0.3),
+        'purchases': provider('purchases', lambda rng: rng.randint(0, 10)),
+        'score': provider('score', lambda rng: rng.random() * 10),
+    }
+    expr, error = expression.compile(
+        '!blocked and (vip or (age >= 18 and country == 49 and '
+        '(premium or purchases > 3 or score > 7.5)))')
+    subjects = list(range(100))
+
+    async def prefetch(subject):
+        # what callers do today: every fact first, concurrently
+        names = [name.lower() for name in expr.identifiers]
+        values = await asyncio.gather(*[providers[name](subject) for name in names])
+        return expr.evaluate(dict(zip(names, values)))
+
+    async def measure(evaluate):
+        start = time.perf_counter()
+        results = [await evaluate(subject) for subject in subjects]
+        return results, (time.perf_counter() - start) / len(subjects)
+
+    async def main():
+        expected, elapsed = await measure(prefetch)
+        print(f'prefetch all:     {len(expr.identifiers):5.2f} fetches, '
+              f'{elapsed * 1000:5.1f} ms per evaluation')
+
+        cache = FactCache()
+        for label, evaluator in [
+                ('lazy:', LazyEvaluator(providers)),
+                ('lazy, speculate:', LazyEvaluator(providers, speculate=True)),
+                ('lazy, adaptive:', LazyEvaluator(providers, speculate='adaptive')),
+                ('lazy, cached:', LazyEvaluator(providers, cache=cache)),
+                ('again, cached:', LazyEvaluator(providers, cache=cache))]:
+            results, elapsed = await measure(
+                lambda subject: evaluator.evaluate(expr, subject))
+            assert [str(value) for value, error in results] == \
+                   [str(value) for value, error in expected]
+            print(f'{label:17s} {evaluator.fetches / len(subjects):5.2f} fetches, '
+                  f'{elapsed * 1000:5.1f} ms per evaluation')
+
+    asyncio.run(main())
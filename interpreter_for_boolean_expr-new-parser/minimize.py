@@ -0,0 +1,463 @@
+
+##########################
+# MINIMIZE
+##########################
+
+# Shrinks the AND/OR/! structure of an expression into a logically
+# equivalent sum of products. Identifiers and comparisons are treated as
+# opaque boolean atoms. Up to EXACT_VARIABLE_LIMIT atoms the result is
+# exact (Quine-McCluskey), beyond that an Espresso-style expand and
+# irredundant loop gives a near-minimal cover.
+#
+# Atoms are assumed to be bools, runtime errors of atoms that get
+# dropped (e.g. 'x and !x' with a number x) are not kept.
+
+import time
+
+from interpreter import *
+from render import to_source, count_literals, is_logical, logical_spine
+
+
+EXACT_VARIABLE_LIMIT = 10
+MAX_CUBES = 10000
+TIME_BUDGET = 1.0
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    def __init__(self, seconds):
+        self.deadline = time.perf_counter() + seconds
+
+    def check(self):
+        if time.perf_counter() > self.deadline:
+            raise BudgetExceeded()
+
+
+class MinimizeResult:
+    def __init__(self, text, node, literals_before, literals_after, method):
+        self.text = text
+        self.node = node
+        self.literals_before = literals_before
+        self.literals_after = literals_after
+        # 'exact', 'heuristic' or 'unchanged'
+        self.method = method
+
+    def __repr__(self):
+        return (f'{self.text} ({self.method}, '
+                f'{self.literals_before} -> {self.literals_after} literals)')
+
+
+##########################
+# ATOMS
+##########################
+
+class Atoms:
+    def __init__(self):
+        self.index = {}
+        self.sources = []
+
+    def add(self, node):
+        # the same comparison written twice is the same atom
+        source = to_source(node)
+        if source not in self.index:
+            self.index[source] = len(self.sources)
+            self.sources.append(source)
+        return self.index[source]
+
+    def collect(self, node):
+        # in source order
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, BooleanNode):
+                continue
+            if isinstance(node, UnaryOpNode):
+                nodes.append(node.node)
+            elif is_logical(node):
+                nodes.append(node.right_node)
+                nodes.append(node.left_node)
+            else:
+                self.add(node)
+
+    def literal(self, index, positive):
+        source = self.sources[index]
+        if positive:
+            return source
+        if ' ' in source:
+            return f'!({source})'
+        return '!' + source
+
+
+##########################
+# CUBES
+##########################
+
+# A cube is a product of literals stored as two bit masks over the atom
+# indices: (pos, neg). (0, 0) is the cube that is always true.
+
+def literal_count(cube):
+    pos, neg = cube
+    return bin(pos).count('1') + bin(neg).count('1')
+
+
+def cover_cost(cover):
+    return len(cover), sum(literal_count(cube) for cube in cover)
+
+
+def contains(big, small):
+    return big[0] & small[0] == big[0] and big[1] & small[1] == big[1]
+
+
+def remove_contained(cover):
+    result = []
+    for cube in sorted(set(cover), key=literal_count):
+        if not any(contains(kept, cube) for kept in result):
+            result.append(cube)
+    return result
+
+
+def cofactor(cover, cube):
+    pos, neg = cube
+    care = pos | neg
+    result = []
+    for cube_pos, cube_neg in cover:
+        if cube_pos & neg or cube_neg & pos:
+            continue
+        result.append((cube_pos & ~care, cube_neg & ~care))
+    return result
+
+
+def tautology(cover, budget):
+    budget.check()
+    if not cover:
+        return False
+    if (0, 0) in cover:
+        return True
+
+    all_pos = 0
+    all_neg = 0
+    for pos, neg in cover:
+        all_pos |= pos
+        all_neg |= neg
+
+    # a unate cover is only a tautology if it holds the universal cube
+    binate = all_pos & all_neg
+    if not binate:
+        return False
+
+    bit = binate & -binate
+    return tautology(cofactor(cover, (bit, 0)), budget) and \
+        tautology(cofactor(cover, (0, bit)), budget)
+
+
+def to_cover(node, atoms, negated, max_cubes):
+    if isinstance(node, BooleanNode):
+        if (node.tok.value == 'TRUE') != negated:
+            return [(0, 0)]
+        return []
+
+    if isinstance(node, UnaryOpNode):
+        return to_cover(node.node, atoms, not negated, max_cubes)
+
+    if is_logical(node):
+        # long chains nest on the left, the left spine is walked in a loop
+        spine = logical_spine(node)
+        cover = to_cover(spine[-1].left_node, atoms, negated, max_cubes)
+        for node in reversed(spine):
+            right = to_cover(node.right_node, atoms, negated, max_cubes)
+            cover = join_covers(node, cover, right, negated, max_cubes)
+        return cover
+
+    bit = 1 << atoms.index[to_source(node)]
+    if negated:
+        return [(0, bit)]
+    return [(bit, 0)]
+
+
+def join_covers(node, left, right, negated, max_cubes):
+    # De Morgan: a negated AND is an OR of the negations
+    if node.op_tok.matches(TT_KEYWORD, 'OR') != negated:
+        return remove_contained(left + right)
+
+    product = []
+    for left_pos, left_neg in left:
+        for right_pos, right_neg in right:
+            pos = left_pos | right_pos
+            neg = left_neg | right_neg
+            if pos & neg:
+                continue
+            product.append((pos, neg))
+        if len(product) > max_cubes:
+            raise BudgetExceeded()
+    return remove_contained(product)
+
+
+##########################
+# HEURISTIC
+##########################
+
+def expand(cover, budget):
+    result = []
+    for cube in sorted(cover, key=literal_count, reverse=True):
+        if any(contains(kept, cube) for kept in result):
+            continue
+        pos, neg = cube
+        for bit in bits(pos | neg):
+            candidate = (pos & ~bit, neg & ~bit)
+            if tautology(cofactor(cover, candidate), budget):
+                pos, neg = candidate
+        result = [kept for kept in result if not contains((pos, neg), kept)]
+        result.append((pos, neg))
+    return result
+
+
+def irredundant(cover, budget):
+    result = list(cover)
+    for cube in sorted(cover, key=literal_count, reverse=True):
+        rest = [other for other in result if other != cube]
+        if tautology(cofactor(rest, cube), budget):
+            result = rest
+    return result
+
+
+def minimize_heuristic(cover, budget):
+    best = cover
+    try:
+        while True:
+            cover = irredundant(expand(best, budget), budget)
+            if cover_cost(cover) >= cover_cost(best):
+                return best
+            best = cover
+    except BudgetExceeded:
+        # every step keeps the cover equivalent, keep the best so far
+        return best
+
+
+def bits(mask):
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+##########################
+# EXACT
+##########################
+
+def truth_table(node, atoms, count):
+    # one bit per assignment, atom i is true in assignment m if bit i of m is set
+    full = (1 << (1 << count)) - 1
+    columns = []
+    for i in range(count):
+        block = ((1 << (1 << i)) - 1) << (1 << i)
+        pattern = 0
+        step = 1 << (i + 1)
+        for start in range(0, 1 << count, step):
+            pattern |= block << start
+        columns.append(pattern)
+
+    def table(node):
+        if isinstance(node, BooleanNode):
+            return full if node.tok.value == 'TRUE' else 0
+        if isinstance(node, UnaryOpNode):
+            return ~table(node.node) & full
+        if is_logical(node):
+            spine = logical_spine(node)
+            result = table(spine[-1].left_node)
+            for node in reversed(spine):
+                if node.op_tok.matches(TT_KEYWORD, 'AND'):
+                    result &= table(node.right_node)
+                else:
+                    result |= table(node.right_node)
+            return result
+        return columns[atoms.index[to_source(node)]]
+
+    return table(node)
+
+
+def prime_implicants(minterms, count, budget):
+    # implicants are (value, mask), bits set in mask are "don't care"
+    current = set((minterm, 0) for minterm in minterms)
+    primes = set()
+
+    while current:
+        budget.check()
+        combined = set()
+        used = set()
+        for value, mask in current:
+            for i in range(count):
+                bit = 1 << i
+                if mask & bit or value & bit:
+                    continue
+                partner = (value | bit, mask)
+                if partner in current:
+                    combined.add((value, mask | bit))
+                    used.add((value, mask))
+                    used.add(partner)
+        primes |= current - used
+        current = combined
+
+    return primes
+
+
+def implicant_to_cube(implicant, count):
+    value, mask = implicant
+    care = ((1 << count) - 1) & ~mask
+    return value & care, ~value & care
+
+
+def covers(implicant, minterm):
+    value, mask = implicant
+    return minterm & ~mask == value
+
+
+def select_cover(primes, minterms, count, budget):
+    cubes = {prime: implicant_to_cube(prime, count) for prime in primes}
+    covering = {minterm: [prime for prime in primes if covers(prime, minterm)]
+                for minterm in minterms}
+
+    # essential primes are the only ones covering some minterm
+    chosen = set()
+    for minterm, options in covering.items():
+        if len(options) == 1:
+            chosen.add(options[0])
+    uncovered = set(minterm for minterm in minterms
+                    if not any(covers(prime, minterm) for prime in chosen))
+
+    greedy = greedy_cover(uncovered, covering, cubes)
+    best = [list(chosen) + greedy]
+    exact = [True]
+
+    def cost(selection):
+        return cover_cost([cubes[prime] for prime in selection])
+
+    def search(selection, uncovered):
+        budget.check()
+        if cost(selection) >= cost(best[0]):
+            return
+        if not uncovered:
+            best[0] = list(selection)
+            return
+        # branch on the minterm with the fewest options
+        minterm = min(uncovered, key=lambda m: len(covering[m]))
+        for prime in sorted(covering[minterm],
+                            key=lambda p: literal_count(cubes[p])):
+            rest = set(m for m in uncovered if not covers(prime, m))
+            search(selection + [prime], rest)
+
+    try:
+        search(list(chosen), uncovered)
+    except BudgetExceeded:
+        exact[0] = False
+
+    return [cubes[prime] for prime in best[0]], exact[0]
+
+
+def greedy_cover(uncovered, covering, cubes):
+    uncovered = set(uncovered)
+    selection = []
+    while uncovered:
+        candidates = set(prime for minterm in uncovered
+                         for prime in covering[minterm])
+        prime = max(candidates, key=lambda p: (
+            sum(1 for m in uncovered if covers(p, m)),
+            -literal_count(cubes[p])))
+        selection.append(prime)
+        uncovered = set(m for m in uncovered if not covers(prime, m))
+    return selection
+
+
+##########################
+# MINIMIZE
+##########################
+
+def cover_to_source(cover, atoms):
+    if not cover:
+        return 'false'
+    if (0, 0) in cover:
+        return 'true'
+
+    products = []
+    for pos, neg in sorted(cover, key=lambda cube: (literal_count(cube), cube)):
+        literals = []
+        for i in range(len(atoms.sources)):
+            bit = 1 << i
+            if pos & bit:
+                literals.append(atoms.literal(i, True))
+            elif neg & bit:
+                literals.append(atoms.literal(i, False))
+        products.append(' and '.join(literals))
+
+    # 'and' and 'or' share one level, products need their own parentheses
+    if len(products) > 1:
+        products = [f'({product})' if ' and ' in product else product
+                    for product in products]
+    return ' or '.join(products)
+
+
+def parse_source(text, fn):
+    tokens, error = Lexer(fn, text).make_tokens()
+    if error:
+        return None, error
+    ast = Parser(tokens).parse()
+    return ast.node, ast.error
+
+
+def minimize(node, exact_limit=EXACT_VARIABLE_LIMIT, max_cubes=MAX_CUBES,
+             time_budget=TIME_BUDGET):
+    literals_before = count_literals(node)
+    atoms = Atoms()
+    atoms.collect(node)
+    count = len(atoms.sources)
+    budget = Budget(time_budget)
+
+    cover = None
+    method = 'heuristic'
+    if count <= exact_limit:
+        try:
+            table = truth_table(node, atoms, count)
+            minterms = [m for m in range(1 << count) if table >> m & 1]
+            primes = prime_implicants(minterms, count, budget)
+            cover, exact = select_cover(primes, minterms, count, budget)
+            method = 'exact' if exact else 'heuristic'
+        except BudgetExceeded:
+            cover = None
+
+    if cover == None:
+        try:
+            cover = minimize_heuristic(
+                to_cover(node, atoms, False, max_cubes), budget)
+        except BudgetExceeded:
+            cover = None
+
+    text = cover_to_source(cover, atoms) if cover != None else None
+    literals_after = sum(literal_count(cube) for cube in cover) \
+        if cover != None else literals_before
+
+    # a sum of products can be larger than a factored input
+    if text == None or literals_after > literals_before:
+        return MinimizeResult(to_source(node), node, literals_before,
+                              literals_before, 'unchanged')
+
+    new_node, error = parse_source(text, '<minimized>')
+    return MinimizeResult(text, new_node, literals_before, literals_after,
+                          method)
+
+
+def minimize_text(text, fn='<expr>', **options):
+    node, error = parse_source(text, fn)
+    if error:
+        return None, error
+    return minimize(node, **options), None
+
+
+if __name__ == '__main__':
+    for text in ['a and b or a and !b',
+                 '(a or b) and (a or c) and (a or !b or c)',
+                 'true and x or x and (y or !y) or !!x and z',
+                 '(a and b) or (a and b and c) or (!a and b) or (b and d)']:
+        result, error = minimize_text(text)
+        print(f'{text}\n  -> {result}')
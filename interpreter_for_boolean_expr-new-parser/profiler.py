@@ -0,0 +1,232 @@
+
+##########################
+# PROFILER
+##########################
+
+# Opt-in per node profiling. ProfilingInterpreter wraps every evaluate,
+# the normal Interpreter and Expression.evaluate are left untouched so
+# there is no cost when profiling is off.
+#
+# Stats are keyed by the source span of a node and add up over every
+# evaluation run through the same Profile. A Profile is not meant to be
+# shared between threads.
+
+import json
+import time
+
+from interpreter import *
+
+
+class NodeStats:
+    def __init__(self, node):
+        self.pos_start = node.pos_start
+        self.pos_end = node.pos_end
+        self.kind = type(node).__name__
+        self.count = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.outcomes = {'true': 0, 'false': 0, 'value': 0, 'error': 0}
+        # how often the node was an operand of 'and'/'or' and how often
+        # flipping it would have changed that operator's result
+        self.operand = 0
+        self.decisive = 0
+
+    def source(self):
+        return self.pos_start.ftxt[self.pos_start.idx:self.pos_end.idx]
+
+    def never_decisive(self):
+        return self.operand > 0 and self.decisive == 0
+
+    def as_dict(self):
+        return {
+            'start': self.pos_start.idx,
+            'end': self.pos_end.idx,
+            'source': self.source(),
+            'kind': self.kind,
+            'count': self.count,
+            'total_time': self.total_time,
+            'self_time': self.self_time,
+            'outcomes': dict(self.outcomes),
+            'operand': self.operand,
+            'decisive': self.decisive,
+        }
+
+
+def outcome_of(value):
+    # value is None if evaluating failed
+    if value == None:
+        return 'error'
+    if isinstance(value, Booleen):
+        return value.value.lower()
+    return 'value'
+
+
+##########################
+# PROFILING INTERPRETER
+##########################
+
+class ProfilingInterpreter(Interpreter):
+    def __init__(self, profile):
+        super().__init__()
+        self.profile = profile
+        self.path = []
+        self.child_times = []
+        self.last_outcomes = {}
+
+    def evaluate(self, node, context):
+        stats = self.profile.node_stats(node)
+        self.path.append(stats.source())
+        self.child_times.append(0.0)
+
+        start = time.perf_counter()
+        value = None
+        try:
+            value = super().evaluate(node, context)
+            return value
+        finally:
+            self.record(node, stats, value, time.perf_counter() - start)
+
+    def visit_BinOpNode(self, node, context):
+        # the Interpreter walks the left spine of a chain in a loop, its
+        # inner nodes are entered here and recorded as if it recursed
+        spine = left_spine(node)
+        entered = []
+        value = None
+        try:
+            for inner in spine[1:]:
+                self.step(inner, context)
+                stats = self.profile.node_stats(inner)
+                self.path.append(stats.source())
+                self.child_times.append(0.0)
+                entered.append((inner, stats, time.perf_counter()))
+
+            value = self.evaluate(spine[-1].left_node, context)
+            for node in reversed(spine):
+                value = self.apply(node, value, context)
+                if entered:
+                    inner, stats, start = entered.pop()
+                    self.record(inner, stats, value, time.perf_counter() - start)
+            return value
+        finally:
+            # innermost first, after an error
+            while entered:
+                inner, stats, start = entered.pop()
+                self.record(inner, stats, None, time.perf_counter() - start)
+
+    def apply(self, node, left, context):
+        right = self.evaluate(node.right_node, context)
+        return Booleen('TRUE' if OPERATORS[node.op](left, right) else 'FALSE',
+                       node.pos_start, node.pos_end, context)
+
+    def record(self, node, stats, value, elapsed):
+        self_time = elapsed - self.child_times.pop()
+        if self.child_times:
+            self.child_times[-1] += elapsed
+
+        outcome = outcome_of(value)
+        stats.count += 1
+        stats.total_time += elapsed
+        stats.self_time += self_time
+        stats.outcomes[outcome] += 1
+        self.profile.add_stack(self.path, self_time)
+        self.path.pop()
+
+        if isinstance(node, BinOpNode) and node.op_tok.type == TT_KEYWORD:
+            self.record_decisive(node)
+        self.last_outcomes[id(node)] = outcome
+
+    def record_decisive(self, node):
+        # an operand decides 'and' if the other one is true,
+        # and decides 'or' if the other one is false
+        neutral = 'true' if node.op_tok.matches(TT_KEYWORD, 'AND') else 'false'
+        left = self.last_outcomes.pop(id(node.left_node), None)
+        right = self.last_outcomes.pop(id(node.right_node), None)
+        for operand, other in ((node.left_node, right), (node.right_node, left)):
+            stats = self.profile.node_stats(operand)
+            stats.operand += 1
+            if other == neutral:
+                stats.decisive += 1
+
+
+##########################
+# PROFILE
+##########################
+
+class Profile:
+    def __init__(self, expr):
+        self.expr = expr
+        self.stats = {}
+        # ';' joined source path -> self time, for flame graphs
+        self.stacks = {}
+        self.evaluations = 0
+
+    def node_stats(self, node):
+        key = (node.pos_start.idx, node.pos_end.idx)
+        stats = self.stats.get(key)
+        if stats == None:
+            stats = self.stats[key] = NodeStats(node)
+        return stats
+
+    def add_stack(self, path, self_time):
+        key = ';'.join(path)
+        self.stacks[key] = self.stacks.get(key, 0.0) + self_time
+
+    def evaluate(self, bindings=None):
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        if bindings:
+            context.symbol_table.update(bindings)
+
+        self.evaluations += 1
+        result = ProfilingInterpreter(self).visit(self.expr.node, context)
+        return result.value, result.error
+
+    def hottest(self):
+        return sorted(self.stats.values(), key=lambda s: s.total_time,
+                      reverse=True)
+
+    def annotate(self):
+        result = f'{self.evaluations} evaluations of {self.expr.text}\n'
+        for stats in self.hottest():
+            outcomes = ' '.join(f'{name}={count}'
+                                for name, count in stats.outcomes.items()
+                                if count)
+            result += (f'\n{stats.count} visits, '
+                       f'{stats.total_time * 1000:.3f} ms total, '
+                       f'{stats.self_time * 1000:.3f} ms self, {outcomes}')
+            if stats.operand:
+                result += f', decisive {stats.decisive}/{stats.operand}'
+                if stats.never_decisive():
+                    result += ' (never decisive)'
+            result += '\n' + string_with_arrows(
+                stats.pos_start.ftxt, stats.pos_start, stats.pos_end) + '\n'
+        return result
+
+    def to_json(self):
+        return json.dumps({
+            'text': self.expr.text,
+            'evaluations': self.evaluations,
+            'nodes': [stats.as_dict() for stats in self.hottest()],
+        }, indent=2)
+
+    def collapsed(self):
+        # 'outer;inner self_time_in_microseconds' lines for flamegraph.pl
+        lines = []
+        for path, self_time in sorted(self.stacks.items()):
+            lines.append(f'{path} {round(self_time * 1e6)}')
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    import random
+    import expression
+
+    expr, error = expression.compile(
+        '(age >= 18 and country == 49) and (premium or age > 0) and !banned')
+    profile = Profile(expr)
+    for i in range(1000):
+        profile.evaluate({'age': random.randint(0, 99),
+                          'country': random.choice([49, 1, 33]),
+                          'premium': random.random() < 0.1,
+                          'banned': random.random() < 0.01})
+    print(profile.annotate())
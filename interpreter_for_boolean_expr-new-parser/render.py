@@ -0,0 +1,161 @@
+
+##########################
+# RENDER
+##########################
+
+# Turns an AST back into source text that Lexer and Parser accept,
+# with only the parentheses the grammar needs.
+
+from decimal import Decimal
+from interpreter import *
+
+
+# binding strength of each level in the Parser, higher binds tighter.
+# The Parser reads 'and' and 'or' on one level from left to right.
+PREC_LOGICAL = 1
+PREC_EQUALITY = 2
+PREC_COMPARSION = 3
+PREC_UNARY = 4
+PREC_PRIMARY = 5
+
+OP_SOURCE = {
+    TT_EE: '==',
+    TT_NE: '!=',
+    TT_LT: '<',
+    TT_LTE: '<=',
+    TT_GT: '>',
+    TT_GTE: '>=',
+}
+
+
+def op_precedence(op_tok):
+    if op_tok.type == TT_KEYWORD:
+        return PREC_LOGICAL
+    if op_tok.type in (TT_EE, TT_NE):
+        return PREC_EQUALITY
+    return PREC_COMPARSION
+
+
+def op_source(op_tok):
+    if op_tok.type == TT_KEYWORD:
+        return op_tok.value.lower()
+    return OP_SOURCE[op_tok.type]
+
+
+def precedence(node):
+    if isinstance(node, BinOpNode):
+        return op_precedence(node.op_tok)
+    if isinstance(node, UnaryOpNode):
+        return PREC_UNARY
+    return PREC_PRIMARY
+
+
+class RenderError(Error):
+    def __init__(self, pos_start, pos_end, details):
+        super().__init__(pos_start, pos_end, 'Render Error', details)
+
+
+def has_literal(value):
+    # the lexer only knows digits and one '.', no signs or exponents
+    return not (isinstance(value, bool) or value < 0 or value != value
+                or value in (float('inf'), float('-inf')))
+
+
+def number_source(value):
+    if not has_literal(value):
+        raise ValueError(f'{value!r} has no literal in the language')
+    if isinstance(value, int):
+        return str(value)
+    text = f'{Decimal(repr(value)):f}'
+    if '.' not in text:
+        text += '.0'
+    return text
+
+
+def number_display(value):
+    # for messages and reprs, values without a literal like -2 or nan
+    # are shown as in py and do not parse back
+    if has_literal(value):
+        return number_source(value)
+    return repr(value)
+
+
+def to_source(node, number=number_source):
+    if isinstance(node, BooleanNode):
+        return node.tok.value.lower()
+
+    if isinstance(node, NumberNode):
+        return number(node.tok.value)
+
+    if isinstance(node, VarAccessNode):
+        return node.var_name_tok.value.lower()
+
+    if isinstance(node, UnaryOpNode):
+        return '!' + wrap(node.node, PREC_UNARY, number)
+
+    if isinstance(node, BinOpNode):
+        # operators are left associative, a right operand on the same
+        # level needs parentheses to keep its grouping. Long chains nest
+        # on the left, so the left spine is rendered in a loop.
+        spine = left_spine(node)
+        text = wrap(spine[-1].left_node, op_precedence(spine[-1].op_tok), number)
+        for node in reversed(spine):
+            prec = op_precedence(node.op_tok)
+            if node is not spine[-1] and op_precedence(node.left_node.op_tok) < prec:
+                text = f'({text})'
+            text = f'{text} {op_source(node.op_tok)} {wrap(node.right_node, prec + 1, number)}'
+        return text
+
+    raise Exception(f'Cannot render {type(node).__name__}')
+
+
+def wrap(node, min_prec, number=number_source):
+    text = to_source(node, number)
+    if precedence(node) < min_prec:
+        return f'({text})'
+    return text
+
+
+def is_logical(node):
+    return isinstance(node, BinOpNode) and node.op_tok.type == TT_KEYWORD
+
+
+def chain(node):
+    # operands of a chain of one operator, walked without recursion
+    # since 'a and b and c ...' nests on the left
+    op = node.op_tok.value
+    operands = []
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        if is_logical(node) and node.op_tok.value == op:
+            pending.append(node.right_node)
+            pending.append(node.left_node)
+        else:
+            operands.append(node)
+    return operands
+
+
+def logical_spine(node):
+    # like left_spine, only through 'and'/'or' of any mix
+    spine = [node]
+    while is_logical(node.left_node):
+        node = node.left_node
+        spine.append(node)
+    return spine
+
+
+# the number of identifiers and comparisons in a tree
+def count_literals(node):
+    count = 0
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, UnaryOpNode):
+            nodes.append(node.node)
+        elif is_logical(node):
+            nodes.append(node.left_node)
+            nodes.append(node.right_node)
+        elif isinstance(node, (VarAccessNode, NumberNode, BinOpNode)):
+            count += 1
+    return count
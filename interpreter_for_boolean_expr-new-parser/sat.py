@@ -0,0 +1,508 @@
+
+##########################
+# SAT
+##########################
+
+# Tseitin encoding of an AST into CNF and a CDCL solver (watched
+# literals, first-UIP clause learning, activity based decisions, Luby
+# restarts and a conflict budget).
+#
+# Identifiers and comparisons are boolean atoms like in minimize.py.
+# Two comparisons on the same number are independent atoms here, so a
+# model over comparisons may not exist for real numbers.
+
+import heapq
+
+from interpreter import *
+from minimize import Atoms
+from render import is_logical, chain
+
+
+SAT = 'SAT'
+UNSAT = 'UNSAT'
+UNKNOWN = 'UNKNOWN'
+
+MAX_CONFLICTS = 100000
+RESTART_BASE = 100
+MIN_LEARNTS = 2000
+LEARNT_INCREMENT = 300
+
+
+##########################
+# CNF
+##########################
+
+class CNF:
+    def __init__(self):
+        self.num_vars = 0
+        self.clauses = []
+        self.atoms = Atoms()
+        # variable of each atom, in the order of atoms.sources
+        self.atom_vars = []
+        self.true_var = None
+
+    def new_var(self):
+        self.num_vars += 1
+        return self.num_vars
+
+    def add_clause(self, clause):
+        self.clauses.append(list(clause))
+
+    def atom(self, node):
+        index = self.atoms.add(node)
+        if index == len(self.atom_vars):
+            self.atom_vars.append(self.new_var())
+        return self.atom_vars[index]
+
+    def constant(self, value):
+        if self.true_var == None:
+            self.true_var = self.new_var()
+            self.add_clause([self.true_var])
+        return self.true_var if value else -self.true_var
+
+    def encode(self, node):
+        # returns a literal that is true exactly when node is true
+        if isinstance(node, BooleanNode):
+            return self.constant(node.tok.value == 'TRUE')
+
+        if isinstance(node, UnaryOpNode):
+            negations = 0
+            while isinstance(node, UnaryOpNode):
+                negations += 1
+                node = node.node
+            literal = self.encode(node)
+            return -literal if negations % 2 else literal
+
+        if is_logical(node):
+            is_and = node.op_tok.matches(TT_KEYWORD, 'AND')
+            operands = [self.encode(operand) for operand in chain(node)]
+            gate = self.new_var()
+            if is_and:
+                # gate -> every operand, all operands -> gate
+                for literal in operands:
+                    self.add_clause([-gate, literal])
+                self.add_clause([gate] + [-literal for literal in operands])
+            else:
+                for literal in operands:
+                    self.add_clause([gate, -literal])
+                self.add_clause([-gate] + operands)
+            return gate
+
+        return self.atom(node)
+
+    def assert_true(self, node):
+        # the top level needs no gates, every operand of a conjunction
+        # is a clause and a disjunction is one clause
+        conjuncts = [node]
+        if is_logical(node) and node.op_tok.matches(TT_KEYWORD, 'AND'):
+            conjuncts = chain(node)
+
+        for conjunct in conjuncts:
+            if is_logical(conjunct) and conjunct.op_tok.matches(TT_KEYWORD, 'OR'):
+                self.add_clause([self.encode(operand)
+                                 for operand in chain(conjunct)])
+            else:
+                self.add_clause([self.encode(conjunct)])
+
+    def assert_false(self, node):
+        self.add_clause([-self.encode(node)])
+
+    def to_dimacs(self):
+        lines = []
+        for source, var in zip(self.atoms.sources, self.atom_vars):
+            lines.append(f'c {var} {source}')
+        lines.append(f'p cnf {self.num_vars} {len(self.clauses)}')
+        for clause in self.clauses:
+            lines.append(' '.join(str(literal) for literal in clause) + ' 0')
+        return '\n'.join(lines) + '\n'
+
+    def write_dimacs(self, path):
+        with open(path, 'w') as file:
+            file.write(self.to_dimacs())
+
+
+def tseitin(node):
+    cnf = CNF()
+    cnf.assert_true(node)
+    return cnf
+
+
+##########################
+# SOLVER
+##########################
+
+class SatResult:
+    def __init__(self, status, model=None, conflicts=0):
+        self.status = status
+        # variable -> bool
+        self.model = model
+        self.conflicts = conflicts
+
+    def __repr__(self):
+        return f'{self.status} after {self.conflicts} conflicts'
+
+
+def luby(i):
+    # 1 1 2 1 1 2 4 1 1 2 1 1 2 4 8 ...
+    size = 1
+    sequence = 0
+    while size < i + 1:
+        sequence += 1
+        size = 2 * size + 1
+    while size - 1 != i:
+        size = (size - 1) >> 1
+        sequence -= 1
+        i = i % size
+    return 1 << sequence
+
+
+class Solver:
+    def __init__(self, num_vars, clauses):
+        self.num_vars = num_vars
+        self.clauses = []
+        self.watches = [[] for _ in range(2 * num_vars + 2)]
+        self.values = [0] * (num_vars + 1)
+        self.level = [0] * (num_vars + 1)
+        self.reason = [None] * (num_vars + 1)
+        self.polarity = [False] * (num_vars + 1)
+        self.activity = [0.0] * (num_vars + 1)
+        self.var_inc = 1.0
+        self.trail = []
+        self.trail_lim = []
+        self.qhead = 0
+        self.heap = [(0.0, var) for var in range(1, num_vars + 1)]
+        self.seen = [False] * (num_vars + 1)
+        self.conflicts = 0
+        self.unsat = False
+        self.learnts = []
+        # literal block distance of each learnt clause
+        self.lbd = {}
+
+        for clause in clauses:
+            self.add_clause(clause)
+
+    # literal l is stored at index 2 * var + (l < 0)
+    def watch_index(self, literal):
+        return 2 * literal if literal > 0 else -2 * literal + 1
+
+    def value(self, literal):
+        value = self.values[abs(literal)]
+        return value if literal > 0 else -value
+
+    def add_clause(self, clause):
+        clause = list(dict.fromkeys(clause))
+        if any(-literal in clause for literal in clause):
+            return
+        clause = [literal for literal in clause if self.value(literal) != -1]
+        if any(self.value(literal) == 1 for literal in clause):
+            return
+        if not clause:
+            self.unsat = True
+        elif len(clause) == 1:
+            self.enqueue(clause[0], None)
+            if self.propagate() != None:
+                self.unsat = True
+        else:
+            self.attach(clause)
+
+    def attach(self, clause):
+        index = len(self.clauses)
+        self.clauses.append(clause)
+        self.watches[self.watch_index(clause[0])].append(index)
+        self.watches[self.watch_index(clause[1])].append(index)
+        return index
+
+    def enqueue(self, literal, reason):
+        var = abs(literal)
+        self.values[var] = 1 if literal > 0 else -1
+        self.level[var] = len(self.trail_lim)
+        self.reason[var] = reason
+        self.trail.append(literal)
+
+    def propagate(self):
+        # returns the index of a conflicting clause or None
+        values = self.values
+        clauses = self.clauses
+        watches = self.watches
+        trail = self.trail
+
+        while self.qhead < len(trail):
+            false_literal = -trail[self.qhead]
+            self.qhead += 1
+            watch_index = 2 * false_literal if false_literal > 0 \
+                else -2 * false_literal + 1
+            watchers = watches[watch_index]
+            watches[watch_index] = kept = []
+
+            for position, clause_index in enumerate(watchers):
+                clause = clauses[clause_index]
+                if clause == None:
+                    # removed by reduce_learnts
+                    continue
+                if clause[0] == false_literal:
+                    clause[0], clause[1] = clause[1], clause[0]
+                first = clause[0]
+                first_value = values[first] if first > 0 else -values[-first]
+                if first_value == 1:
+                    kept.append(clause_index)
+                    continue
+
+                for k in range(2, len(clause)):
+                    other = clause[k]
+                    if (values[other] if other > 0 else -values[-other]) != -1:
+                        clause[1], clause[k] = other, clause[1]
+                        watches[2 * other if other > 0 else -2 * other + 1] \
+                            .append(clause_index)
+                        break
+                else:
+                    kept.append(clause_index)
+                    if first_value == -1:
+                        kept.extend(watchers[position + 1:])
+                        self.qhead = len(trail)
+                        return clause_index
+                    self.enqueue(first, clause_index)
+        return None
+
+    def reduce_learnts(self):
+        # drop the half of the learnt clauses with the most decision
+        # levels, clauses that are the reason of an assignment stay
+        def locked(index):
+            first = self.clauses[index][0]
+            return self.reason[abs(first)] == index and self.value(first) == 1
+
+        self.learnts.sort(key=lambda index: self.lbd[index], reverse=True)
+        half = len(self.learnts) // 2
+        kept = []
+        for position, index in enumerate(self.learnts):
+            if position < half and self.lbd[index] > 2 and not locked(index):
+                self.clauses[index] = None
+                del self.lbd[index]
+            else:
+                kept.append(index)
+        self.learnts = kept
+
+    def bump(self, var):
+        self.activity[var] += self.var_inc
+        if self.activity[var] > 1e100:
+            self.activity = [activity * 1e-100 for activity in self.activity]
+            self.var_inc *= 1e-100
+            self.heap = [(-self.activity[v], v) for v in range(1, self.num_vars + 1)
+                         if self.values[v] == 0]
+            heapq.heapify(self.heap)
+        else:
+            heapq.heappush(self.heap, (-self.activity[var], var))
+
+    def analyze(self, clause_index):
+        # first unique implication point
+        learnt = [None]
+        counter = 0
+        literal = None
+        index = len(self.trail) - 1
+        current_level = len(self.trail_lim)
+        seen = self.seen
+
+        while True:
+            clause = self.clauses[clause_index]
+            for other in (clause if literal == None else clause[1:]):
+                var = abs(other)
+                if not seen[var] and self.level[var] > 0:
+                    seen[var] = True
+                    self.bump(var)
+                    if self.level[var] >= current_level:
+                        counter += 1
+                    else:
+                        learnt.append(other)
+
+            while not seen[abs(self.trail[index])]:
+                index -= 1
+            literal = self.trail[index]
+            index -= 1
+            clause_index = self.reason[abs(literal)]
+            seen[abs(literal)] = False
+            counter -= 1
+            if counter == 0:
+                break
+
+        learnt[0] = -literal
+
+        # drop literals implied by the rest of the clause
+        minimized = [learnt[0]]
+        for other in learnt[1:]:
+            reason = self.reason[abs(other)]
+            if reason == None or not all(
+                    seen[abs(implied)] or self.level[abs(implied)] == 0
+                    for implied in self.clauses[reason][1:]):
+                minimized.append(other)
+        for other in learnt[1:]:
+            seen[abs(other)] = False
+        learnt = minimized
+
+        backtrack_level = 0
+        if len(learnt) > 1:
+            # the second watch must be the literal assigned last
+            highest = max(range(1, len(learnt)),
+                          key=lambda i: self.level[abs(learnt[i])])
+            learnt[1], learnt[highest] = learnt[highest], learnt[1]
+            backtrack_level = self.level[abs(learnt[1])]
+        return learnt, backtrack_level
+
+    def cancel_until(self, level):
+        if len(self.trail_lim) <= level:
+            return
+        start = self.trail_lim[level]
+        for literal in self.trail[start:]:
+            var = abs(literal)
+            self.polarity[var] = literal > 0
+            self.values[var] = 0
+            self.reason[var] = None
+            heapq.heappush(self.heap, (-self.activity[var], var))
+        del self.trail[start:]
+        del self.trail_lim[level:]
+        self.qhead = len(self.trail)
+
+    def decide(self):
+        while self.heap:
+            activity, var = heapq.heappop(self.heap)
+            if self.values[var] == 0:
+                return var if self.polarity[var] else -var
+        return None
+
+    def solve(self, max_conflicts=MAX_CONFLICTS):
+        if self.unsat:
+            return SatResult(UNSAT, conflicts=self.conflicts)
+
+        self.max_learnts = max(MIN_LEARNTS, len(self.clauses) // 3)
+        restart = 0
+        restart_limit = RESTART_BASE * luby(restart)
+        conflicts_since_restart = 0
+
+        while True:
+            conflict = self.propagate()
+            if conflict != None:
+                self.conflicts += 1
+                conflicts_since_restart += 1
+                if not self.trail_lim:
+                    return SatResult(UNSAT, conflicts=self.conflicts)
+
+                learnt, backtrack_level = self.analyze(conflict)
+                self.cancel_until(backtrack_level)
+                if len(learnt) == 1:
+                    self.enqueue(learnt[0], None)
+                else:
+                    index = self.attach(learnt)
+                    self.learnts.append(index)
+                    self.lbd[index] = len(set(
+                        self.level[abs(other)] for other in learnt))
+                    self.enqueue(learnt[0], index)
+                self.var_inc /= 0.95
+
+                if len(self.learnts) >= self.max_learnts:
+                    self.reduce_learnts()
+                    self.max_learnts += LEARNT_INCREMENT
+
+                if self.conflicts >= max_conflicts:
+                    return SatResult(UNKNOWN, conflicts=self.conflicts)
+                continue
+
+            if conflicts_since_restart >= restart_limit:
+                restart += 1
+                restart_limit = RESTART_BASE * luby(restart)
+                conflicts_since_restart = 0
+                self.cancel_until(0)
+                continue
+
+            literal = self.decide()
+            if literal == None:
+                model = {var: self.values[var] == 1
+                         for var in range(1, self.num_vars + 1)}
+                return SatResult(SAT, model, self.conflicts)
+            self.trail_lim.append(len(self.trail))
+            self.enqueue(literal, None)
+
+
+def solve(cnf, max_conflicts=MAX_CONFLICTS):
+    return Solver(cnf.num_vars, cnf.clauses).solve(max_conflicts)
+
+
+##########################
+# QUERIES
+##########################
+
+def atom_values(cnf, result):
+    # source of every atom -> bool in the model
+    return {source: result.model[var]
+            for source, var in zip(cnf.atoms.sources, cnf.atom_vars)}
+
+
+def model_bindings(cnf, result):
+    # identifier bindings for the Interpreter, comparisons are left out
+    bindings = {}
+    for source, var in zip(cnf.atoms.sources, cnf.atom_vars):
+        if source.isidentifier() and source not in ('true', 'false'):
+            bindings[source.upper()] = result.model[var]
+    return bindings
+
+
+def check(node, bindings):
+    # evaluate node with the Interpreter, returns (is true, error)
+    context = Context('<program>')
+    context.symbol_table = SymbolTable(global_symbol_table)
+    context.symbol_table.update(bindings)
+    result = Interpreter().visit(node, context)
+    if result.error:
+        return False, result.error
+    return result.value.value == 'TRUE', None
+
+
+def satisfiable(node, max_conflicts=MAX_CONFLICTS):
+    # returns (status, identifier bindings or None)
+    cnf = tseitin(node)
+    result = solve(cnf, max_conflicts)
+    if result.status != SAT:
+        return result.status, None
+    return SAT, model_bindings(cnf, result)
+
+
+def implies(node, other, max_conflicts=MAX_CONFLICTS):
+    # node implies other if 'node and !other' has no model.
+    # returns (holds, counterexample bindings or None), holds is True,
+    # False or UNKNOWN when the conflict budget ran out.
+    cnf = CNF()
+    cnf.assert_true(node)
+    cnf.assert_false(other)
+    result = solve(cnf, max_conflicts)
+    if result.status == UNSAT:
+        return True, None
+    if result.status == UNKNOWN:
+        return UNKNOWN, None
+    return False, model_bindings(cnf, result)
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    random.seed(0)
+    names = [f'v{i}' for i in range(300)]
+    clauses = []
+    for _ in range(1100):
+        clause = random.sample(names, 3)
+        clauses.append('(' + ' or '.join(
+            ('!' if random.random() < 0.5 else '') + name
+            for name in clause) + ')')
+    text = ' and '.join(clauses)
+
+    tokens, error = Lexer('<bench>', text).make_tokens()
+    ast = Parser(tokens).parse()
+    if ast.error:
+        raise SystemExit(ast.error.as_string())
+    node = ast.node
+    start = time.perf_counter()
+    cnf = tseitin(node)
+    result = solve(cnf)
+    elapsed = time.perf_counter() - start
+    print(f'{len(names)} identifiers, {len(cnf.clauses)} clauses: '
+          f'{result} in {elapsed:.2f}s')
+    if result.status == SAT:
+        print('verified by Interpreter:',
+              check(node, model_bindings(cnf, result))[0])
@@ -0,0 +1,435 @@
+
+##########################
+# SHARDED EVALUATION
+##########################
+
+# Spreads a rule set over N local worker processes. Every rule lives on
+# exactly one worker, picked by consistent hashing of its id, so adding
+# or removing a rule touches only that rule and adding or removing a
+# worker only moves the rules whose ring position changed owner (about
+# 1/N of them).
+#
+# Workers are plain subprocesses running this file with --worker. They
+# talk JSON lines over their stdin/stdout pipes: the Coordinator writes
+# each fact batch to all workers holding rules before reading any reply,
+# so the workers evaluate in parallel, and merges the matching rule ids
+# per fact. A rule matches when it evaluates to true, rules that fail
+# (undefined fact, wrong type, limits) are counted as errors.
+#
+# Rule ids must be JSON values (str or int), facts py bools and numbers.
+
+import bisect
+import hashlib
+import json
+import os
+import selectors
+import subprocess
+import sys
+import time
+from collections import deque
+
+from interpreter import *
+import expression
+
+
+DEFAULT_REPLICAS = 64
+# latency samples kept per shard for the percentiles
+LATENCY_SAMPLES = 1024
+
+
+class WorkerError(Exception):
+    pass
+
+
+##########################
+# HASH RING
+##########################
+
+def ring_hash(text):
+    # stable across processes, unlike hash()
+    digest = hashlib.blake2b(text.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def rule_key(rule_id):
+    return json.dumps(rule_id)
+
+
+class HashRing:
+    def __init__(self, replicas=DEFAULT_REPLICAS):
+        # every shard is placed `replicas` times to even out the load
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+
+    def add(self, shard):
+        for replica in range(self.replicas):
+            point = ring_hash(f'{shard}#{replica}')
+            i = bisect.bisect(self.points, point)
+            self.points.insert(i, point)
+            self.owners.insert(i, shard)
+
+    def remove(self, shard):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners)
+                if owner != shard]
+        self.points = [point for point, owner in kept]
+        self.owners = [owner for point, owner in kept]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[i]
+
+
+##########################
+# WORKER
+##########################
+
+class Worker:
+    # the state of one worker process, kept apart from the pipes so it
+    # can be tested in process
+    def __init__(self):
+        self.rules = {}
+        self.limits = None
+        self.interpreter = Interpreter()
+
+    def handle(self, message):
+        op = message['op']
+        if op == 'add':
+            for rule_id, text in message['rules']:
+                expr, error = expression.compile(text, limits=self.limits)
+                if error:
+                    # checked by the Coordinator before, cannot happen
+                    # unless the limits differ
+                    raise WorkerError(error.as_string())
+                self.rules[rule_id] = expr
+            return {'rules': len(self.rules)}
+        if op == 'remove':
+            for rule_id in message['ids']:
+                self.rules.pop(rule_id, None)
+            return {'rules': len(self.rules)}
+        if op == 'evaluate':
+            return self.evaluate(message['facts'])
+        if op == 'limits':
+            self.limits = Limits(**message['limits'])
+            return {}
+        raise WorkerError(f'Unknown op {op!r}')
+
+    def evaluate(self, batch):
+        start = time.perf_counter()
+        matches = []
+        errors = 0
+        for facts in batch:
+            context = Context('<program>')
+            context.symbol_table = SymbolTable(global_symbol_table)
+            context.symbol_table.update(facts)
+            matched = []
+            for rule_id, expr in self.rules.items():
+                context.governor = Governor(self.limits)
+                result = self.interpreter.visit(expr.node, context)
+                if result.error:
+                    errors += 1
+                elif isinstance(result.value, Booleen) and result.value.value == 'TRUE':
+                    matched.append(rule_id)
+            matches.append(matched)
+        return {'matches': matches, 'errors': errors,
+                'busy': time.perf_counter() - start}
+
+
+def worker_main(stdin, stdout):
+    worker = Worker()
+    for line in stdin:
+        message = json.loads(line)
+        if message['op'] == 'stop':
+            break
+        try:
+            reply = worker.handle(message)
+        except Exception as error:
+            reply = {'error': f'{type(error).__name__}: {error}'}
+        stdout.write(json.dumps(reply).encode() + b'\n')
+        stdout.flush()
+
+
+##########################
+# COORDINATOR
+##########################
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Shard:
+    def __init__(self, name, process):
+        self.name = name
+        self.process = process
+        self.rules = set()
+        self.buffer = b''
+        self.batches = 0
+        self.facts = 0
+        self.errors = 0
+        # seconds spent evaluating, measured by the worker
+        self.busy = 0.0
+        # seconds from sending a batch until its reply was read
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'pid': self.process.pid,
+            'rules': len(self.rules),
+            'batches': self.batches,
+            'facts': self.facts,
+            'errors': self.errors,
+            'busy': self.busy,
+            'facts_per_second': self.facts / self.busy if self.busy else 0.0,
+            'latency_p50': percentile(self.latencies, 0.5),
+            'latency_p99': percentile(self.latencies, 0.99),
+        }
+
+
+class Coordinator:
+    def __init__(self, workers=2, limits=None, replicas=DEFAULT_REPLICAS):
+        self.limits = limits
+        self.ring = HashRing(replicas)
+        self.shards = {}
+        # rule id -> text, to move rules between workers
+        self.rules = {}
+        self.next_shard = 0
+        self.batches = 0
+        self.facts = 0
+        self.wall = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        for _ in range(workers):
+            self.add_worker()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ##########################
+    # WORKERS
+    ##########################
+
+    def spawn(self, name):
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        shard = Shard(name, process)
+        if self.limits != None:
+            self.request([shard], {'op': 'limits', 'limits': vars(self.limits)})
+        return shard
+
+    def add_worker(self):
+        # returns the number of rules moved to the new worker
+        name = f'shard-{self.next_shard}'
+        self.next_shard += 1
+        self.shards[name] = self.spawn(name)
+        self.ring.add(name)
+        return self.rebalance()
+
+    def remove_worker(self, name):
+        # returns the number of rules moved off the removed worker
+        if len(self.shards) == 1:
+            raise ValueError('Cannot remove the last worker')
+        self.ring.remove(name)
+        moved = self.rebalance()
+        self.stop(self.shards.pop(name))
+        return moved
+
+    def rebalance(self):
+        moves = {}
+        for shard in self.shards.values():
+            for rule_id in shard.rules:
+                owner = self.ring.owner(rule_key(rule_id))
+                if owner != shard.name:
+                    moves.setdefault((shard.name, owner), []).append(rule_id)
+
+        moved = 0
+        for (source, target), ids in moves.items():
+            self.send_rules(self.shards[target], ids)
+            self.request([self.shards[source]], {'op': 'remove', 'ids': ids})
+            self.shards[source].rules.difference_update(ids)
+            moved += len(ids)
+        return moved
+
+    def stop(self, shard):
+        try:
+            self.write(shard, {'op': 'stop'})
+            shard.process.stdin.close()
+        except OSError:
+            pass
+        shard.process.wait()
+        shard.process.stdout.close()
+
+    def close(self):
+        for shard in self.shards.values():
+            self.stop(shard)
+        self.shards = {}
+
+    ##########################
+    # RULES
+    ##########################
+
+    def add(self, rule_id, text):
+        # returns the error if the rule does not compile, else None
+        return dict(self.add_many([(rule_id, text)])).get(rule_id)
+
+    def add_many(self, items):
+        # items is an iterable of (id, text), returns [(id, error)] for
+        # the rules that do not compile
+        errors = []
+        by_shard = {}
+        for rule_id, text in items:
+            expr, error = expression.compile(text, limits=self.limits)
+            if error:
+                errors.append((rule_id, error))
+                continue
+            self.rules[rule_id] = text
+            owner = self.ring.owner(rule_key(rule_id))
+            by_shard.setdefault(owner, []).append(rule_id)
+        for owner, ids in by_shard.items():
+            self.send_rules(self.shards[owner], ids)
+        return errors
+
+    def remove(self, rule_id):
+        if rule_id not in self.rules:
+            return False
+        del self.rules[rule_id]
+        shard = self.shards[self.ring.owner(rule_key(rule_id))]
+        self.request([shard], {'op': 'remove', 'ids': [rule_id]})
+        shard.rules.discard(rule_id)
+        return True
+
+    def send_rules(self, shard, ids):
+        rules = [[rule_id, self.rules[rule_id]] for rule_id in ids]
+        self.request([shard], {'op': 'add', 'rules': rules})
+        shard.rules.update(ids)
+
+    ##########################
+    # EVALUATION
+    ##########################
+
+    def evaluate(self, batch):
+        # batch is a list of fact dicts, returns a set of matching rule
+        # ids per fact
+        batch = list(batch)
+        start = time.perf_counter()
+        shards = [shard for shard in self.shards.values() if shard.rules]
+        replies = self.request(shards, {'op': 'evaluate', 'facts': batch})
+
+        matches = [set() for _ in batch]
+        for shard, (reply, latency) in replies.items():
+            for matched, ids in zip(matches, reply['matches']):
+                matched.update(ids)
+            shard.batches += 1
+            shard.facts += len(batch)
+            shard.errors += reply['errors']
+            shard.busy += reply['busy']
+            shard.latencies.append(latency)
+
+        elapsed = time.perf_counter() - start
+        self.batches += 1
+        self.facts += len(batch)
+        self.wall += elapsed
+        self.latencies.append(elapsed)
+        return matches
+
+    def stats(self):
+        return {
+            'workers': len(self.shards),
+            'rules': len(self.rules),
+            'batches': self.batches,
+            'facts': self.facts,
+            'facts_per_second': self.facts / self.wall if self.wall else 0.0,
+            'latency_p50': percentile(self.latencies, 0.5),
+            'latency_p99': percentile(self.latencies, 0.99),
+            'shards': [shard.stats() for shard in self.shards.values()],
+        }
+
+    ##########################
+    # PIPES
+    ##########################
+
+    def write(self, shard, message):
+        data = memoryview(json.dumps(message).encode() + b'\n')
+        while data:
+            written = shard.process.stdin.write(data)
+            data = data[written:]
+
+    def request(self, shards, message):
+        # sends message to all shards before reading, returns
+        # shard -> (reply, seconds until it was read). Every reply is
+        # read before a failed one is raised, so none is left in a pipe
+        # to be taken for the reply to the next request.
+        start = time.perf_counter()
+        for shard in shards:
+            self.write(shard, message)
+
+        replies = {}
+        errors = []
+        pending = len(shards)
+        with selectors.DefaultSelector() as selector:
+            for shard in shards:
+                selector.register(shard.process.stdout, selectors.EVENT_READ, shard)
+            while pending:
+                for key, events in selector.select():
+                    shard = key.data
+                    chunk = os.read(key.fd, 1 << 16)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        pending -= 1
+                        shard.buffer = b''
+                        errors.append(f'{shard.name} exited with code '
+                                      f'{shard.process.wait()}')
+                        continue
+                    shard.buffer += chunk
+                    if not shard.buffer.endswith(b'\n'):
+                        continue
+                    reply = json.loads(shard.buffer)
+                    shard.buffer = b''
+                    selector.unregister(key.fileobj)
+                    pending -= 1
+                    if 'error' in reply:
+                        errors.append(f"{shard.name}: {reply['error']}")
+                    else:
+                        replies[shard] = (reply, time.perf_counter() - start)
+        if errors:
+            raise WorkerError('\n'.join(errors))
+        return replies
+
+
+if __name__ == '__main__' and sys.argv[1:] == ['--worker']:
+    worker_main(sys.stdin.buffer, sys.stdout.buffer)
+
+elif __name__ == '__main__':
+    import random
+
+    random.seed(0)
+    names = [f'f{i}' for i in range(40)]
+    rules = []
+    for i in range(2000):
+        a, b, c = random.sample(names, 3)
+        rules.append((f'rule-{i}', f'{a} > {random.randint(0, 9)} and '
+                                   f'({b} < {random.randint(0, 9)} or {c} == 3)'))
+    batches = [[{name: random.randint(0, 9) for name in names} for _ in range(20)]
+               for _ in range(10)]
+
+    for workers in [1, 2, 4]:
+        with Coordinator(workers) as coordinator:
+            coordinator.add_many(rules)
+            for batch in batches:
+                coordinator.evaluate(batch)
+            stats = coordinator.stats()
+        print(f"{workers} workers: {stats['facts_per_second']:.0f} facts/s, "
+              f"p50 {stats['latency_p50'] * 1000:.1f} ms, "
+              f"p99 {stats['latency_p99'] * 1000:.1f} ms")
+        for shard in stats['shards']:
+            print(f"  {shard['name']}: {shard['rules']} rules, "
+                  f"{shard['facts_per_second']:.0f} facts/s busy, "
+                  f"p50 {shard['latency_p50'] * 1000:.1f} ms")
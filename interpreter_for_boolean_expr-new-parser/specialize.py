@@ -0,0 +1,254 @@
+
+##########################
+# SPECIALIZE
+##########################
+
+# Partial evaluation: substitutes the identifiers that are known ahead
+# of time (tenant, region, feature flags ...), folds everything that
+# only depends on them and returns the residual expression that is left
+# for the identifiers bound per request.
+#
+# Operands of 'and'/'or' that are not known yet are assumed to be bools,
+# so 'false and x' folds to 'false' without looking at x. Type errors
+# between known values are reported right away.
+
+from interpreter import *
+from expression import Expression
+from render import RenderError, has_literal, number_display, to_source
+
+
+class Specialization:
+    def __init__(self, node, value, nodes_before, nodes_after):
+        # the residual tree, None if the whole expression was decided
+        self.node = node
+        # the Booleen or Number the expression was decided to, else None
+        self.value = value
+        self.nodes_before = nodes_before
+        self.nodes_after = nodes_after
+
+    def is_constant(self):
+        return self.node == None
+
+    def residual(self, fn='<specialized>'):
+        # the residual tree, a literal if the expression was decided
+        if self.node != None:
+            return self.node
+        pos_start = self.value.pos_start or Position(0, 0, 0, fn, '')
+        pos_end = self.value.pos_end or Position(0, 0, 0, fn, '')
+        return constant_node(self.value, pos_start, pos_end)
+
+    def to_source(self):
+        # returns (source, error), a known number like -2 or nan has no
+        # literal in the language and cannot be rendered
+        node = self.residual()
+        for number in number_nodes(node):
+            if not has_literal(number.tok.value):
+                return None, RenderError(
+                    number.pos_start, number.pos_end,
+                    f'{number.tok.value!r} has no literal in the language')
+        return to_source(node), None
+
+    def expression(self, fn='<specialized>'):
+        # compiled residual to cache and evaluate on the hot path, built
+        # from the tree so it also works when to_source() fails
+        node = self.residual(fn)
+        return Expression(fn, to_source(node, number_display), node)
+
+    def expected_speedup(self):
+        # evaluation cost is linear in the visited nodes
+        return self.nodes_before / max(self.nodes_after, 1)
+
+    def __repr__(self):
+        return (f'{to_source(self.residual(), number_display)} ({self.nodes_before} -> '
+                f'{self.nodes_after} nodes, ~{self.expected_speedup():.1f}x)')
+
+
+def count_nodes(node):
+    count = 0
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        count += 1
+        if isinstance(node, BinOpNode):
+            nodes.append(node.left_node)
+            nodes.append(node.right_node)
+        elif isinstance(node, UnaryOpNode):
+            nodes.append(node.node)
+    return count
+
+
+def number_nodes(node):
+    numbers = []
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, NumberNode):
+            numbers.append(node)
+        elif isinstance(node, BinOpNode):
+            nodes.append(node.left_node)
+            nodes.append(node.right_node)
+        elif isinstance(node, UnaryOpNode):
+            nodes.append(node.node)
+    return numbers
+
+
+def constant_node(value, pos_start, pos_end):
+    if isinstance(value, Booleen):
+        return BooleanNode(Token(TT_KEYWORD, value.value, pos_start, pos_end))
+    tok_type = TT_FLOAT if isinstance(value.value, float) else TT_INT
+    return NumberNode(Token(tok_type, value.value, pos_start, pos_end))
+
+
+##########################
+# PARTIAL EVALUATOR
+##########################
+
+# Every visit returns (constant, node, error): constant is a Booleen or
+# Number when the subtree is decided, otherwise node is its residual.
+
+class PartialEvaluator:
+    def visit(self, node, context):
+        method_name = f'visit_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_visit_method)
+        return method(node, context)
+
+    def no_visit_method(self, node, context):
+        raise Exception(f'No visit_{type(node).__name__} method defined')
+
+    def visit_BooleanNode(self, node, context):
+        value = Booleen(node.tok.value).set_context(context)
+        return value.set_pos(node.pos_start, node.pos_end), None, None
+
+    def visit_NumberNode(self, node, context):
+        value = Number(node.tok.value).set_context(context)
+        return value.set_pos(node.pos_start, node.pos_end), None, None
+
+    def visit_VarAccessNode(self, node, context):
+        value = context.symbol_table.get(node.var_name_tok.value)
+        if value == None:
+            return None, node, None
+        value = value.copy().set_context(context)
+        return value.set_pos(node.pos_start, node.pos_end), None, None
+
+    def visit_UnaryOpNode(self, node, context):
+        value, residual, error = self.visit(node.node, context)
+        if error:
+            return None, None, error
+
+        if value != None:
+            value, error = value.reverse()
+            if error:
+                return None, None, error
+            return value.set_pos(node.pos_start, node.pos_end), None, None
+
+        # !!x is x only if x is a Booleen, '!' rejects numbers and the
+        # type of an identifier is not known yet. Comparisons and
+        # 'and'/'or' always give a Booleen.
+        if isinstance(residual, UnaryOpNode) and isinstance(residual.node, BinOpNode):
+            return None, residual.node, None
+        return None, UnaryOpNode(node.op_tok, residual), None
+
+    def visit_BinOpNode(self, node, context):
+        # long chains nest on the left, the left spine is walked in a loop
+        spine = left_spine(node)
+        left, left_node, error = self.visit(spine[-1].left_node, context)
+        for node in reversed(spine):
+            if error:
+                break
+            left, left_node, error = self.combine(node, left, left_node, context)
+        return left, left_node, error
+
+    def combine(self, node, left, left_node, context):
+        # node with its left operand visited already
+        right, right_node, error = self.visit(node.right_node, context)
+        if error:
+            return None, None, error
+
+        if left != None and right != None:
+            result, error = apply_op(node.op_tok, left, right)
+            if error:
+                return None, None, error
+            return result.set_pos(node.pos_start, node.pos_end), None, None
+
+        if node.op_tok.type == TT_KEYWORD:
+            known = left if left != None else right
+            residual = right_node if left != None else left_node
+            if known != None:
+                if not isinstance(known, Booleen):
+                    # a number in 'and'/'or' fails for any other operand,
+                    # the unknown one stands in as a bool for the message
+                    unknown = Booleen('TRUE').set_context(context)
+                    if left != None:
+                        result, error = apply_op(node.op_tok, left, unknown)
+                    else:
+                        result, error = apply_op(node.op_tok, unknown, right)
+                    return None, None, error
+                # 'true and x' is x, 'false or x' is x
+                is_and = node.op_tok.matches(TT_KEYWORD, 'AND')
+                if (known.value == 'TRUE') == is_and:
+                    return None, residual, None
+                return known.copy().set_pos(node.pos_start, node.pos_end), None, None
+
+        if left != None:
+            left_node = constant_node(left, left.pos_start, left.pos_end)
+        if right != None:
+            right_node = constant_node(right, right.pos_start, right.pos_end)
+        return None, BinOpNode(left_node, node.op_tok, right_node), None
+
+
+def apply_op(op_tok, left, right):
+    if op_tok.matches(TT_KEYWORD, 'AND'):
+        return left.and_to(right)
+    if op_tok.matches(TT_KEYWORD, 'OR'):
+        return left.or_to(right)
+    if op_tok.type == TT_EE:
+        return left.double_equal(right)
+    if op_tok.type == TT_NE:
+        return left.not_equal(right)
+    if op_tok.type == TT_LT:
+        return left.less_than(right)
+    if op_tok.type == TT_LTE:
+        return left.less_equal_than(right)
+    if op_tok.type == TT_GT:
+        return left.greater_than(right)
+    return left.greater_equal_than(right)
+
+
+def specialize(expr, known_bindings):
+    # expr is a compiled Expression, returns (Specialization, error)
+    context = Context('<specialize>')
+    context.symbol_table = SymbolTable()
+    context.symbol_table.update(known_bindings)
+
+    value, node, error = PartialEvaluator().visit(expr.node, context)
+    if error:
+        return None, error
+
+    nodes_after = count_nodes(node) if node != None else 1
+    return Specialization(node, value, count_nodes(expr.node), nodes_after), None
+
+
+if __name__ == '__main__':
+    import time
+    import expression
+
+    text = ('((tenant == 7 and region == 3) or (beta and region == 4)) and '
+            '(premium or (tenant != 7 and !beta)) and amount > 100 and active')
+    expr, error = expression.compile(text)
+    result, error = specialize(expr, {'tenant': 7, 'region': 3,
+                                      'beta': False, 'premium': True})
+    print(result)
+
+    residual = result.expression()
+    runs = 20000
+    bindings = {'tenant': 7, 'region': 3, 'beta': False, 'premium': True,
+                'amount': 150, 'active': True}
+    start = time.perf_counter()
+    for _ in range(runs):
+        expr.evaluate(bindings)
+    full = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(runs):
+        residual.evaluate({'amount': 150, 'active': True})
+    partial = time.perf_counter() - start
+    print(f'measured speedup {full / partial:.1f}x')
@@ -1,11 +1,59 @@
+import sys
 import interpreter
 
 
-while True:
-    text = input('boo > ')
-    result, error = interpreter.run('<stdin>', text)
+# read expressions from a pipe until EOF, one result line per expression
+# errors go to stderr and the exit code is 1 if any expression failed
+def run_batch(stdin, stdout, stderr):
+    exit_code = 0
 
+    for line_number, text in enumerate(stdin, 1):
+        text = text.rstrip('\r\n')
+        if not text.strip():
+            continue
+
+        result, error = interpreter.run(f'<stdin:{line_number}>', text)
+        if error:
+            stdout.write('ERROR\n')
+            stderr.write(error.as_string() + '\n')
+            exit_code = 1
+        else:
+            stdout.write(f'{result}\n')
+
+    stdout.flush()
+    return exit_code
+
+
+# run a script file, one result line per statement
+def run_script(path, stdout, stderr):
+    values, error = interpreter.run_file(path)
     if error:
-        print(error.as_string())
-    else:
-        print(result)
+        stderr.write(error.as_string() + '\n')
+        return 1
+
+    for value in values:
+        stdout.write(f'{value}\n')
+    stdout.flush()
+    return 0
+
+
+def run_interactive():
+    while True:
+        text = input('boo > ')
+        result, error = interpreter.run('<stdin>', text)
+
+        if error:
+            print(error.as_string())
+        else:
+            print(result)
+
+
+if __name__ == '__main__':
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if paths:
+        sys.exit(max(run_script(path, sys.stdout, sys.stderr) for path in paths))
+    if '--batch' in sys.argv[1:] or not sys.stdin.isatty():
+        stdout = open(sys.stdout.fileno(), 'w', buffering=1 << 16,
+                      closefd=False)
+        sys.exit(run_batch(sys.stdin, stdout, sys.stderr))
+    run_interactive()
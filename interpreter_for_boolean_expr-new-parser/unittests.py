@@ -1,5 +1,35 @@
+import asyncio
+import io
+import os
+import tempfile
 import unittest
 from interpreter import *
+from terminal import run_batch, run_script
+import expression
+import itertools
+import threading
+import time
+import weakref
+from minimize import minimize_text
+from render import to_source
+import random
+import sat
+import canonical
+from specialize import specialize
+import json
+from profiler import Profile
+from cache import ResultCache, fact_context
+from adaptive import AdaptiveExpression
+from intervals import prune_text
+from sharding import Coordinator, HashRing, Worker, WorkerError, rule_key
+from lazy import ADAPTIVE_WARMUP, FactCache, LazyEvaluator
+
+try:
+    import numpy as np
+    from vectorized import *
+    from bitmap_index import BitmapIndex, Bitmap
+except ImportError:
+    np = None
 
 
 # unittests for boolean interpreter
@@ -110,6 +140,789 @@ class TestBooInterpreter(unittest.TestCase):
                 self.assertTrue(self.result)
 
 
+class TestCompiledExpression(unittest.TestCase):
+
+    def test_evaluate(self):
+        expr, error = expression.compile('a and !b or x > 3')
+        self.assertIsNone(error)
+        self.assertEqual(expr.identifiers, {'A', 'B', 'X'})
+
+        result, error = expr.evaluate({'a': True, 'b': True, 'x': 5})
+        self.assertEqual(result.value, 'TRUE')
+        result, error = expr.evaluate({'a': True, 'b': True, 'x': 1})
+        self.assertEqual(result.value, 'FALSE')
+        result, error = expr.evaluate({'a': True})
+        self.assertEqual(error.details, "'B' is not defined")
+
+    def test_immutable(self):
+        expr, error = expression.compile('!true')
+        with self.assertRaises(AttributeError):
+            expr.node = None
+        # negation must not change the tree or the values it was built from
+        self.assertEqual(expr.evaluate()[0].value, 'FALSE')
+        self.assertEqual(expr.evaluate()[0].value, 'FALSE')
+
+    def test_syntax_error(self):
+        expr, error = expression.compile('true and')
+        self.assertIsNone(expr)
+        self.assertEqual(error.error_name, 'Invalid Syntax')
+
+    def test_shared_between_threads(self):
+        expr, error = expression.compile('x > 10 and !flag')
+        failures = []
+
+        def worker(offset):
+            for i in range(500):
+                x = (i + offset) % 20
+                flag = i % 3 == 0
+                result, error = expr.evaluate({'x': x, 'flag': flag})
+                expected = 'TRUE' if x > 10 and not flag else 'FALSE'
+                if error or result.value != expected:
+                    failures.append((x, flag))
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+
+
+class TestMinimize(unittest.TestCase):
+
+    # compare both expressions on every assignment of the identifiers
+    def assert_equivalent(self, text, other):
+        expr, error = expression.compile(text)
+        other_expr, error = expression.compile(other)
+        self.assertIsNone(error)
+        names = sorted(expr.identifiers)
+        for values in itertools.product([True, False], repeat=len(names)):
+            bindings = dict(zip(names, values))
+            self.assertEqual(expr.evaluate(bindings)[0].value,
+                             other_expr.evaluate(bindings)[0].value)
+
+    def test_exact(self):
+        text = '(a and b) or (a and b and c) or (!a and b) or (b and d)'
+        result, error = minimize_text(text)
+        self.assertEqual(result.text, 'b')
+        self.assertEqual(result.method, 'exact')
+        self.assertEqual((result.literals_before, result.literals_after), (9, 1))
+
+        result, error = minimize_text('(a or b) and (a or c) and (a or !b or c)')
+        self.assertEqual(result.text, 'a or (b and c)')
+        self.assert_equivalent('(a or b) and (a or c) and (a or !b or c)',
+                               result.text)
+
+    def test_heuristic(self):
+        text = '(a and b) or (a and !b) or (c and !!d) or (c and d and e) or !(x or !x)'
+        result, error = minimize_text(text, exact_limit=0)
+        self.assertEqual(result.method, 'heuristic')
+        self.assertEqual(result.literals_after, 3)
+        self.assert_equivalent(text, result.text)
+
+    def test_constants_and_comparisons(self):
+        result, error = minimize_text('x or !x')
+        self.assertEqual(result.text, 'true')
+        result, error = minimize_text('n > 3 and !(n > 3) or false')
+        self.assertEqual(result.text, 'false')
+        result, error = minimize_text('(n > 3 and a) or (n > 3 and !a)')
+        self.assertEqual(result.text, 'n > 3')
+
+    def test_render_round_trip(self):
+        for text in ['a or (b and c)', '!(a and b) or c == true',
+                     'a == (b == c)', '1 < 2 == 3 >= 2.5', '!!a']:
+            expr, error = expression.compile(text)
+            self.assertEqual(to_source(expr.node), text)
+
+
+class TestSat(unittest.TestCase):
+
+    def parse(self, text):
+        expr, error = expression.compile(text)
+        return expr.node
+
+    def test_satisfiable(self):
+        node = self.parse('(a or b) and !a and (!b or c) and true')
+        status, bindings = sat.satisfiable(node)
+        self.assertEqual(status, sat.SAT)
+        self.assertEqual(bindings, {'A': False, 'B': True, 'C': True})
+        self.assertEqual(sat.check(node, bindings), (True, None))
+
+        status, bindings = sat.satisfiable(self.parse('a and !(a or b)'))
+        self.assertEqual(status, sat.UNSAT)
+        self.assertIsNone(bindings)
+
+    def test_implies(self):
+        a = self.parse('(x and y) and z')
+        b = self.parse('x or w')
+        self.assertEqual(sat.implies(a, b), (True, None))
+        holds, counterexample = sat.implies(b, a)
+        self.assertIs(holds, False)
+        self.assertEqual(sat.check(b, counterexample), (True, None))
+        self.assertEqual(sat.check(a, counterexample), (False, None))
+
+        pigeons = ' and '.join(f'(p{p}h0 or p{p}h1)' for p in range(3))
+        holes = ' and '.join(f'!(p{p}h{h} and p{q}h{h})' for h in range(2)
+                             for p in range(3) for q in range(p + 1, 3))
+        holds, counterexample = sat.implies(self.parse(f'{pigeons} and {holes}'),
+                                            self.parse('false'), max_conflicts=0)
+        self.assertEqual((holds, counterexample), (sat.UNKNOWN, None))
+
+    def test_random_cnf(self):
+        # compare with brute force on small random 3-CNF
+        rng = random.Random(7)
+        for _ in range(100):
+            count = rng.randint(3, 7)
+            clauses = []
+            for _ in range(rng.randint(5, 35)):
+                clause = rng.sample(range(1, count + 1), 3)
+                clauses.append([v if rng.random() < 0.5 else -v
+                                for v in clause])
+            expected = any(
+                all(any(values[abs(l) - 1] == (l > 0) for l in clause)
+                    for clause in clauses)
+                for values in itertools.product([True, False], repeat=count))
+            result = sat.Solver(count, clauses).solve()
+            self.assertEqual(result.status == sat.SAT, expected)
+
+    def test_conflict_budget(self):
+        # pigeonhole: 6 pigeons in 5 holes needs many conflicts
+        clauses = []
+        var = lambda p, h: p * 5 + h + 1
+        for p in range(6):
+            clauses.append([var(p, h) for h in range(5)])
+        for h in range(5):
+            for p in range(6):
+                for q in range(p + 1, 6):
+                    clauses.append([-var(p, h), -var(q, h)])
+        result = sat.Solver(30, clauses).solve(max_conflicts=10)
+        self.assertEqual(result.status, sat.UNKNOWN)
+        result = sat.Solver(30, clauses).solve()
+        self.assertEqual(result.status, sat.UNSAT)
+
+    def test_dimacs(self):
+        cnf = sat.tseitin(self.parse('a and (b or !c)'))
+        self.assertEqual(cnf.to_dimacs(),
+                         'c 1 a\nc 2 b\nc 3 c\np cnf 3 2\n1 0\n2 -3 0\n')
+
+
+class TestCanonical(unittest.TestCase):
+
+    def canonical_text(self, text):
+        node, error = canonical.parse(text)
+        return canonical.to_text(canonical.canonicalize(node))
+
+    def test_same_logic_same_hash(self):
+        variants = ['a and (x > 3) and b', 'b and a and 3 < x',
+                    '(b and !!a) and true and x > 3', 'a and (b and x > 3.0)']
+        hashes = set(canonical.canonical_hash(text)[0] for text in variants)
+        self.assertEqual(len(hashes), 1)
+        self.assertEqual(self.canonical_text(variants[0]), '3 < x and a and b')
+
+    def test_different_logic_different_hash(self):
+        self.assertNotEqual(canonical.canonical_hash('a and b')[0],
+                            canonical.canonical_hash('a or b')[0])
+        self.assertNotEqual(canonical.canonical_hash('x < 3')[0],
+                            canonical.canonical_hash('3 < x')[0])
+
+    def test_folding(self):
+        self.assertEqual(self.canonical_text('a and false or b'), 'b')
+        self.assertEqual(self.canonical_text('!!!a or false'), '!a')
+        self.assertEqual(self.canonical_text('true == (x >= 1)'), '1 <= x == true')
+
+    def test_canonical_node_is_equivalent(self):
+        text = '(!(b or a) or c) and x >= 2'
+        node, error = canonical.parse(text)
+        expr, error = expression.compile(text)
+        for a, b, c, x in itertools.product([True, False], [True, False],
+                                            [True, False], [1, 2, 3]):
+            bindings = {'a': a, 'b': b, 'c': c, 'x': x}
+            result, error = sat.check(canonical.canonical_node(node), bindings)
+            self.assertEqual(result, expr.evaluate(bindings)[0].value == 'TRUE')
+
+    def test_group_by_canonical_hash(self):
+        items = [(1, 'a and b'), (2, 'b and a'), (3, 'a or b'),
+                 (4, 'true and (b and a)'), (5, 'a and'), (6, 'b or a')]
+        errors = []
+        groups = canonical.group_by_canonical_hash(
+            items, partitions=4, on_error=lambda i, e: errors.append(i))
+        self.assertEqual(sorted(sorted(ids) for digest, ids in groups),
+                         [[1, 2, 4], [3, 6]])
+        self.assertEqual(errors, [5])
+
+    def test_alternating_chain(self):
+        # nests once per operator change, within the default max_depth
+        names = [f'v{i}' for i in range(250)]
+        text = names[0] + ''.join(f' {op} {name}' for op, name in
+                                  zip(itertools.cycle(['or', 'and']), names[1:]))
+        digest, error = canonical.canonical_hash(text)
+        self.assertIsNone(error)
+        self.assertEqual(canonical.canonical_hash('true and ' + text)[0], digest)
+        self.assertTrue(self.canonical_text(text).endswith(') and v248) or v249'))
+
+        # an item that raises goes to on_error and the rest is grouped
+        errors = []
+        groups = canonical.group_by_canonical_hash(
+            [(1, text), (2, None), (3, 'true and ' + text)], partitions=2,
+            on_error=lambda i, e: errors.append((i, type(e))))
+        self.assertEqual([ids for digest, ids in groups], [[1, 3]])
+        self.assertEqual(errors, [(2, TypeError)])
+
+
+class TestSpecialize(unittest.TestCase):
+
+    def test_residual(self):
+        expr, error = expression.compile(
+            '((tenant == 7 and region == 3) or beta) and amount > 100 and !!active')
+        result, error = specialize(expr, {'tenant': 7, 'region': 3})
+        self.assertFalse(result.is_constant())
+        self.assertEqual(result.to_source(), ('amount > 100 and !!active', None))
+        self.assertEqual((result.nodes_before, result.nodes_after), (17, 7))
+        self.assertGreater(result.expected_speedup(), 2)
+
+        residual = result.expression()
+        for amount, active in itertools.product([50, 150], [True, False]):
+            bindings = {'tenant': 7, 'region': 3, 'beta': False,
+                        'amount': amount, 'active': active}
+            self.assertEqual(
+                residual.evaluate({'amount': amount, 'active': active})[0].value,
+                expr.evaluate(bindings)[0].value)
+
+    def test_constant(self):
+        expr, error = expression.compile('flag and x > 3 or region == 2')
+        result, error = specialize(expr, {'flag': False, 'region': 2})
+        self.assertTrue(result.is_constant())
+        self.assertEqual(result.to_source(), ('true', None))
+        self.assertEqual(result.expression().evaluate()[0].value, 'TRUE')
+
+    def test_double_negation(self):
+        # '!' rejects numbers, so '!!x' only folds if x is known to be a bool
+        expr, error = expression.compile('!!x')
+        result, error = specialize(expr, {})
+        self.assertEqual(result.to_source(), ('!!x', None))
+        value, error = result.expression().evaluate({'x': 5})
+        self.assertEqual(error.details, "Negation of 'int/float'")
+
+        expr, error = expression.compile('!!(x > 1) and !!y')
+        result, error = specialize(expr, {'y': True})
+        self.assertEqual(result.to_source(), ('x > 1', None))
+
+    def test_comparison_keeps_known_side(self):
+        expr, error = expression.compile('x < limit')
+        result, error = specialize(expr, {'limit': 2.5})
+        self.assertEqual(result.to_source(), ('x < 2.5', None))
+
+    def test_constant_without_literal(self):
+        # the lexer has no signs, so -2 and nan cannot be rendered
+        expr, error = expression.compile('x < limit')
+        for limit in (-2, float('nan')):
+            result, error = specialize(expr, {'limit': limit})
+            source, error = result.to_source()
+            self.assertIsNone(source)
+            self.assertEqual(error.details, f'{limit!r} has no literal in the language')
+            self.assertEqual(error.pos_start.idx, 4)
+
+            residual = result.expression()
+            self.assertEqual(residual.text, f'x < {limit!r}')
+            self.assertEqual(residual.evaluate({'x': -3})[0].value,
+                             expr.evaluate({'x': -3, 'limit': limit})[0].value)
+
+        result, error = specialize(expression.compile('limit')[0], {'limit': -2})
+        self.assertEqual(str(result.expression().evaluate()[0]), '-2')
+
+    def test_type_error(self):
+        expr, error = expression.compile('tenant and x')
+        result, error = specialize(expr, {'tenant': 7})
+        self.assertIsNone(result)
+        self.assertEqual(error.details, "Logical operation on 'int/float' and 'bool'")
+
+
+class TestProfiler(unittest.TestCase):
+
+    def set_up(self):
+        expr, error = expression.compile('(x > 3 or true) and flag')
+        self.profile = Profile(expr)
+        for x, flag in [(1, True), (5, True), (1, False), (9, True)]:
+            self.profile.evaluate({'x': x, 'flag': flag})
+        return self
+
+    def stats(self, source):
+        for stats in self.profile.stats.values():
+            if stats.source() == source:
+                return stats
+
+    def test_counts_and_outcomes(self):
+        self.set_up()
+        comparison = self.stats('x > 3')
+        self.assertEqual(comparison.count, 4)
+        self.assertEqual(comparison.outcomes['true'], 2)
+        self.assertEqual(comparison.outcomes['false'], 2)
+        self.assertGreater(comparison.total_time, 0)
+        self.assertEqual(self.stats('3').outcomes['value'], 4)
+
+    def test_never_decisive(self):
+        self.set_up()
+        # 'true' makes the 'or' true no matter what x > 3 is
+        self.assertTrue(self.stats('x > 3').never_decisive())
+        self.assertFalse(self.stats('flag').never_decisive())
+        self.assertEqual(self.stats('flag').decisive, 4)
+
+    def test_errors(self):
+        expr, error = expression.compile('x and true')
+        profile = Profile(expr)
+        value, error = profile.evaluate({'x': 1})
+        self.assertEqual(error.details, "Logical operation on 'int/float' and 'bool'")
+        self.assertEqual(self.set_up().profile.evaluations, 4)
+        root = profile.stats[(0, len('x and true'))]
+        self.assertEqual(root.outcomes['error'], 1)
+
+    def test_exports(self):
+        self.set_up()
+        data = json.loads(self.profile.to_json())
+        self.assertEqual(data['evaluations'], 4)
+        self.assertEqual(len(data['nodes']), 7)
+
+        collapsed = self.profile.collapsed().splitlines()
+        self.assertIn('(x > 3 or true) and flag;x > 3 or true;x > 3;x',
+                      [line.rsplit(' ', 1)[0] for line in collapsed])
+        self.assertIn('x > 3', self.profile.annotate())
+
+
+class TestLimits(unittest.TestCase):
+
+    def test_default_limits(self):
+        result, error = run('stdin', '(' * 60 + 'true' + ')' * 60)
+        self.assertIsInstance(error, LimitExceededError)
+        self.assertEqual(error.details, 'Nesting deeper than 50')
+        self.assertEqual(error.pos_start.idx, 50)
+
+        result, error = run('stdin', '!' * 100000 + 'true')
+        self.assertEqual(error.details, 'Nesting deeper than 50')
+
+    def test_long_chains(self):
+        # chains are walked in a loop and count as one level of depth
+        names = [f'v{i}' for i in range(2000)]
+        bindings = {name: True for name in names}
+        result, error = run('stdin', ' and '.join(names), bindings)
+        self.assertEqual(result.value, 'TRUE')
+        result, error = run('stdin', ' or '.join(f'x > {i}' for i in range(500))
+                            + ' and !a', {'x': 0, 'a': False})
+        self.assertEqual(result.value, 'FALSE')
+
+        expr, error = expression.compile(' and '.join(names))
+        self.assertEqual(expr.node.depth, 2)
+        self.assertEqual(to_source(expr.node), ' and '.join(names))
+        result, error = specialize(expr, {'v0': True})
+        self.assertEqual(result.nodes_after, 2 * len(names) - 3)
+
+        # a change of operator is a level of its own
+        text = ' '.join(f'and {name} or {name}' for name in names[:200])[4:]
+        result, error = run('stdin', text, bindings)
+        self.assertEqual(error.details, 'Expression deeper than 300')
+
+        # errors still point at the failing operand
+        text = ' and '.join(names[:400]) + ' and 5'
+        result, error = run('stdin', text, bindings)
+        self.assertEqual(error.details, "Logical operation on 'bool' and 'int/float'")
+        self.assertEqual(error.pos_start.idx, len(text) - 1)
+
+        # the profiler records the inner nodes of the chain as if nested
+        profile = Profile(expression.compile('a and b or c and d')[0])
+        self.assertEqual(profile.evaluate({'a': True, 'b': False, 'c': True,
+                                           'd': True})[0].value, 'TRUE')
+        self.assertEqual(len(profile.stats), 7)
+        self.assertIn('a and b or c and d;a and b or c;a and b;a',
+                      [line.rsplit(' ', 1)[0]
+                       for line in profile.collapsed().splitlines()])
+        inner = profile.stats[(0, len('a and b'))]
+        self.assertEqual((inner.operand, inner.decisive), (1, 0))
+        inner = profile.stats[(0, len('a and b or c'))]
+        self.assertEqual((inner.operand, inner.decisive), (1, 1))
+
+    def test_custom_limits(self):
+        limits = Limits(max_bytes=10)
+        result, error = run('stdin', 'true and false', limits=limits)
+        self.assertEqual(error.error_name, 'Limit Exceeded')
+        self.assertEqual(error.pos_start.idx, 10)
+
+        result, error = run('stdin', 'a or b or c', limits=Limits(max_tokens=4))
+        self.assertEqual(error.details, 'More than 4 tokens')
+
+        result, error = run('stdin', 'a or b or c', limits=Limits(max_nodes=3))
+        self.assertEqual(error.details, 'More than 3 nodes')
+
+        result, error = run('stdin', 'a and a and a', {'a': True},
+                            limits=Limits(max_steps=3))
+        self.assertEqual(error.details, 'More than 3 evaluation steps')
+
+        result, error = run('stdin', 'a and a and a', {'a': True},
+                            limits=Limits(max_steps=5))
+        self.assertIsNone(error)
+
+        limits = Limits(max_depth=5)
+        result, error = run('stdin', 'a and (a and (a and (a and (a and a))))',
+                            {'a': True}, limits=limits)
+        self.assertEqual(error.details, 'Expression deeper than 5')
+        result, error = run('stdin', 'a and ' * 20 + 'a', {'a': True}, limits=limits)
+        self.assertEqual(result.value, 'TRUE')
+
+    def test_timeout(self):
+        limits = Limits(timeout=0, max_tokens=None)
+        result, error = run('stdin', 'true and ' * 1000 + 'true', limits=limits)
+        self.assertEqual(error.details, 'Tokenizing took too long')
+
+    def test_compiled_expression(self):
+        expr, error = expression.compile('x > 1 and x < 5',
+                                         limits=Limits(max_nodes=5))
+        self.assertEqual(error.details, 'More than 5 nodes')
+        expr, error = expression.compile('x > 1 and x < 5')
+        value, error = expr.evaluate({'x': 3}, limits=Limits(max_steps=2))
+        self.assertEqual(error.details, 'More than 2 evaluation steps')
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_hits_and_invalidation(self):
+        expr, error = expression.compile('age >= 18 and !banned')
+        context = fact_context({'age': 30, 'banned': False, 'clicks': 0})
+        cache = ResultCache()
+
+        value, error = cache.evaluate(expr, context)
+        self.assertEqual(value.value, 'TRUE')
+        # a fact the expression does not read
+        context.set_fact('clicks', 1)
+        value, error = cache.evaluate(expr, context)
+        self.assertEqual(value.value, 'TRUE')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        context.set_fact('age', 12)
+        value, error = cache.evaluate(expr, context)
+        self.assertEqual(value.value, 'FALSE')
+        self.assertEqual(cache.invalidations, 1)
+
+        # same values again are served from the cache
+        context.set_fact('age', 30)
+        value, error = cache.evaluate(expr, context)
+        self.assertEqual(value.value, 'TRUE')
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+        context.remove_fact('banned')
+        value, error = cache.evaluate(expr, context)
+        self.assertEqual(error.details, "'BANNED' is not defined")
+
+    def test_shared_between_contexts(self):
+        expr, error = expression.compile('x > 1')
+        cache = ResultCache()
+        cache.evaluate(expr, fact_context({'x': 2}))
+        value, error = cache.evaluate(expr, fact_context({'x': 2}))
+        self.assertEqual(cache.hits, 1)
+        # 2 and 2.0 are different keys
+        value, error = cache.evaluate(expr, fact_context({'x': 2.0}))
+        self.assertEqual(cache.hits, 1)
+
+        expr, error = expression.compile('x')
+        self.assertEqual(str(cache.evaluate(expr, fact_context({'x': 2}))[0]), '2')
+        self.assertEqual(str(cache.evaluate(expr, fact_context({'x': 2.0}))[0]), '2.0')
+
+    def test_errors_and_eviction(self):
+        cache = ResultCache(maxsize=2)
+        expr, error = expression.compile('x and true')
+        value, error = cache.evaluate(expr, fact_context({'x': 1}))
+        self.assertEqual(error.details, "Logical operation on 'int/float' and 'bool'")
+        value, error = cache.evaluate(expr, fact_context({'x': 1}))
+        self.assertEqual(error.details, "Logical operation on 'int/float' and 'bool'")
+        self.assertEqual(cache.hits, 1)
+
+        for x in (True, False):
+            cache.evaluate(expr, fact_context({'x': x}))
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertEqual(cache.evictions, 1)
+
+        # limit errors depend on the budget and are not cached
+        cache = ResultCache(limits=Limits(max_steps=1))
+        for i in range(2):
+            value, error = cache.evaluate(expr, fact_context({'x': True}))
+            self.assertIsInstance(error, LimitExceededError)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_facts_changing_while_evaluating(self):
+        expr, error = expression.compile('x > 5')
+        context = fact_context({'x': 0})
+        cache = ResultCache()
+
+        class Interrupted(Interpreter):
+            # another thread changes x after the key was built
+            def visit(self, node, own=None):
+                writer = threading.Thread(target=context.set_fact, args=('x', 10))
+                writer.start()
+                writer.join()
+                return super().visit(node, own)
+
+        cache.interpreter = Interrupted()
+        value, error = cache.evaluate(expr, context)
+        self.assertEqual(value.value, 'FALSE')
+        cache.interpreter = Interpreter()
+
+        # the entry of x = 0 must not hold the result of x = 10
+        context.set_fact('x', 0)
+        self.assertEqual(cache.evaluate(expr, context)[0].value, 'FALSE')
+        context.set_fact('x', 10)
+        self.assertEqual(cache.evaluate(expr, context)[0].value, 'TRUE')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_contexts_are_not_kept(self):
+        expr, error = expression.compile('x and true')
+        cache = ResultCache(maxsize=2)
+        context = fact_context({'x': 1})
+        governor = context.governor = Governor(Limits(max_steps=1))
+        value, error = cache.evaluate(expr, context)
+        # evaluated with the cache's limits, the caller's governor is untouched
+        self.assertEqual(error.details, "Logical operation on 'int/float' and 'bool'")
+        self.assertIs(error.context, context)
+        self.assertIs(context.governor, governor)
+        self.assertEqual(governor.steps, 0)
+
+        # the cached error is handed out with the caller's context
+        other = fact_context({'x': 1})
+        value, error = cache.evaluate(expr, other)
+        self.assertEqual(cache.hits, 1)
+        self.assertIs(error.context, other)
+
+        dead = weakref.ref(context)
+        del context, governor, value, error
+        self.assertIsNone(dead())
+
+        # the keys remembered per context are bounded too
+        contexts = [fact_context({'x': True}) for i in range(5)]
+        for context in contexts:
+            cache.evaluate(expr, context)
+        self.assertEqual(len(cache.keys), 2)
+
+
+class TestAdaptive(unittest.TestCase):
+
+    def test_same_results_as_interpreter(self):
+        expr, error = expression.compile('(a or b) and x > 3 and !c or x == b')
+        adaptive = AdaptiveExpression(expr, interval=7)
+        random.seed(3)
+        choices = [True, False, 0, 5, 2.5, None]
+        for i in range(300):
+            bindings = {name: random.choice(choices) for name in 'abcx'}
+            bindings = {k: v for k, v in bindings.items() if v != None}
+            value, error = expr.evaluate(bindings)
+            adaptive_value, adaptive_error = adaptive.evaluate(bindings)
+            self.assertEqual(str(adaptive_value), str(value))
+            self.assertEqual(adaptive_error and adaptive_error.as_string(),
+                             error and error.as_string())
+        self.assertGreater(adaptive.fallbacks, 0)
+        self.assertLess(adaptive.fallbacks, 300)
+
+    def test_reorder_and_persist(self):
+        expr, error = expression.compile('a > 1 and b > 1 and flag')
+        adaptive = AdaptiveExpression(expr, interval=50)
+        for i in range(100):
+            adaptive.evaluate({'a': 5, 'b': 5, 'flag': i % 10 == 0})
+        order = [operand['source'] for operand in adaptive.decisions()[0]['order']]
+        self.assertEqual(order[0], 'flag')
+        self.assertEqual(adaptive.reorders, 2)
+
+        restored = AdaptiveExpression(expr)
+        restored.load_json(adaptive.to_json())
+        self.assertEqual(restored.decisions(), adaptive.decisions())
+        value, error = restored.evaluate({'a': 5, 'b': 5, 'flag': False})
+        self.assertEqual(value.value, 'FALSE')
+        # short-circuited after the first operand
+        self.assertEqual(restored.visited, 2)
+
+    def test_operand_source(self):
+        # spans of negated and parenthesized operands keep their ')'
+        expr, error = expression.compile('!(h > 5 and i > 5) and (a or b) and c')
+        adaptive = AdaptiveExpression(expr)
+        adaptive.evaluate({'h': 1, 'i': 1, 'a': True, 'b': True, 'c': True})
+        chain = adaptive.decisions()[0]
+        self.assertEqual(chain['source'], '!(h > 5 and i > 5) and (a or b) and c')
+        self.assertEqual(sorted(operand['source'] for operand in chain['order']),
+                         ['!(h > 5 and i > 5)', 'a or b', 'c'])
+
+
+class TestIntervals(unittest.TestCase):
+
+    def test_pruning(self):
+        for text, expected, removed in [
+                ('x < 5 and x > 10', 'false', ['x < 5', 'x > 10']),
+                ('x < 5 and x < 7 and y', 'x < 5 and y', ['x < 7']),
+                ('x < 5 or 7 > x', '7 > x', ['x < 5']),
+                ('x > 1 and x < 2', 'x > 1 and x < 2', []),
+                ('x < 5 or x >= 5', 'x < 5 or x >= 5', []),
+                ('x == 1 and x != 1.0', 'false', ['x == 1', 'x != 1.0']),
+                ('x >= 3 and (x < 2 or y) and !(x < 1)', 'x >= 3 and y',
+                 ['x < 2', 'x < 1']),
+                ('1 < 2 and y', 'y', ['1 < 2'])]:
+            result, error = prune_text(text)
+            self.assertEqual(result.to_source(), expected)
+            self.assertEqual([removal.source() for removal in result.removed],
+                             removed)
+
+        result, error = prune_text('x < 5 and x < 7')
+        self.assertEqual(result.removed[0].reason, 'implied')
+        self.assertEqual(result.removed[0].value, True)
+
+    def test_same_results(self):
+        random.seed(11)
+        literals = ['1', '1.0', '1.5', '2', '5']
+        values = [0, 1, 1.0, 1.5, 2, 3, 5, 5.5, float('nan')]
+        ops = ['<', '<=', '>', '>=', '==', '!=']
+
+        def comparison():
+            name = random.choice(['x', 'y'])
+            literal = random.choice(literals)
+            op = random.choice(ops)
+            if random.random() < 0.3:
+                return f'{literal} {op} {name}'
+            return f'{name} {op} {literal}'
+
+        def generate(depth):
+            if depth == 0 or random.random() < 0.3:
+                text = comparison()
+                return f'!({text})' if random.random() < 0.2 else text
+            op = random.choice([' and ', ' or '])
+            return '(' + op.join(generate(depth - 1)
+                                 for _ in range(random.randint(2, 3))) + ')'
+
+        for i in range(80):
+            text = generate(3)
+            result, error = prune_text(text)
+            pruned = to_source(result.node)
+            for x, y in itertools.product(values, repeat=2):
+                expected, error = run('<test>', text, {'x': x, 'y': y})
+                value, error = run('<test>', pruned, {'x': x, 'y': y})
+                self.assertEqual(value.value, expected.value, (text, pruned, x, y))
+
+
+class TestScripts(unittest.TestCase):
+    script = ('# shared definitions\n'
+              'VAR eligible = adult and !banned\n'
+              'VAR adult = age >= 18\n'
+              '\n'
+              'eligible and score > 5\n'
+              'eligible or vip; VAR vip = score > 9\n')
+
+    def test_run_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rules.boo')
+            with open(path, 'w') as file:
+                file.write(self.script)
+            values, error = run_file(path, {'age': 20, 'banned': False, 'score': 7})
+            self.assertEqual([value.value for value in values],
+                             ['TRUE', 'TRUE', 'TRUE', 'TRUE', 'FALSE'])
+
+            stdout, stderr = io.StringIO(), io.StringIO()
+            self.assertEqual(run_script(path, stdout, stderr), 1)
+            self.assertIn("'AGE' is not defined", stderr.getvalue())
+
+    def test_traceback(self):
+        script, error = compile_script('<rules>', self.script)
+        values, error = script.evaluate({'age': 20, 'banned': 3, 'score': 7})
+        self.assertEqual(error.details, "Negation of 'int/float'")
+        self.assertEqual(error.generate_traceback(),
+                         'Traceback (most recent call last):\n'
+                         '  File <rules>, line 2, in <program>\n'
+                         '  File <rules>, line 2, in ELIGIBLE\n')
+
+    def test_definitions_evaluated_once(self):
+        text = 'VAR a = x and x and x\na\na or a\n!a'
+        # 1 assignment + 5 nodes for the definition + 1 + 3 + 2 for the rest
+        values, error = run('<t>', text, {'x': True}, Limits(max_steps=12))
+        self.assertEqual(values.value, 'FALSE')
+        values, error = run('<t>', text, {'x': True}, Limits(max_steps=11))
+        self.assertIsInstance(error, LimitExceededError)
+
+    def test_errors(self):
+        for text, details in [
+                ('VAR a = b\nVAR b = c and true\nVAR c = a\na',
+                 "'A' depends on itself (A -> B -> C -> A)"),
+                ('VAR a = true\nVAR a = false', "'A' is already defined"),
+                ('VAR = true', 'Expected identifier'),
+                ('VAR a true', "Expected '='"),
+                ('true false', "Expected 'and' or 'or'"),
+                ('a var b', "Expected 'and' or 'or'")]:
+            result, error = run('<t>', text)
+            self.assertEqual(error.details, details)
+        self.assertEqual(run('<t>', 'VAR a = 1 < 2\n\n;a and true\n')[0].value, 'TRUE')
+
+
+class TestBatchMode(unittest.TestCase):
+
+    def test_results_and_exit_code(self):
+        stdin = io.StringIO('true and !false\n\n3 < x\n1 >= 2\n')
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+
+        exit_code = run_batch(stdin, stdout, stderr)
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(stdout.getvalue(), 'TRUE\nERROR\nFALSE\n')
+        self.assertIn("'X' is not defined", stderr.getvalue())
+
+    def test_success(self):
+        stdout = io.StringIO()
+        exit_code = run_batch(io.StringIO('true\n'), stdout, io.StringIO())
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(stdout.getvalue(), 'TRUE\n')
+
+
+@unittest.skipUnless(np, 'numpy is not installed')
+class TestColumnEvaluation(unittest.TestCase):
+
+    def set_up(self):
+        rng = np.random.default_rng(1)
+        self.columns = {
+            'active': rng.random(500) < 0.5,
+            'age': rng.integers(0, 100, 500),
+            'score': rng.random(500) * 10,
+        }
+        return self
+
+    # evaluate row by row with the normal interpreter
+    def run_rows(self, text):
+        results = []
+        for i in range(len(self.columns['age'])):
+            bindings = {name: column[i].item()
+                        for name, column in self.columns.items()}
+            result, error = run('stdin', text, bindings)
+            if error:
+                return results, error
+            results.append(result.value == 'TRUE')
+        return results, None
+
+    def test_matches_interpreter(self):
+        self.set_up()
+        for text in ["active and age >= 18 or !active and score > 7.5",
+                     "age == 42 or score <= 1 and active != true",
+                     "(age < 50) == active"]:
+            expected, error = self.run_rows(text)
+            result, error = run_columns('stdin', text, self.columns,
+                                        chunk_size=64)
+            self.assertIsNone(error)
+            self.assertEqual(expected, result.tolist())
+
+    def test_error_row(self):
+        self.set_up()
+        mixed = np.array([1, 2.5, True, 4], dtype=object)
+        result, error = run_columns('stdin', 'mixed > 2', {'mixed': mixed},
+                                    chunk_size=2)
+        self.assertIsNone(result)
+        self.assertEqual(error.row, 2)
+        self.assertEqual(error.details, "Comparsion of 'bool' and 'int/float'")
+
+        expected, expected_error = self.run_rows('active and age')
+        result, error = run_columns('stdin', 'active and age', self.columns)
+        self.assertEqual(error.details, expected_error.details)
+        self.assertEqual(error.row, len(expected))
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -126,3 +939,302 @@ if __name__ == '__main__':
 # neg testen (sehr lang)
 
 # neuer datetyp         randfalle wie fehler mit klammern
+
+
+@unittest.skipUnless(np, 'numpy is not installed')
+class TestBitmapIndex(unittest.TestCase):
+
+    def set_up(self):
+        rng = np.random.default_rng(2)
+        rows = 200000
+        score = rng.random(rows) * 10
+        score[rng.random(rows) < 0.01] = np.nan
+        self.columns = {
+            'active': rng.random(rows) < 0.5,
+            'vip': rng.random(rows) < 0.01,
+            'age': rng.integers(0, 100, rows),
+            'score': score,
+        }
+        self.index = BitmapIndex.build(self.columns, buckets=16)
+        return self
+
+    def check(self, index, text):
+        result, error = index.query(text)
+        expected, error = run_columns('stdin', text, self.columns)
+        self.assertEqual(result.count(), int(expected.sum()), text)
+        self.assertTrue(np.array_equal(result.to_array(),
+                                       np.flatnonzero(expected)), text)
+        return result
+
+    def test_matches_columns(self):
+        self.set_up()
+        for text in ['vip and active',
+                     'active and age >= 18 or !active and score > 7.5',
+                     'age == 42 or score <= 1 and active != true',
+                     '!(score < 5) and 30 > age',
+                     'score != 2.5 or vip',
+                     'age < score and (age < 50) == active',
+                     'age == 4.5 or 1 < 2 and vip']:
+            self.check(self.index, text)
+
+        result = self.check(self.index, 'vip and age < 50')
+        # only the bucket holding 50 is looked at row by row
+        self.assertLess(result.rechecked, 200000 // 8)
+        self.assertEqual(list(self.index.row_ids('vip and age < 50')[0])[:3],
+                         result.to_array()[:3].tolist())
+
+    def test_save_and_load(self):
+        self.set_up()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.bmi')
+            self.index.save(path)
+            index = BitmapIndex.load(path)
+            self.check(index, 'active and age >= 18 or !active and score > 7.5')
+            self.check(index, '!vip and age == 99')
+            index.close()
+
+            # results of a loaded index outlive it
+            index = BitmapIndex.load(path)
+            results = [index.query(text)[0] for text in ('vip', 'age < 3', 'active or vip')]
+            expected = [result.to_array().copy() for result in results]
+            index.close()
+            self.assertIsNone(index.mmap)
+            for result, rows in zip(results, expected):
+                self.assertTrue(np.array_equal(result.to_array(), rows))
+
+    def test_errors(self):
+        self.set_up()
+        for text, details in [
+                ('age and vip', "Logical operation on 'int/float' and 'bool'"),
+                ('vip > 1', "Comparsion of 'bool' and 'int/float'"),
+                ('!age', "Negation of 'int/float'"),
+                ('missing or vip', "'MISSING' is not defined"),
+                ('age', "Expected 'bool' result, got 'int/float'")]:
+            result, error = self.index.query(text)
+            self.assertEqual(error.details, details)
+            # the same error, position and row as evaluating the columns
+            mask, expected = run_columns('stdin', text, self.columns)
+            self.assertEqual((error.details, error.pos_start.idx, error.row),
+                             (expected.details, expected.pos_start.idx, expected.row))
+
+    def test_bitmap_operations(self):
+        rng = np.random.default_rng(3)
+        size = 3 * 65536 + 100
+        for density in (0.001, 0.5):
+            a = rng.random(size) < density
+            b = rng.random(size) < 0.05
+            x, y = Bitmap.from_mask(a), Bitmap.from_mask(b)
+            self.assertTrue(np.array_equal((x & y).to_mask(), a & b))
+            self.assertTrue(np.array_equal((x | y).to_mask(), a | b))
+            self.assertTrue(np.array_equal((x ^ y).to_mask(), a ^ b))
+            self.assertTrue(np.array_equal((~x).to_mask(), ~a))
+            self.assertEqual((~x).count(), size - int(a.sum()))
+
+
+class TestSharding(unittest.TestCase):
+
+    rules = [(f'rule-{i}', text) for i, text in enumerate([
+        'a > 3 and b', 'a < 2 or !b', 'a == 5', 'b and c > 1.5',
+        'missing or b', 'a > 1 and (c < 2 or b)', 'true', '!(a >= 0)'])]
+
+    facts = [{'a': a, 'b': b, 'c': c}
+             for a in (0, 1.5, 5, 7) for b in (True, False) for c in (0, 2)]
+
+    def expected(self, rules):
+        matches = []
+        for facts in self.facts:
+            matched = set()
+            for rule_id, text in rules:
+                expr, error = expression.compile(text)
+                value, error = expr.evaluate(facts)
+                if value != None and value.value == 'TRUE':
+                    matched.add(rule_id)
+            matches.append(matched)
+        return matches
+
+    def test_ring_moves_few_keys(self):
+        ring = HashRing()
+        for shard in ('a', 'b', 'c', 'd'):
+            ring.add(shard)
+        keys = [rule_key(i) for i in range(2000)]
+        before = [ring.owner(key) for key in keys]
+        counts = [before.count(shard) for shard in 'abcd']
+        self.assertTrue(min(counts) > 250, counts)
+
+        ring.add('e')
+        after = [ring.owner(key) for key in keys]
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        self.assertTrue(all(new == 'e' for old, new in moved))
+        self.assertTrue(len(moved) < 800, len(moved))
+
+        ring.remove('e')
+        self.assertEqual([ring.owner(key) for key in keys], before)
+
+    def test_worker(self):
+        worker = Worker()
+        worker.handle({'op': 'add', 'rules': self.rules})
+        reply = worker.handle({'op': 'evaluate', 'facts': self.facts})
+        self.assertEqual([set(ids) for ids in reply['matches']],
+                         self.expected(self.rules))
+        # 'missing or b' fails wherever the fact is missing
+        self.assertEqual(reply['errors'], len(self.facts))
+
+    def test_coordinator(self):
+        with Coordinator(workers=2) as coordinator:
+            errors = coordinator.add_many(self.rules + [('bad', 'a >')])
+            self.assertEqual([rule_id for rule_id, error in errors], ['bad'])
+            self.assertEqual(coordinator.evaluate(self.facts),
+                             self.expected(self.rules))
+
+            self.assertTrue(coordinator.remove('rule-6'))
+            self.assertFalse(coordinator.remove('rule-6'))
+            rules = [rule for rule in self.rules if rule[0] != 'rule-6']
+            self.assertEqual(coordinator.evaluate(self.facts), self.expected(rules))
+
+            moved = coordinator.add_worker()
+            self.assertEqual(moved, len(coordinator.shards['shard-2'].rules))
+            self.assertEqual(coordinator.evaluate(self.facts), self.expected(rules))
+
+            coordinator.remove_worker('shard-0')
+            self.assertEqual(coordinator.evaluate(self.facts), self.expected(rules))
+
+            stats = coordinator.stats()
+            self.assertEqual(stats['workers'], 2)
+            self.assertEqual(stats['batches'], 4)
+            self.assertEqual(sum(shard['rules'] for shard in stats['shards']),
+                             len(rules))
+
+    def test_failed_request(self):
+        with Coordinator(workers=3) as coordinator:
+            coordinator.add_many(self.rules)
+            # every worker fails on the batch, all replies must be read
+            with self.assertRaises(WorkerError) as raised:
+                coordinator.evaluate([{'a': 'text'}])
+            self.assertEqual(str(raised.exception).count('Cannot bind'), 3)
+            self.assertEqual(coordinator.evaluate(self.facts),
+                             self.expected(self.rules))
+
+
+class TestLazyFacts(unittest.TestCase):
+
+    def set_up(self, delays=None, **options):
+        self.calls = []
+        facts = {'a': True, 'b': False, 'x': 3, 'y': 4.5, 'boom': None}
+
+        def provider(name):
+            async def fetch(subject):
+                self.calls.append((name, subject))
+                await asyncio.sleep((delays or {}).get(name, 0))
+                if name == 'boom':
+                    raise KeyError('gone')
+                return facts[name]
+            return fetch
+
+        self.facts = {name: value for name, value in facts.items() if value != None}
+        self.evaluator = LazyEvaluator({name: provider(name) for name in facts},
+                                       **options)
+        return self
+
+    def evaluate(self, text, subject=None, bindings=None):
+        expr, error = expression.compile(text)
+        return asyncio.run(self.evaluator.evaluate(expr, subject, bindings))
+
+    def fetched(self):
+        return sorted(name for name, subject in self.calls)
+
+    def test_same_results(self):
+        self.set_up()
+        for text in ['a and x > 2', 'b or y <= x', '!(x == 3) or a and !b',
+                     '(x > 1 or b) and (y == 4.5)', 'x', 'x == a', 'x and a']:
+            value, error = self.evaluate(text)
+            expected, expected_error = run('<expr>', text, self.facts)
+            self.assertEqual(str(value), str(expected))
+            self.assertEqual(error and error.as_string(),
+                             expected_error and expected_error.as_string())
+
+    def test_short_circuit(self):
+        self.set_up()
+        value, error = self.evaluate('a or x > 100')
+        self.assertEqual(value.value, 'TRUE')
+        self.assertEqual(self.fetched(), ['a'])
+        value, error = self.evaluate('b and (x > 1 or y > 1)')
+        self.assertEqual(value.value, 'FALSE')
+        self.assertEqual(self.fetched(), ['a', 'b'])
+        self.assertEqual(self.evaluator.skipped, 2)
+
+    def test_bindings_and_dedup(self):
+        self.set_up()
+        value, error = self.evaluate('x > 1 and x < y and x != y', bindings={'y': 9})
+        self.assertEqual(value.value, 'TRUE')
+        self.assertEqual(self.fetched(), ['x'])
+
+        self.set_up()
+        value, error = self.evaluate('x == x')
+        self.assertEqual(self.fetched(), ['x'])
+        self.assertEqual(self.evaluator.deduplicated, 1)
+
+    def test_errors(self):
+        self.set_up(delays={'y': 1}, timeout=0.01)
+        value, error = self.evaluate('a and missing')
+        self.assertEqual(error.details, "'MISSING' is not defined")
+        value, error = self.evaluate('a and y > 1')
+        self.assertEqual(error.details, "Fetching 'Y' timed out")
+        self.assertEqual(error.pos_start.idx, 6)
+        value, error = self.evaluate('boom or a')
+        self.assertEqual(error.details, "Fetching 'BOOM' failed: 'gone'")
+        self.assertEqual(self.evaluator.timeouts, 1)
+        self.assertEqual(self.evaluator.failures, 1)
+
+    def test_cache(self):
+        cache = FactCache()
+        self.set_up(cache=cache)
+        self.evaluate('a and x > 1', subject=1)
+        self.evaluate('a and x > 1', subject=1)
+        self.evaluate('a and x > 1', subject=2)
+        self.assertEqual(self.calls, [('a', 1), ('x', 1), ('a', 2), ('x', 2)])
+        self.assertEqual(cache.hits, 2)
+
+        cache = FactCache(ttl=0)
+        self.set_up(cache=cache)
+        self.evaluate('a', subject=1)
+        self.evaluate('a', subject=1)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_fetches(self):
+        delays = {'a': 0.05, 'x': 0.05, 'y': 0.05}
+        self.set_up(delays=delays)
+        start = time.perf_counter()
+        value, error = self.evaluate('x < y')
+        self.assertLess(time.perf_counter() - start, 0.09)
+
+        self.set_up(delays=delays, speculate=True)
+        start = time.perf_counter()
+        value, error = self.evaluate('a and x < y')
+        self.assertEqual(value.value, 'TRUE')
+        self.assertLess(time.perf_counter() - start, 0.09)
+
+        # the speculative fetches of the skipped operand are cancelled
+        self.set_up(delays={'x': 1}, speculate=True)
+        value, error = self.evaluate('!a and x > 1')
+        self.assertEqual(value.value, 'FALSE')
+        self.assertEqual(self.evaluator.cancelled, 1)
+
+    def test_adaptive_speculation(self):
+        delays = {}
+        self.set_up(delays=delays, speculate='adaptive')
+        expr, error = expression.compile('(a and x > 1) or (!a and y > 1)')
+
+        async def evaluate_all():
+            for i in range(ADAPTIVE_WARMUP):
+                await self.evaluator.evaluate(expr, i)
+            # the left operand of 'or' always decides, 'a' never does
+            delays.update({'a': 0.05, 'x': 0.05, 'y': 0.05})
+            start = time.perf_counter()
+            value, error = await self.evaluator.evaluate(expr, 'last')
+            return value, time.perf_counter() - start
+
+        value, elapsed = asyncio.run(evaluate_all())
+        self.assertEqual(value.value, 'TRUE')
+        self.assertLess(elapsed, 0.09)
+        self.assertEqual(sorted(name for name, subject in self.calls
+                                if subject == 'last'), ['a', 'x'])
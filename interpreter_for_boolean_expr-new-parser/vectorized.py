@@ -0,0 +1,311 @@
+
+##########################
+# VECTORIZED EVALUATION
+##########################
+
+# Evaluates one expression against whole columns (one row per record)
+# instead of calling the Interpreter once per row.
+
+import numpy as np
+from interpreter import *
+
+
+DEFAULT_CHUNK_SIZE = 65536
+
+
+##########################
+# ERRORS
+##########################
+
+class ColumnError(RTError):
+    def __init__(self, pos_start, pos_end, details, context, row=0):
+        super().__init__(pos_start, pos_end, details, context)
+        self.row = row
+
+    def as_string(self):
+        result = super().as_string()
+        result += f'\n\nin row {self.row}'
+        return result
+
+
+##########################
+# CHUNK
+##########################
+
+class Chunk:
+    def __init__(self, columns, start, stop, context):
+        self.columns = columns
+        self.start = start
+        self.stop = stop
+        self.size = stop - start
+        self.context = context
+
+    def column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            return None
+        return column[self.start:self.stop]
+
+
+##########################
+# COLUMN INTERPRETER
+##########################
+
+# Every visit returns (values, is_bool, error) for one chunk.
+# values and is_bool are arrays with one entry per row, is_bool tells
+# if the row holds a 'bool' or an 'int/float' like Booleen and Number.
+# error is None or (row, ColumnError) for the first failing row.
+
+class ColumnInterpreter:
+    def visit(self, node, chunk):
+        method_name = f'visit_{type(node).__name__}'
+        method = getattr(self, method_name, self.no_visit_method)
+        return method(node, chunk)
+
+    def no_visit_method(self, node, chunk):
+        raise Exception(f'No visit_{type(node).__name__} method defined')
+
+    def visit_BooleanNode(self, node, chunk):
+        values = np.full(chunk.size, node.tok.value == 'TRUE')
+        return values, np.ones(chunk.size, dtype=bool), None
+
+    def visit_NumberNode(self, node, chunk):
+        values = np.full(chunk.size, node.tok.value)
+        return values, np.zeros(chunk.size, dtype=bool), None
+
+    def visit_VarAccessNode(self, node, chunk):
+        var_name = node.var_name_tok.value
+        values = chunk.column(var_name)
+
+        if values is None:
+            error = ColumnError(
+                node.pos_start, node.pos_end,
+                f"'{var_name}' is not defined",
+                chunk.context
+            )
+            return None, None, (0, error)
+
+        if values.dtype.kind == 'O':
+            is_bool = np.fromiter(
+                (isinstance(value, (bool, np.bool_)) for value in values),
+                dtype=bool, count=chunk.size)
+        else:
+            is_bool = np.full(chunk.size, values.dtype.kind == 'b')
+        return values, is_bool, None
+
+    def visit_BinOpNode(self, node, chunk):
+        # long chains nest on the left, the left spine is walked in a loop
+        spine = left_spine(node)
+        left = self.visit(spine[-1].left_node, chunk)
+        for node in reversed(spine):
+            left = self.combine(node, left, chunk)
+        return left
+
+    def combine(self, node, left, chunk):
+        # node with its left operand visited already
+        left, left_is_bool, left_error = left
+        right, right_is_bool, right_error = self.visit(node.right_node, chunk)
+        errors = [left_error, right_error]
+        if left is None or right is None:
+            return None, None, first_error(errors)
+
+        op_tok = node.op_tok
+        if op_tok.matches(TT_KEYWORD, 'AND') or op_tok.matches(TT_KEYWORD, 'OR'):
+            # Number.and_to reports on itself, Booleen.and_to on the other side
+            errors.append(self.find_error(
+                ~left_is_bool, node.left_node, chunk,
+                lambda row: "Logical operation on 'int/float' and "
+                            f"'{kind_name(right_is_bool[row])}'"))
+            errors.append(self.find_error(
+                left_is_bool & ~right_is_bool, node.right_node, chunk,
+                lambda row: "Logical operation on 'bool' and 'int/float'"))
+            left = as_bool(left)
+            right = as_bool(right)
+            if op_tok.matches(TT_KEYWORD, 'AND'):
+                values = left & right
+            else:
+                values = left | right
+
+        elif op_tok.type in (TT_EE, TT_NE):
+            # values of different types are never equal
+            values = (left_is_bool == right_is_bool) & equal(left, right)
+            if op_tok.type == TT_NE:
+                values = ~values
+
+        else:
+            # Booleen reports on itself, Number.less_than on the other side
+            errors.append(self.find_error(
+                left_is_bool, node.left_node, chunk,
+                lambda row: "Comparsion of 'bool' and "
+                            f"'{kind_name(right_is_bool[row])}'"))
+            errors.append(self.find_error(
+                ~left_is_bool & right_is_bool, node.right_node, chunk,
+                lambda row: "Comparsion of 'bool' and 'int/float'"))
+            values = compare(op_tok.type, left, right)
+
+        return values, np.ones(chunk.size, dtype=bool), first_error(errors)
+
+    def visit_UnaryOpNode(self, node, chunk):
+        values, is_bool, error = self.visit(node.node, chunk)
+        if values is None:
+            return None, None, error
+
+        errors = [error]
+        if node.op_tok.type == TT_NEG:
+            errors.append(self.find_error(
+                ~is_bool, node.node, chunk,
+                lambda row: "Negation of 'int/float'"))
+            values = ~as_bool(values)
+        return values, np.ones(chunk.size, dtype=bool), first_error(errors)
+
+    def find_error(self, mask, node, chunk, details):
+        if not mask.any():
+            return None
+        row = int(np.argmax(mask))
+        return row, ColumnError(
+            node.pos_start, node.pos_end,
+            details(row),
+            chunk.context
+        )
+
+
+def kind_name(is_bool):
+    if is_bool:
+        return 'bool'
+    return 'int/float'
+
+
+def as_bool(values):
+    if values.dtype == bool:
+        return values
+    return values.astype(bool)
+
+
+def equal(left, right):
+    return np.asarray(left == right, dtype=bool)
+
+
+def compare(op_type, left, right):
+    if op_type == TT_LT:
+        return np.asarray(left < right, dtype=bool)
+    if op_type == TT_LTE:
+        return np.asarray(left <= right, dtype=bool)
+    if op_type == TT_GT:
+        return np.asarray(left > right, dtype=bool)
+    return np.asarray(left >= right, dtype=bool)
+
+
+def first_error(errors):
+    # lowest row wins, on a tie the one evaluated first like in the Interpreter
+    result = None
+    for error in errors:
+        if error and (result == None or error[0] < result[0]):
+            result = error
+    return result
+
+
+##########################
+# RUN
+##########################
+
+def prepare_columns(columns):
+    prepared = {}
+    length = None
+
+    for name, column in columns.items():
+        column = np.asarray(column)
+        if column.ndim != 1:
+            raise ValueError(f"Column '{name}' must be one-dimensional")
+        if column.dtype.kind not in 'biufO':
+            raise TypeError(
+                f"Column '{name}' must hold bool, int or float values")
+        if length == None:
+            length = len(column)
+        elif len(column) != length:
+            raise ValueError(f"Column '{name}' has {len(column)} rows, "
+                             f"expected {length}")
+        prepared[name.upper()] = column
+
+    return prepared, length or 0
+
+
+def evaluate_columns(node, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    columns, length = prepare_columns(columns)
+    interpreter = ColumnInterpreter()
+    context = Context('<program>')
+    result = np.empty(length, dtype=bool)
+
+    # process big tables in fixed-size chunks to bound temporary memory
+    for start in range(0, length, chunk_size):
+        stop = min(start + chunk_size, length)
+        chunk = Chunk(columns, start, stop, context)
+        values, is_bool, error = interpreter.visit(node, chunk)
+
+        if error:
+            row, error = error
+            error.row = start + row
+            return None, error
+
+        if not is_bool.all():
+            row = int(np.argmin(is_bool))
+            return None, ColumnError(
+                node.pos_start, node.pos_end,
+                "Expected 'bool' result, got 'int/float'",
+                context, start + row
+            )
+
+        result[start:stop] = values
+
+    return result, None
+
+
+def run_columns(fn, text, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Generate tokens
+    lexer = Lexer(fn, text)
+    tokens, error = lexer.make_tokens()
+    if error:
+        return None, error
+
+    # Generate AST
+    parser = Parser(tokens)
+    ast = parser.parse()
+    if ast.error:
+        return None, ast.error
+
+    # Run program over all rows
+    return evaluate_columns(ast.node, columns, chunk_size)
+
+
+##########################
+# BENCHMARK
+##########################
+
+if __name__ == '__main__':
+    import time
+
+    rows = 1_000_000
+    rng = np.random.default_rng(0)
+    columns = {
+        'active': rng.random(rows) < 0.5,
+        'age': rng.integers(0, 100, rows),
+        'score': rng.random(rows) * 10,
+    }
+    text = 'active and age >= 18 or !active and score > 7.5'
+
+    start = time.perf_counter()
+    result, error = run_columns('<bench>', text, columns)
+    elapsed = time.perf_counter() - start
+    print(f'vectorized: {rows / elapsed:,.0f} rows/s')
+
+    sample = 2000
+    interpreter = Interpreter()
+    ast = Parser(Lexer('<bench>', text).make_tokens()[0]).parse().node
+    start = time.perf_counter()
+    for i in range(sample):
+        context = Context('<program>')
+        context.symbol_table = SymbolTable(global_symbol_table)
+        context.symbol_table.update(
+            {name: column[i].item() for name, column in columns.items()})
+        interpreter.visit(ast, context)
+    elapsed = time.perf_counter() - start
+    print(f'row at a time: {sample / elapsed:,.0f} rows/s')